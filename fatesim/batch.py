@@ -0,0 +1,217 @@
+from math import isfinite
+from typing import List, Tuple
+import numpy as np
+
+from fatesim import profiling
+from fatesim.simulation import determine_total_modifier
+from fatesim.stats import SimulationStats
+from fatesim.unit import Unit, UnitGroup
+
+# Trials are rolled in chunks of this size to bound memory use
+DEFAULT_BATCH_SIZE = 1 << 20
+
+
+def count_combat_dice(units: List[Unit]) -> Tuple[int, int]:
+    # Number of (d6, d3) a set of units rolls; only military units fight and
+    # bloodied units roll a d3 instead of a d6
+    military = [u for u in units if u.has_military]
+    num_d3 = sum(1 for u in military if u.is_bloodied)
+    return len(military) - num_d3, num_d3
+
+
+def max_roll(num_d6: int, num_d3: int) -> int:
+    return 6*num_d6 + 3*num_d3
+
+
+def casualty_signature(units: List[Unit]) -> Tuple[Tuple[int, bool], ...]:
+    # Casualty allocation only depends on unit costs and bloodied state
+    return tuple((u.cost, u.is_bloodied) for u in units)
+
+
+# Keyed by (casualty signature, max deficit); tables are read-only
+_COST_TABLES = {}
+
+
+@profiling.profiled("casualty_tables")
+def casualty_cost_table(ug: UnitGroup, max_deficit: int) -> np.ndarray:
+    # Renown lost by 'ug' when losing a battle by each deficit in
+    # [0, max_deficit], following the reference casualty rules so the
+    # batched path allocates deaths and bloodying exactly like
+    # 'determine_new_units'
+    key = (casualty_signature(ug.units), max_deficit)
+    if key in _COST_TABLES:
+        return _COST_TABLES[key]
+
+    # Rather than running 'allocate_casualties' for every deficit, walk its
+    # rules over the cost-sorted units once: deficit d kills the d // 6
+    # cheapest units (prefix sums of their values) and the rest makes at
+    # most two hits on the survivors, so large groups take O(n log n + d)
+    units = sorted(ug.units, key=lambda unit: unit.cost)
+    costs = [u.cost for u in units]
+    bloodied = [u.is_bloodied for u in units]
+    n = len(units)
+    dead_value = [0]
+    for u in units:
+        dead_value.append(dead_value[-1] + u.renown_value())
+    # Index of the first unbloodied unit at or after each position
+    next_unbloodied = [n] * (n + 1)
+    for i in range(n - 1, -1, -1):
+        next_unbloodied[i] = next_unbloodied[i + 1] if bloodied[i] else i
+
+    table = np.zeros(max_deficit + 1, dtype=np.int64)
+    for deficit in range(1, max_deficit + 1):
+        num_deaths = deficit // 6
+        if num_deaths >= n:
+            # Everything is dead, larger deficits cannot cost more
+            table[deficit:] = dead_value[n]
+            break
+        remainder = deficit - 6 * num_deaths
+        lost = dead_value[num_deaths]
+        # Survivors are units [num_deaths, last]; hits bloody the cheapest
+        # unbloodied survivor or remove the last once all are bloodied
+        last = n - 1
+        search = num_deaths
+        for _ in range(remainder // 3 + (remainder % 3 > 0)):
+            if last < num_deaths:
+                break
+            i = next_unbloodied[search]
+            if i > last:
+                # Bloodied (now or before), so worth half its cost
+                lost += costs[last] // 2
+                last -= 1
+            else:
+                lost += costs[i] - costs[i] // 2
+                search = i + 1
+        table[deficit] = lost
+    table.flags.writeable = False
+    _COST_TABLES[key] = table
+    return table
+
+
+@profiling.profiled("dice_rolling")
+def roll_dice_sums(rng: np.random.Generator, n: int,
+                   num_d6: int, num_d3: int) -> np.ndarray:
+    # Sum of 'num_d6' d6 and 'num_d3' d3 for each of 'n' trials
+    totals = np.zeros(n, dtype=np.int64)
+    if num_d6:
+        totals += rng.integers(1, 7, size=(n, num_d6)).sum(axis=1)
+    if num_d3:
+        totals += rng.integers(1, 4, size=(n, num_d3)).sum(axis=1)
+    return totals
+
+
+class BatchedMatchup():
+    # Everything that stays fixed across trials of one matchup: dice counts,
+    # total modifiers and per-deficit casualty cost tables, since each trial
+    # starts from the same two unit groups
+    def __init__(self, ug1: UnitGroup, ug2: UnitGroup, is_open: bool,
+                 extra_modifiers=(0, 0)) -> None:
+        self.ug1 = ug1
+        self.ug2 = ug2
+        self.is_open = is_open
+        self.dice_1 = count_combat_dice(ug1.units)
+        self.dice_2 = count_combat_dice(ug2.units)
+        # As in 'simulate_battle', 'extra_modifiers' are added to each side
+        self.modifier_1 = determine_total_modifier(ug1, ug2, is_open) +\
+            extra_modifiers[0]
+        self.modifier_2 = determine_total_modifier(ug2, ug1, is_open) +\
+            extra_modifiers[1]
+        # Largest deficit each side can lose by (every die rolling 1 against
+        # every opposing die rolling its maximum)
+        self.cost_table_1 = casualty_cost_table(
+            ug1, max(max_roll(*self.dice_2) + self.modifier_2
+                     - sum(self.dice_1) - self.modifier_1, 0))
+        self.cost_table_2 = casualty_cost_table(
+            ug2, max(max_roll(*self.dice_1) + self.modifier_1
+                     - sum(self.dice_2) - self.modifier_2, 0))
+
+    @classmethod
+    def prepare(cls, ug1: UnitGroup, ug2: UnitGroup, is_open: bool,
+                extra_modifiers=(0, 0)):
+        # None (as with 'simulate_battle') unless both sides can fight
+        if not any(u.has_military for u in ug1.units) or\
+                not any(u.has_military for u in ug2.units):
+            print("Both units_1 and units_2 must be non-empty")
+            return None
+        return cls(ug1, ug2, is_open, extra_modifiers)
+
+    def blank_stats(self, keep_trials=False) -> SimulationStats:
+        sim_stats = SimulationStats.blank(keep_trials)
+        sim_stats.ug1 = self.ug1
+        sim_stats.ug2 = self.ug2
+        return sim_stats
+
+    def run(self, sim_stats: SimulationStats, rng: np.random.Generator,
+            n: int, batch_size=DEFAULT_BATCH_SIZE) -> None:
+        # Add 'n' trials to 'sim_stats'
+        for start in range(0, n, batch_size):
+            size = min(batch_size, n - start)
+            totals_1 = roll_dice_sums(rng, size, *self.dice_1) +\
+                self.modifier_1
+            totals_2 = roll_dice_sums(rng, size, *self.dice_2) +\
+                self.modifier_2
+            deficits = totals_1 - totals_2
+            if profiling.ENABLED:
+                profiling.count("battles", size)
+                profiling.count("dice_rolled", size * (sum(self.dice_1)
+                                                       + sum(self.dice_2)))
+            sim_stats.add_batch(deficits,
+                                self.cost_table_1[np.maximum(-deficits, 0)],
+                                self.cost_table_2[np.maximum(deficits, 0)])
+
+
+@profiling.profiled("simulate_n_stats_vectorized")
+def simulate_n_stats_vectorized(ug1: UnitGroup, ug2: UnitGroup,
+                                is_open: bool, n=100, seed=None,
+                                batch_size=DEFAULT_BATCH_SIZE,
+                                keep_trials=False, extra_modifiers=(0, 0)):
+    # Batched equivalent of 'simulate_n_stats': every trial's dice are rolled
+    # as one array and casualties are looked up from per-deficit tables
+    matchup = BatchedMatchup.prepare(ug1, ug2, is_open, extra_modifiers)
+    if matchup is None:
+        return None
+
+    sim_stats = matchup.blank_stats(keep_trials)
+    matchup.run(sim_stats, np.random.default_rng(seed), n, batch_size)
+    return sim_stats
+
+
+@profiling.profiled("simulate_to_precision")
+def simulate_to_precision(ug1: UnitGroup, ug2: UnitGroup, is_open: bool,
+                          precision: float, target="win_probability",
+                          confidence=0.95, max_trials=1000000,
+                          batch_size=1000, seed=None, keep_trials=False,
+                          extra_modifiers=(0, 0)):
+    # Sequential sampling: run trials in batches until every interval for
+    # 'target' is within +/- 'precision' at the given 'confidence', or
+    # 'max_trials' is reached. 'target' is "win_probability" (both sides'
+    # win rates, 'precision' as a probability) or "cost" (both sides'
+    # average renown cost, 'precision' in renown)
+    # The returned stats record 'confidence', 'target_precision',
+    # 'achieved_precision' and the final 'intervals'
+    matchup = BatchedMatchup.prepare(ug1, ug2, is_open, extra_modifiers)
+    if matchup is None:
+        return None
+
+    rng = np.random.default_rng(seed)
+    sim_stats = matchup.blank_stats(keep_trials)
+    # Cost intervals need at least 2 trials to be finite
+    size = min(max(batch_size, 2), max_trials)
+    while True:
+        matchup.run(sim_stats, rng, size)
+        intervals = sim_stats.confidence_intervals(target, confidence)
+        half_width = max((high - low) / 2 for low, high in intervals.values())
+        trials = sim_stats.accumulator.num_trials
+        if half_width <= precision or trials >= max_trials:
+            break
+        # Interval widths shrink like 1/sqrt(n): jump straight to the
+        # estimated number of trials needed, at least one more batch
+        needed = int(trials * (half_width / precision)**2) - trials\
+            if isfinite(half_width) else batch_size
+        size = min(max(needed, batch_size), max_trials - trials)
+
+    sim_stats.confidence = confidence
+    sim_stats.target_precision = precision
+    sim_stats.achieved_precision = half_width
+    sim_stats.intervals = intervals
+    return sim_stats
@@ -0,0 +1,196 @@
+from collections import OrderedDict
+from hashlib import sha1
+from pathlib import Path
+from typing import Tuple
+import os
+
+from fatesim.stats import SimulationStats, simulate_n_stats
+from fatesim.unit import UNIT_COSTS, UNIT_TEMPLATES, Unit, UnitGroup
+
+# Bump when the simulation rules change so stale entries stop matching
+CACHE_VERSION = 2
+DEFAULT_CACHE_DIR = Path(os.environ.get("FATESIM_CACHE_DIR",
+                                        Path.home() / ".cache" / "fatesim"))
+
+
+def _digest(obj) -> str:
+    return sha1(repr(obj).encode()).hexdigest()
+
+
+def unit_fingerprint(unit: Unit) -> Tuple:
+    # Everything about a unit that can change a battle's outcome
+    return (unit.name, unit.kind, unit.movement, unit.has_military,
+            tuple(sorted(str(m) for m in unit.modifiers)), unit.cost,
+            unit.is_bloodied)
+
+
+def unit_group_fingerprint(ug: UnitGroup) -> Tuple:
+    # Order-independent; casualties only depend on unit costs, so the order
+    # units are listed in does not change results
+    return tuple(sorted(unit_fingerprint(u) for u in ug.units))
+
+
+# (template factories, unit costs) -> fingerprint of the last definitions
+_definitions_memo = (None, None)
+
+
+def definitions_fingerprint() -> str:
+    # Changes whenever a template or unit cost is edited. Templates are only
+    # rebuilt and hashed when a factory is added, removed or replaced or a
+    # cost changes, not on every cache lookup
+    global _definitions_memo
+    contents = (tuple(UNIT_TEMPLATES.items()), tuple(UNIT_COSTS.items()))
+    if _definitions_memo[0] == contents:
+        return _definitions_memo[1]
+    templates = [(name, unit_fingerprint(UNIT_TEMPLATES[name]()))
+                 for name in sorted(UNIT_TEMPLATES)]
+    fingerprint = _digest((CACHE_VERSION, templates,
+                           sorted(UNIT_COSTS.items())))
+    _definitions_memo = (contents, fingerprint)
+    return fingerprint
+
+
+def seed_fingerprint(seed):
+    # Keyable form of a 'simulate_n_stats' seed (an int or a SeedSequence),
+    # None for anything else, e.g. a Generator whose state keeps moving
+    import numpy as np
+    if isinstance(seed, (int, np.integer)) and not isinstance(seed, bool):
+        return int(seed)
+    if isinstance(seed, np.random.SeedSequence):
+        return ("SeedSequence", seed.entropy, tuple(seed.spawn_key),
+                seed.pool_size)
+    return None
+
+
+def matchup_key(ug1: UnitGroup, ug2: UnitGroup, is_open: bool, n: int,
+                extra_modifiers=(0, 0), seed=None) -> str:
+    parts = (unit_group_fingerprint(ug1), unit_group_fingerprint(ug2),
+             is_open, n)
+    # Only keyed when set, so plain battles keep their existing entries
+    if tuple(extra_modifiers) != (0, 0):
+        parts += (tuple(int(m) for m in extra_modifiers),)
+    # Unseeded runs are interchangeable, seeded ones only with the same seed
+    if seed is not None:
+        fingerprint = seed_fingerprint(seed)
+        if fingerprint is None:
+            raise ValueError(f"Cannot key a cache entry on seed {seed!r}")
+        parts += (("seed", fingerprint),)
+    return _digest(parts)
+
+
+def _encode(sim_stats: SimulationStats) -> dict:
+    # Accumulator totals only, so entries are small and do not depend on the
+    # groups' uids
+    import numpy as np
+    acc = sim_stats.accumulator
+    data = {name: np.int64(value) for name, value in vars(acc).items()
+            if name != "deficit_counts"}
+    data["deficit_values"] = np.array(list(acc.deficit_counts.keys()),
+                                      dtype=np.int64)
+    data["deficit_counts"] = np.array(list(acc.deficit_counts.values()),
+                                      dtype=np.int64)
+    return data
+
+
+def _decode(data: dict, ug1: UnitGroup, ug2: UnitGroup) -> SimulationStats:
+    sim_stats = SimulationStats.blank()
+    sim_stats.ug1 = ug1
+    sim_stats.ug2 = ug2
+    acc = sim_stats.accumulator
+    for name, value in data.items():
+        if name not in ("deficit_values", "deficit_counts"):
+            setattr(acc, name, int(value))
+    acc.deficit_counts = dict(zip(data["deficit_values"].tolist(),
+                                  data["deficit_counts"].tolist()))
+    return sim_stats
+
+
+class MatchupCache():
+    # Two-tier cache of 'simulate_n_stats' results: an in-memory LRU in front
+    # of one .npz file per matchup on disk. Disk entries live in a directory
+    # named after the current template/cost definitions, so editing
+    # UNIT_TEMPLATES or UNIT_COSTS invalidates everything automatically
+    def __init__(self, directory=DEFAULT_CACHE_DIR, maxsize=1024) -> None:
+        self.directory = Path(directory) / "matchups" if directory else None
+        self.maxsize = maxsize
+        self._memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, definitions: str, key: str) -> Path:
+        return self.directory / definitions / f"{key}.npz"
+
+    def _remember(self, full_key: Tuple[str, str], data: dict) -> None:
+        self._memory[full_key] = data
+        self._memory.move_to_end(full_key)
+        while len(self._memory) > self.maxsize:
+            self._memory.popitem(last=False)
+
+    def get(self, ug1: UnitGroup, ug2: UnitGroup, is_open: bool, n: int,
+            extra_modifiers=(0, 0), seed=None) -> SimulationStats:
+        # Cached stats relabelled for 'ug1' and 'ug2', or None
+        definitions = definitions_fingerprint()
+        full_key = (definitions, matchup_key(ug1, ug2, is_open, n,
+                                             extra_modifiers, seed))
+        data = self._memory.get(full_key)
+        if data is None and self.directory is not None:
+            path = self._path(*full_key)
+            if path.exists():
+                import numpy as np
+                with np.load(path) as npz:
+                    data = {name: npz[name] for name in npz.files}
+        if data is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._remember(full_key, data)
+        return _decode(data, ug1, ug2)
+
+    def put(self, ug1: UnitGroup, ug2: UnitGroup, is_open: bool, n: int,
+            sim_stats: SimulationStats, extra_modifiers=(0, 0),
+            seed=None) -> None:
+        definitions = definitions_fingerprint()
+        full_key = (definitions, matchup_key(ug1, ug2, is_open, n,
+                                             extra_modifiers, seed))
+        data = _encode(sim_stats)
+        self._remember(full_key, data)
+        if self.directory is not None:
+            path = self._path(*full_key)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # Write then rename so readers never see a partial file
+            tmp_path = path.with_suffix(f".{os.getpid()}.tmp.npz")
+            import numpy as np
+            np.savez(tmp_path, **data)
+            os.replace(tmp_path, path)
+
+    def simulate_n_stats(self, ug1: UnitGroup, ug2: UnitGroup,
+                         is_open: bool, n=100, extra_modifiers=(0, 0),
+                         **kwargs) -> SimulationStats:
+        # 'simulate_n_stats' that only runs on a cache miss. Entries hold
+        # totals of fixed-size runs only, so runs that keep their trials or
+        # sample to a precision always simulate. A 'seed' is part of the
+        # key; runs with a 'dice' source or a seed that cannot be keyed
+        # always simulate too
+        seed = kwargs.get("seed")
+        if kwargs.get("keep_trials") or kwargs.get("precision") is not None\
+                or kwargs.get("dice") is not None or\
+                (seed is not None and seed_fingerprint(seed) is None):
+            return simulate_n_stats(ug1, ug2, is_open, n=n,
+                                    extra_modifiers=extra_modifiers, **kwargs)
+        sim_stats = self.get(ug1, ug2, is_open, n, extra_modifiers, seed)
+        if sim_stats is None:
+            sim_stats = simulate_n_stats(ug1, ug2, is_open, n=n,
+                                         extra_modifiers=extra_modifiers,
+                                         **kwargs)
+            if sim_stats is not None:
+                self.put(ug1, ug2, is_open, n, sim_stats, extra_modifiers,
+                         seed)
+        return sim_stats
+
+    def clear(self) -> None:
+        # Empties both tiers, including entries for older definitions
+        self._memory.clear()
+        if self.directory is not None and self.directory.exists():
+            for path in self.directory.glob("*/*.npz"):
+                path.unlink()
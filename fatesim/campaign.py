@@ -0,0 +1,215 @@
+from typing import Callable, Dict, List
+import numpy as np
+
+from fatesim.modifier import UNIT_KINDS
+from fatesim.nation import Nation
+from fatesim.resources import registry
+from fatesim.settlement import SETTLEMENT_KINDS, Settlement
+from fatesim.unit import UNIT_COSTS, Unit
+
+# Turn engine for many nations over many campaign replicas at once. Every
+# quantity is an array over (replica, nation) - settlement and unit counts
+# get a trailing axis over SETTLEMENT_KINDS / UNIT_KINDS - so one turn is a
+# handful of array operations however many nations and replicas there are.
+# Each turn:
+#   1. Settlements pay out their RenownGain and FateGain
+#   2. New settlements are founded, charging their Prosperity/HappinessTax
+#   3. Units are recruited for their renown cost, up to what is affordable
+#      and the nation's military unit cap
+# Indicators are clamped to [-3, 3] as in 'Nation'; resources are unbounded
+
+INDICATOR_MIN, INDICATOR_MAX = -3, 3
+
+
+class SettlementTable():
+    # 'settlement_ref.csv' as arrays in SETTLEMENT_KINDS order
+    def __init__(self, ref: Dict[str, Dict[str, int]] = None) -> None:
+        if ref is None:
+            ref = registry().settlements
+        self.renown_gain = np.array([ref[k]["RenownGain"]
+                                     for k in SETTLEMENT_KINDS], dtype=np.int64)
+        self.fate_gain = np.array([ref[k]["FateGain"]
+                                   for k in SETTLEMENT_KINDS], dtype=np.int64)
+        self.prosperity_tax = np.array([ref[k]["ProsperityTax"]
+                                        for k in SETTLEMENT_KINDS],
+                                       dtype=np.int64)
+        self.happiness_tax = np.array([ref[k]["HappinessTax"]
+                                       for k in SETTLEMENT_KINDS],
+                                      dtype=np.int64)
+
+
+def unit_cost_array() -> np.ndarray:
+    # Recruitment costs in UNIT_KINDS order, read when needed so changes to
+    # UNIT_COSTS (e.g. in a sensitivity sweep) take effect
+    return np.array([UNIT_COSTS[k] for k in UNIT_KINDS], dtype=np.int64)
+
+
+class CampaignState():
+    def __init__(self, names: List[str], renown: np.ndarray, fate: np.ndarray,
+                 prosperity: np.ndarray, happiness: np.ndarray,
+                 settlements: np.ndarray, units: np.ndarray,
+                 military_unit_cap: np.ndarray) -> None:
+        self.names = names
+        # (replicas, nations)
+        self.renown = renown
+        self.fate = fate
+        self.prosperity = prosperity
+        self.happiness = happiness
+        # (replicas, nations, len(SETTLEMENT_KINDS))
+        self.settlements = settlements
+        # (replicas, nations, len(UNIT_KINDS)), military units only
+        self.units = units
+        # (nations,)
+        self.military_unit_cap = military_unit_cap
+        self.turn = 0
+
+    @property
+    def num_replicas(self) -> int:
+        return self.renown.shape[0]
+
+    @property
+    def num_nations(self) -> int:
+        return self.renown.shape[1]
+
+    @classmethod
+    def from_nations(cls, nations: List[Nation], replicas=1):
+        # Every replica starts from the same 'nations'
+        def tile(values):
+            values = np.array(values, dtype=np.int64)
+            return np.tile(values, (replicas,) + (1,) * values.ndim)
+
+        settlements = [[sum(s.kind == kind for s in (n.settlements or []))
+                        for kind in SETTLEMENT_KINDS] for n in nations]
+        units = [[sum(u.kind == kind and u.has_military
+                      for u in (n.units or [])) for kind in UNIT_KINDS]
+                 for n in nations]
+        return cls([n.name for n in nations],
+                   tile([n.renown for n in nations]),
+                   tile([n.fate for n in nations]),
+                   tile([n.prosperity for n in nations]),
+                   tile([n.happiness for n in nations]),
+                   tile(settlements), tile(units),
+                   np.array([n.military_unit_cap for n in nations],
+                            dtype=np.int64))
+
+    def to_nations(self, replica=0) -> List[Nation]:
+        # Nations as they stand in one replica. Units are rebuilt as plain
+        # units of their kind (movement from 'units.csv', no bonuses)
+        unit_ref = registry().units
+        nations = []
+        for i, name in enumerate(self.names):
+            settlements = [Settlement(f"{name} {kind} {j + 1}", kind)
+                           for kind, count in zip(SETTLEMENT_KINDS,
+                                                  self.settlements[replica, i])
+                           for j in range(count)]
+            units = [Unit(unit_ref[kind]["BaseMovement"], True, kind, [],
+                          affiliation=name)
+                     for kind, count in zip(UNIT_KINDS,
+                                            self.units[replica, i])
+                     for _ in range(count)]
+            nations.append(Nation(name, int(self.renown[replica, i]),
+                                  int(self.fate[replica, i]),
+                                  int(self.prosperity[replica, i]),
+                                  int(self.happiness[replica, i]),
+                                  units=units,
+                                  military_unit_cap=int(
+                                      self.military_unit_cap[i]),
+                                  settlements=settlements))
+        return nations
+
+
+def default_nations() -> List[Nation]:
+    # Every nation in 'nations.csv', starting with nothing but a Capital
+    return [Nation(name, 0, 0, 0, 0,
+                   settlements=[Settlement(f"{name} Capital", "Capital")])
+            for name in registry().nations]
+
+
+# A policy decides each turn's actions: policy(state, rng) returns
+# (found, recruit), count arrays shaped like 'state.settlements' and
+# 'state.units' (or None for no action)
+Policy = Callable[[CampaignState, np.random.Generator], tuple]
+
+
+def random_policy(found_prob=0.05, recruit_prob=0.2,
+                  found_kind="Village") -> Policy:
+    # Each nation founds a 'found_kind' settlement with probability
+    # 'found_prob' and tries to recruit one unit of a random kind with
+    # probability 'recruit_prob'
+    kind_index = SETTLEMENT_KINDS.index(found_kind)
+
+    def policy(state: CampaignState, rng: np.random.Generator):
+        shape = (state.num_replicas, state.num_nations)
+        found = np.zeros(state.settlements.shape, dtype=np.int64)
+        found[..., kind_index] = rng.random(shape) < found_prob
+        recruit = np.zeros(state.units.shape, dtype=np.int64)
+        kinds = rng.integers(0, len(UNIT_KINDS), size=shape)
+        np.put_along_axis(recruit, kinds[..., None],
+                          (rng.random(shape) < recruit_prob)[..., None],
+                          axis=-1)
+        return found, recruit
+    return policy
+
+
+def advance_turn(state: CampaignState, table: SettlementTable,
+                 found: np.ndarray = None,
+                 recruit: np.ndarray = None) -> CampaignState:
+    # Advance every replica by one turn in place
+    # Income
+    state.renown += state.settlements @ table.renown_gain
+    state.fate += state.settlements @ table.fate_gain
+
+    # Founding
+    if found is not None:
+        state.settlements += found
+        state.prosperity += found @ table.prosperity_tax
+        state.happiness += found @ table.happiness_tax
+        np.clip(state.prosperity, INDICATOR_MIN, INDICATOR_MAX,
+                out=state.prosperity)
+        np.clip(state.happiness, INDICATOR_MIN, INDICATOR_MAX,
+                out=state.happiness)
+
+    # Recruitment, in UNIT_KINDS order while renown and the cap allow
+    if recruit is not None:
+        room = np.maximum(state.military_unit_cap - state.units.sum(axis=-1),
+                          0)
+        for k, cost in enumerate(unit_cost_array().tolist()):
+            num = np.minimum(np.minimum(recruit[..., k],
+                                        state.renown // cost), room)
+            num = np.maximum(num, 0)
+            state.units[..., k] += num
+            state.renown -= num * cost
+            room -= num
+
+    state.turn += 1
+    return state
+
+
+def run_campaign(state: CampaignState, turns: int, policy: Policy = None,
+                 table: SettlementTable = None, seed=None,
+                 record=True) -> Dict[str, np.ndarray]:
+    # Advance 'state' by 'turns' turns. With 'record', returns the mean over
+    # replicas of every nation's resources, indicators and settlement/unit
+    # totals after each turn, as (turns, nations) arrays
+    if table is None:
+        table = SettlementTable()
+    rng = np.random.default_rng(seed)
+    history = {}
+    if record:
+        for name in ("renown", "fate", "prosperity", "happiness",
+                     "settlements", "units"):
+            history[name] = np.empty((turns, state.num_nations))
+
+    for t in range(turns):
+        found, recruit = (None, None) if policy is None else\
+            policy(state, rng)
+        advance_turn(state, table, found, recruit)
+        if record:
+            history["renown"][t] = state.renown.mean(axis=0)
+            history["fate"][t] = state.fate.mean(axis=0)
+            history["prosperity"][t] = state.prosperity.mean(axis=0)
+            history["happiness"][t] = state.happiness.mean(axis=0)
+            history["settlements"][t] = state.settlements.sum(
+                axis=-1).mean(axis=0)
+            history["units"][t] = state.units.sum(axis=-1).mean(axis=0)
+    return history
@@ -0,0 +1,212 @@
+from typing import List, Tuple
+
+from fatesim.dice import GLOBAL_DICE, DiceSource
+from fatesim.unit import UNIT_KINDS, Unit, UnitGroup
+
+# Compact, immutable unit groups for the combat hot path. Unit definitions
+# are interned as 'UnitSpec's and a group only stores which specs it holds
+# and which of them are bloodied, so battle states share everything else and
+# a "copy" of a group is just a new pair of small tuples
+
+# Kind codes are the bit positions used in modifier kind masks
+KIND_CODES = {kind: code for code, kind in enumerate(UNIT_KINDS)}
+# Modifier vectors hold, for open then structure battles, the bonus against
+# anything ("all") followed by the bonus against each kind in UNIT_KINDS
+NUM_TARGETS = 1 + len(UNIT_KINDS)
+OPEN_OFFSET, STRUCT_OFFSET = 0, NUM_TARGETS
+
+
+def modifier_vector(modifiers) -> Tuple[int, ...]:
+    # Reduce a list of modifiers into a vector of bonuses by target, following
+    # the same applicability rules as 'determine_total_modifier'
+    vector = [0] * (2 * NUM_TARGETS)
+    for mod in modifiers:
+        offset = OPEN_OFFSET if mod.is_open else STRUCT_OFFSET
+        if mod.targets_all:
+            vector[offset] += mod.bonus
+            continue
+        # Targets naming unknown kinds have an empty mask and never apply
+        for code in range(len(UNIT_KINDS)):
+            if mod.kind_mask & (1 << code):
+                vector[offset + 1 + code] += mod.bonus
+    return tuple(vector)
+
+
+class UnitSpec():
+    # Everything needed to rebuild a 'Unit' apart from its bloodied state
+    __slots__ = ("movement", "has_military", "kind", "kind_code",
+                 "bonuses_strs", "name", "affiliation", "cost",
+                 "modifier_vector")
+
+    def __init__(self, unit: Unit) -> None:
+        self.movement = unit.movement
+        self.has_military = unit.has_military
+        self.kind = unit.kind
+        self.kind_code = KIND_CODES[unit.kind]
+        self.bonuses_strs = tuple(unit.bonuses_strs)
+        self.name = unit.name
+        self.affiliation = unit.affiliation
+        self.cost = unit.cost
+        self.modifier_vector = modifier_vector(unit.modifiers)
+
+    def to_unit(self, is_bloodied: bool) -> Unit:
+        return Unit(self.movement, self.has_military, self.kind,
+                    list(self.bonuses_strs), name=self.name,
+                    affiliation=self.affiliation, is_bloodied=is_bloodied)
+
+
+_SPECS = {}
+
+
+def unit_spec(unit: Unit) -> UnitSpec:
+    # Interned spec for a unit's definition. The cost is part of it since
+    # it also depends on UNIT_COSTS, which can change between lookups
+    key = (unit.movement, unit.has_military, unit.kind,
+           tuple(unit.bonuses_strs), unit.name, unit.affiliation, unit.cost)
+    spec = _SPECS.get(key)
+    if spec is None:
+        spec = _SPECS[key] = UnitSpec(unit)
+    return spec
+
+
+class CompactUnitGroup():
+    __slots__ = ("uid", "specs", "bloodied", "kind_codes", "costs",
+                 "_modifier_vector", "_kind_mask")
+
+    def __init__(self, specs: Tuple[UnitSpec, ...],
+                 bloodied: Tuple[bool, ...], uid: str) -> None:
+        self.uid = uid
+        self.specs = specs
+        self.bloodied = bloodied
+        self.kind_codes = tuple(s.kind_code for s in specs)
+        self.costs = tuple(s.cost for s in specs)
+        # Computed on first use
+        self._modifier_vector = None
+        self._kind_mask = None
+
+    @classmethod
+    def from_unit_group(cls, ug: UnitGroup):
+        return cls(tuple(unit_spec(u) for u in ug.units),
+                   tuple(u.is_bloodied for u in ug.units), ug.uid)
+
+    def to_unit_group(self) -> UnitGroup:
+        return UnitGroup([s.to_unit(b) for s, b in zip(self.specs,
+                                                       self.bloodied)],
+                         self.uid)
+
+    def __len__(self) -> int:
+        return len(self.specs)
+
+    @property
+    def modifier_vector(self) -> Tuple[int, ...]:
+        # Group modifiers, equivalent to 'UnitGroup.modifiers'
+        if self._modifier_vector is None:
+            self._modifier_vector = tuple(map(sum, zip(
+                *(s.modifier_vector for s in self.specs)))) \
+                if self.specs else (0,) * (2 * NUM_TARGETS)
+        return self._modifier_vector
+
+    @property
+    def kind_mask(self) -> int:
+        # Bitmask of the unit kinds present in the group
+        if self._kind_mask is None:
+            mask = 0
+            for code in self.kind_codes:
+                mask |= 1 << code
+            self._kind_mask = mask
+        return self._kind_mask
+
+    def combat_dice(self) -> Tuple[int, int]:
+        # (d6, d3) rolled by the group's military units
+        num_d6 = num_d3 = 0
+        for s, b in zip(self.specs, self.bloodied):
+            if s.has_military:
+                if b:
+                    num_d3 += 1
+                else:
+                    num_d6 += 1
+        return num_d6, num_d3
+
+    def total_modifier(self, defending: "CompactUnitGroup",
+                       is_open: bool) -> int:
+        # Equivalent to 'determine_total_modifier(self, defending, is_open)'
+        vector = self.modifier_vector
+        offset = OPEN_OFFSET if is_open else STRUCT_OFFSET
+        total = vector[offset]
+        mask = defending.kind_mask
+        for code in range(len(UNIT_KINDS)):
+            if mask & (1 << code):
+                total += vector[offset + 1 + code]
+        return total
+
+    def renown_value(self) -> int:
+        return sum(c // 2 if b else c
+                   for c, b in zip(self.costs, self.bloodied))
+
+    def allocate_casualties(self, deficit: int) -> "CompactUnitGroup":
+        # New group after losing by 'deficit', following the same rules as
+        # 'fatesim.simulation.allocate_casualties' (units end up sorted by
+        # cost, cheapest first)
+        order = sorted(range(len(self.specs)), key=self.costs.__getitem__)
+        specs = [self.specs[i] for i in order]
+        bloodied = [self.bloodied[i] for i in order]
+
+        # Unit deaths, cheapest first
+        num_deaths = deficit // 6
+        if num_deaths >= len(specs):
+            return CompactUnitGroup((), (), self.uid)
+        del specs[:num_deaths], bloodied[:num_deaths]
+        deficit -= 6 * num_deaths
+
+        # Bloody the cheapest unbloodied units, then remove the most
+        # expensive once everything is bloodied
+        num_bloodied = deficit // 3
+        deficit -= 3 * num_bloodied
+        for i, b in enumerate(bloodied):
+            if num_bloodied <= 0:
+                break
+            if not b:
+                bloodied[i] = True
+                num_bloodied -= 1
+        while num_bloodied > 0 and specs:
+            specs.pop()
+            bloodied.pop()
+            num_bloodied -= 1
+
+        # Bloody / remove another unit if deficit remains
+        if deficit > 0 and specs:
+            if all(bloodied):
+                specs.pop()
+                bloodied.pop()
+            else:
+                bloodied[bloodied.index(False)] = True
+
+        return CompactUnitGroup(tuple(specs), tuple(bloodied), self.uid)
+
+
+def roll_compact_dice(cg: CompactUnitGroup,
+                      dice: DiceSource = None) -> List[int]:
+    return (dice or GLOBAL_DICE).roll(
+        [3 if b else 6 for s, b in zip(cg.specs, cg.bloodied)
+         if s.has_military])
+
+
+def simulate_compact_battle(cg1: CompactUnitGroup, cg2: CompactUnitGroup,
+                            is_open: bool, dice: DiceSource = None):
+    # Compact counterpart of 'simulate_battle' + 'determine_new_units':
+    # returns (new cg1, new cg2, signed deficit), with the victor's group
+    # returned as is
+    if not any(s.has_military for s in cg1.specs) or\
+            not any(s.has_military for s in cg2.specs):
+        print("Both units_1 and units_2 must be non-empty")
+        return None
+
+    total_1 = sum(roll_compact_dice(cg1, dice)) +\
+        cg1.total_modifier(cg2, is_open)
+    total_2 = sum(roll_compact_dice(cg2, dice)) +\
+        cg2.total_modifier(cg1, is_open)
+    deficit = total_1 - total_2
+    new_cg1 = cg1 if deficit > 0 else cg1.allocate_casualties(-deficit)
+    new_cg2 = cg2 if deficit < 0 else cg2.allocate_casualties(deficit)
+
+    return new_cg1, new_cg2, deficit
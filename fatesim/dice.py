@@ -0,0 +1,102 @@
+from typing import List, Sequence
+import random
+
+# Sources of dice rolls for the per-trial engines. A source rolls a whole
+# list of dice at once, given each die's number of faces (6, or 3 for
+# bloodied units):
+#   - GlobalRandomDice (the default) draws from the global 'random' module,
+#     exactly as 'roll_d6'/'roll_d3' do, so 'random.seed' still works
+#   - BufferedDice serves rolls from blocks filled by a NumPy Generator, so
+#     each die costs a list lookup. Block k comes from its own child seed,
+#     which makes any position in the stream replayable in O(1): record
+#     'state()' before a trial and 'BufferedDice.from_state' replays it.
+#     'spawn' gives independent streams for workers of a shared pool
+
+DEFAULT_BLOCK_SIZE = 1 << 16
+
+# A d3 from a d6 roll: 1-3 and 4-6 each map onto 1-3 uniformly
+D3_FROM_D6 = (0, 1, 2, 3, 1, 2, 3)
+
+
+class DiceSource():
+    def roll(self, faces: Sequence[int]) -> List[int]:
+        raise NotImplementedError
+
+
+class GlobalRandomDice(DiceSource):
+    def roll(self, faces: Sequence[int]) -> List[int]:
+        return [random.randint(1, f) for f in faces]
+
+
+GLOBAL_DICE = GlobalRandomDice()
+
+
+class BufferedDice(DiceSource):
+    def __init__(self, seed=None, block_size=DEFAULT_BLOCK_SIZE,
+                 position=0) -> None:
+        import numpy as np
+        # 'seed' may be an int, a SeedSequence (e.g. from 'spawn') or None
+        # for fresh entropy, which is then available as 'entropy'
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.seed_sequence = seed
+        self.block_size = block_size
+        self._block = None
+        self._buffer = []
+        self._offset = 0
+        self.seek(position)
+
+    @property
+    def entropy(self):
+        return self.seed_sequence.entropy
+
+    @property
+    def position(self) -> int:
+        # Number of dice rolled from the start of the stream
+        return self._block * self.block_size + self._offset
+
+    def _fill(self, block: int) -> None:
+        import numpy as np
+        seed = np.random.SeedSequence(
+            self.seed_sequence.entropy,
+            spawn_key=self.seed_sequence.spawn_key + (block,))
+        self._buffer = np.random.default_rng(seed).integers(
+            1, 7, size=self.block_size, dtype=np.int8).tolist()
+        self._block = block
+
+    def seek(self, position: int) -> None:
+        block, self._offset = divmod(position, self.block_size)
+        if block != self._block:
+            self._fill(block)
+
+    def roll(self, faces: Sequence[int]) -> List[int]:
+        end = self._offset + len(faces)
+        if end <= self.block_size:
+            values = self._buffer[self._offset:end]
+            self._offset = end
+        else:
+            values = []
+            for _ in faces:
+                if self._offset == self.block_size:
+                    self._fill(self._block + 1)
+                    self._offset = 0
+                values.append(self._buffer[self._offset])
+                self._offset += 1
+        return [v if f == 6 else D3_FROM_D6[v] for v, f in zip(values, faces)]
+
+    def state(self) -> tuple:
+        # Everything needed to replay the stream from this point
+        return (self.seed_sequence.entropy, self.seed_sequence.spawn_key,
+                self.block_size, self.position)
+
+    @classmethod
+    def from_state(cls, state: tuple):
+        import numpy as np
+        entropy, spawn_key, block_size, position = state
+        return cls(np.random.SeedSequence(entropy, spawn_key=spawn_key),
+                   block_size, position)
+
+    def spawn(self, n: int) -> List["BufferedDice"]:
+        # 'n' independent child streams, e.g. one per worker
+        return [BufferedDice(child, self.block_size)
+                for child in self.seed_sequence.spawn(n)]
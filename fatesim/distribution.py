@@ -0,0 +1,115 @@
+from functools import lru_cache
+from typing import Dict, Tuple
+import numpy as np
+
+from fatesim.batch import casualty_cost_table, count_combat_dice
+from fatesim.simulation import determine_total_modifier
+from fatesim.unit import UnitGroup
+
+D6_PMF = np.full(6, 1 / 6)
+D3_PMF = np.full(3, 1 / 3)
+
+
+def dice_sum_pmf(num_d6: int, num_d3: int) -> np.ndarray:
+    # Probabilities of each total from num_d6 + num_d3 (lowest possible
+    # total) up to 6*num_d6 + 3*num_d3
+    pmf = np.ones(1)
+    for _ in range(num_d6):
+        pmf = np.convolve(pmf, D6_PMF)
+    for _ in range(num_d3):
+        pmf = np.convolve(pmf, D3_PMF)
+    return pmf
+
+
+@lru_cache(maxsize=4096)
+def signed_deficit_pmf(dice_1: Tuple[int, int], dice_2: Tuple[int, int],
+                       modifier_1: int, modifier_2: int) -> Tuple[int, np.ndarray]:
+    # Distribution of (UG1 total - UG2 total) for given (d6, d3) dice counts
+    # and total modifiers, returned as (lowest deficit, probabilities)
+    pmf_1 = dice_sum_pmf(*dice_1)
+    pmf_2 = dice_sum_pmf(*dice_2)
+    probs = np.convolve(pmf_1, pmf_2[::-1])
+    probs.flags.writeable = False  # shared through the cache
+    lowest = (sum(dice_1) + modifier_1) - (6*dice_2[0] + 3*dice_2[1]
+                                           + modifier_2)
+    return lowest, probs
+
+
+def _pmf_dict(values: np.ndarray, probs: np.ndarray) -> Dict[int, float]:
+    pmf = {}
+    for v, p in zip(values.tolist(), probs.tolist()):
+        if p > 0:
+            pmf[v] = pmf.get(v, 0.) + p
+    return dict(sorted(pmf.items()))
+
+
+class BattleDistribution():
+    # Exact probabilities of every outcome of a single battle, the
+    # counterpart of 'BattleResult' and of sampling 'simulate_n_stats'
+    def __init__(self, ug1: UnitGroup, ug2: UnitGroup, is_open: bool,
+                 units_1_modifier: int, units_2_modifier: int,
+                 lowest_deficit: int, probs: np.ndarray) -> None:
+        self.ug1 = ug1
+        self.ug2 = ug2
+        self.is_open = is_open
+        self.units_1_modifier = units_1_modifier
+        self.units_2_modifier = units_2_modifier
+        # UG1 total - UG2 total and its probabilities
+        self.signed_deficits = np.arange(lowest_deficit,
+                                         lowest_deficit + len(probs))
+        self.probs = probs
+
+        self.p_ug1_victory = float(probs[self.signed_deficits > 0].sum())
+        self.p_ug2_victory = float(probs[self.signed_deficits < 0].sum())
+        self.p_draw = float(probs[self.signed_deficits == 0].sum())
+        # Same meaning as 'BattleResult.deficit'
+        self.deficit_pmf = _pmf_dict(np.abs(self.signed_deficits), probs)
+        self.average_roll_deficit = sum(d * p for d, p
+                                        in self.deficit_pmf.items())
+
+        # Renown lost by each side, from the reference casualty rules
+        losses_1 = np.maximum(-self.signed_deficits, 0)
+        losses_2 = np.maximum(self.signed_deficits, 0)
+        ug1_costs = casualty_cost_table(ug1, int(losses_1.max()))[losses_1]
+        ug2_costs = casualty_cost_table(ug2, int(losses_2.max()))[losses_2]
+        self.ug1_cost_pmf = _pmf_dict(ug1_costs, probs)
+        self.ug2_cost_pmf = _pmf_dict(ug2_costs, probs)
+        self.average_ug1_cost = float(ug1_costs @ probs)
+        self.average_ug2_cost = float(ug2_costs @ probs)
+        # Conditional on losing, as in 'SimulationStats'
+        self.average_ug1_loss_cost = (self.average_ug1_cost
+                                      / self.p_ug2_victory
+                                      if self.p_ug2_victory else 0)
+        self.average_ug2_loss_cost = (self.average_ug2_cost
+                                      / self.p_ug1_victory
+                                      if self.p_ug1_victory else 0)
+
+    def generate_summary(self) -> str:
+        summary = f"Exact: {self.ug1.uid} - {self.ug2.uid}\n"
+        summary += f"Win Probability: {self.p_ug1_victory:.4f} - {self.p_ug2_victory:.4f} (draw {self.p_draw:.4f})\n"
+        summary += f"Average Roll Deficit: {self.average_roll_deficit:.4f}\n"
+        summary += f"Average Overall Cost: {self.average_ug1_cost:.2f} - {self.average_ug2_cost:.2f}\n"
+        summary += f"Average Loss Cost: {self.average_ug1_loss_cost:.2f} - {self.average_ug2_loss_cost:.2f}\n"
+
+        return summary
+
+
+def exact_battle_distribution(ug1: UnitGroup, ug2: UnitGroup,
+                              is_open: bool,
+                              extra_modifiers=(0, 0)) -> BattleDistribution:
+    # Exact outcome distribution of 'simulate_battle(ug1, ug2, is_open)'
+    # followed by 'determine_new_units' on both sides
+    dice_1 = count_combat_dice(ug1.units)
+    dice_2 = count_combat_dice(ug2.units)
+    if not sum(dice_1) or not sum(dice_2):
+        print("Both units_1 and units_2 must be non-empty")
+        return None
+
+    modifier_1 = determine_total_modifier(ug1, ug2, is_open) +\
+        extra_modifiers[0]
+    modifier_2 = determine_total_modifier(ug2, ug1, is_open) +\
+        extra_modifiers[1]
+    lowest, probs = signed_deficit_pmf(dice_1, dice_2, modifier_1, modifier_2)
+
+    return BattleDistribution(ug1, ug2, is_open, modifier_1, modifier_2,
+                              lowest, probs)
@@ -0,0 +1,239 @@
+from typing import Dict, Tuple
+import numpy as np
+
+from fatesim.batch import roll_dice_sums
+from fatesim.compact import CompactUnitGroup
+from fatesim.distribution import signed_deficit_pmf
+from fatesim.unit import UnitGroup
+
+# Full engagements: two unit groups keep fighting (each round is one
+# 'simulate_battle' followed by 'determine_new_units' on both sides) until
+# one side has no military units left or 'max_rounds' is reached.
+# A round only leaves the state unchanged on a draw, as the loser always
+# loses or bloodies a unit, so the states form an absorbing Markov chain that
+# is a DAG apart from self-loops. The exact backend solves it over every
+# reachable state; the Monte Carlo backend rolls many engagements at once,
+# grouped by their current state
+
+
+def _state_key(cg: CompactUnitGroup) -> Tuple:
+    # Order-independent; specs are interned so their ids identify them
+    return tuple(sorted(zip(map(id, cg.specs), cg.bloodied)))
+
+
+def _can_fight(cg: CompactUnitGroup) -> bool:
+    return any(s.has_military for s in cg.specs)
+
+
+def _potential(cg: CompactUnitGroup) -> int:
+    # Strictly decreases for the loser of every round that is not a draw
+    return 2 * len(cg) + cg.bloodied.count(False)
+
+
+def _absorbed(cg1: CompactUnitGroup, cg2: CompactUnitGroup) -> np.ndarray:
+    # [P(UG1 wins), P(UG2 wins), P(unresolved), renown 1, renown 2, rounds]
+    # for an engagement that stops in this state
+    values = np.zeros(6)
+    if not _can_fight(cg2):
+        values[0] = 1.
+    elif not _can_fight(cg1):
+        values[1] = 1.
+    else:
+        values[2] = 1.  # out of rounds
+    values[3], values[4] = cg1.renown_value(), cg2.renown_value()
+    return values
+
+
+class EngagementResult():
+    def __init__(self, ug1: UnitGroup, ug2: UnitGroup, is_open: bool,
+                 backend: str, max_rounds: int, p_ug1_victory: float,
+                 p_ug2_victory: float, p_unresolved: float,
+                 expected_ug1_renown_lost: float,
+                 expected_ug2_renown_lost: float, expected_rounds: float,
+                 num_trials=None) -> None:
+        self.ug1 = ug1
+        self.ug2 = ug2
+        self.is_open = is_open
+        self.backend = backend
+        self.max_rounds = max_rounds
+        self.num_trials = num_trials  # Monte Carlo only
+        self.p_ug1_victory = p_ug1_victory
+        self.p_ug2_victory = p_ug2_victory
+        # Still fighting after 'max_rounds'
+        self.p_unresolved = p_unresolved
+        self.expected_ug1_renown_lost = expected_ug1_renown_lost
+        self.expected_ug2_renown_lost = expected_ug2_renown_lost
+        self.expected_rounds = expected_rounds
+
+    def generate_summary(self) -> str:
+        summary = f"Engagement ({self.backend}): {self.ug1.uid} - {self.ug2.uid}\n"
+        summary += f"Win Probability: {self.p_ug1_victory:.4f} - {self.p_ug2_victory:.4f} (unresolved {self.p_unresolved:.4f})\n"
+        summary += f"Expected Renown Lost: {self.expected_ug1_renown_lost:.2f} - {self.expected_ug2_renown_lost:.2f}\n"
+        summary += f"Expected Rounds: {self.expected_rounds:.2f}\n"
+
+        return summary
+
+
+class EngagementChain():
+    # Reachable states of an engagement and the transition probabilities
+    # between them, built from the exact single-battle distributions
+    def __init__(self, ug1: UnitGroup, ug2: UnitGroup, is_open: bool) -> None:
+        self.is_open = is_open
+        start = (CompactUnitGroup.from_unit_group(ug1),
+                 CompactUnitGroup.from_unit_group(ug2))
+        self.start = (_state_key(start[0]), _state_key(start[1]))
+        self.states = {self.start: start}
+        # state -> {next state: probability}, absorbing states have none
+        self.transitions = {}
+        frontier = [self.start]
+        while frontier:
+            key = frontier.pop()
+            if key in self.transitions:
+                continue
+            outcomes = self._outcomes(*self.states[key])
+            self.transitions[key] = outcomes
+            frontier.extend(k for k in outcomes if k not in self.transitions)
+
+    def _outcomes(self, cg1: CompactUnitGroup,
+                  cg2: CompactUnitGroup) -> Dict[Tuple, float]:
+        if not _can_fight(cg1) or not _can_fight(cg2):
+            return {}
+        lowest, probs = signed_deficit_pmf(
+            cg1.combat_dice(), cg2.combat_dice(),
+            cg1.total_modifier(cg2, self.is_open),
+            cg2.total_modifier(cg1, self.is_open))
+        outcomes = {}
+        for i, p in enumerate(probs.tolist()):
+            if p == 0:
+                continue
+            deficit = lowest + i
+            new_cg1 = cg1 if deficit > 0 else cg1.allocate_casualties(-deficit)
+            new_cg2 = cg2 if deficit < 0 else cg2.allocate_casualties(deficit)
+            key = (_state_key(new_cg1), _state_key(new_cg2))
+            self.states.setdefault(key, (new_cg1, new_cg2))
+            outcomes[key] = outcomes.get(key, 0.) + p
+        return outcomes
+
+    def solve(self, max_rounds=None) -> np.ndarray:
+        # Expected '_absorbed' values (with the number of rounds fought) from
+        # the starting state
+        if max_rounds is None:
+            return self._solve_unlimited()
+        return self._solve_limited(max_rounds)
+
+    def _solve_unlimited(self) -> np.ndarray:
+        # States in increasing potential order only move to states already
+        # solved, apart from self-loops (draws) which are divided out
+        order = sorted(self.transitions, key=lambda key: sum(
+            _potential(cg) for cg in self.states[key]))
+        solved = {}
+        for key in order:
+            outcomes = self.transitions[key]
+            if not outcomes:
+                solved[key] = _absorbed(*self.states[key])
+                continue
+            p_self = outcomes.get(key, 0.)
+            values = np.zeros(6)
+            for next_key, p in outcomes.items():
+                if next_key != key:
+                    values += p * solved[next_key]
+            values /= 1 - p_self
+            values[5] += 1 / (1 - p_self)  # expected rounds incl. draws
+            solved[key] = values
+        return solved[self.start]
+
+    def _solve_limited(self, max_rounds: int) -> np.ndarray:
+        # Values with r rounds left, from r = 0 up to 'max_rounds'
+        keys = list(self.transitions)
+        values = {key: _absorbed(*self.states[key]) for key in keys}
+        for _ in range(max_rounds):
+            new_values = {}
+            for key in keys:
+                outcomes = self.transitions[key]
+                if not outcomes:
+                    new_values[key] = values[key]
+                    continue
+                total = np.zeros(6)
+                for next_key, p in outcomes.items():
+                    total += p * values[next_key]
+                total[5] += 1
+                new_values[key] = total
+            values = new_values
+        return values[self.start]
+
+
+def _resolve_exact(ug1: UnitGroup, ug2: UnitGroup, is_open: bool,
+                   max_rounds: int) -> EngagementResult:
+    values = EngagementChain(ug1, ug2, is_open).solve(max_rounds)
+    return EngagementResult(ug1, ug2, is_open, "exact", max_rounds,
+                            values[0], values[1], values[2],
+                            ug1.renown_value() - values[3],
+                            ug2.renown_value() - values[4], values[5])
+
+
+def _resolve_monte_carlo(ug1: UnitGroup, ug2: UnitGroup, is_open: bool,
+                         max_rounds: int, n: int,
+                         seed) -> EngagementResult:
+    rng = np.random.default_rng(seed)
+    start = (CompactUnitGroup.from_unit_group(ug1),
+             CompactUnitGroup.from_unit_group(ug2))
+    # state key -> (groups, number of engagements in that state)
+    active = {(_state_key(start[0]), _state_key(start[1])): (start, n)}
+    # (state key, signed deficit) -> next groups
+    next_states = {}
+    totals = np.zeros(6)
+    rounds = 0
+    while active and (max_rounds is None or rounds < max_rounds):
+        new_active = {}
+        for key, ((cg1, cg2), count) in active.items():
+            if not _can_fight(cg1) or not _can_fight(cg2):
+                totals += count * _absorbed(cg1, cg2)
+                continue
+            totals[5] += count  # one more round for each engagement
+            deficits = roll_dice_sums(rng, count, *cg1.combat_dice()) -\
+                roll_dice_sums(rng, count, *cg2.combat_dice()) +\
+                cg1.total_modifier(cg2, is_open) -\
+                cg2.total_modifier(cg1, is_open)
+            values, counts = np.unique(deficits, return_counts=True)
+            for deficit, c in zip(values.tolist(), counts.tolist()):
+                groups = next_states.get((key, deficit))
+                if groups is None:
+                    groups = next_states[(key, deficit)] = (
+                        cg1 if deficit > 0 else
+                        cg1.allocate_casualties(-deficit),
+                        cg2 if deficit < 0 else
+                        cg2.allocate_casualties(deficit))
+                next_key = (_state_key(groups[0]), _state_key(groups[1]))
+                _, previous = new_active.get(next_key, (None, 0))
+                new_active[next_key] = (groups, previous + c)
+        active = new_active
+        rounds += 1
+
+    # Engagements still going after 'max_rounds'
+    for (cg1, cg2), count in active.values():
+        totals += count * _absorbed(cg1, cg2)
+
+    totals /= n
+    return EngagementResult(ug1, ug2, is_open, "monte_carlo", max_rounds,
+                            totals[0], totals[1], totals[2],
+                            ug1.renown_value() - totals[3],
+                            ug2.renown_value() - totals[4], totals[5],
+                            num_trials=n)
+
+
+def resolve_engagement(ug1: UnitGroup, ug2: UnitGroup, is_open: bool,
+                       max_rounds=None, backend="exact", n=10000,
+                       seed=None) -> EngagementResult:
+    # Fight rounds until a side is wiped out ('max_rounds=None' means no
+    # limit). backend="exact" solves the Markov chain over every reachable
+    # state, backend="monte_carlo" simulates 'n' engagements and suits
+    # armies too large to enumerate
+    if not any(u.has_military for u in ug1.units) or\
+            not any(u.has_military for u in ug2.units):
+        print("Both units_1 and units_2 must be non-empty")
+        return None
+    if backend == "exact":
+        return _resolve_exact(ug1, ug2, is_open, max_rounds)
+    if backend == "monte_carlo":
+        return _resolve_monte_carlo(ug1, ug2, is_open, max_rounds, n, seed)
+    raise ValueError(f"Unknown engagement backend '{backend}'")
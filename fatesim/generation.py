@@ -1,11 +1,270 @@
+from typing import Dict, List, Sequence
+import random
+import numpy as np
+
+from fatesim.batch import casualty_cost_table, roll_dice_sums
+from fatesim.modifier import UNIT_KINDS, kind_mask
+from fatesim.resources import registry
 from fatesim.structure import Structure
-from fatesim.settlement import Settlement
-from fatesim.unit import Unit
+from fatesim.unit import (UNIT_TEMPLATES, Unit, UnitGroup,
+                          unit_group_from_templates)
+
+# Random unit groups and structures, one object at a time ('random_unit',
+# 'random_structure') or in bulk as compact arrays. Bulk groups are rows of
+# template indices padded with -1, so millions of them fit in a few MB and go
+# straight into 'paired_battles' without building any Unit objects; use
+# 'to_unit_groups' for the object form. Everything bulk is seeded through a
+# NumPy Generator so the same seed gives the same groups
+
+EMPTY = -1  # padding in template index rows
+
+DEFENSIVE_TARGET = "all struct"
+
+
+def random_unit(has_military: bool, rng: random.Random = random) -> Unit:
+    # A random template unit, or for non-military (diplomatic) units a plain
+    # unit of a random kind
+    if has_military:
+        return UNIT_TEMPLATES[rng.choice(sorted(UNIT_TEMPLATES))]()
+    kind = rng.choice(UNIT_KINDS)
+    return Unit(registry().units[kind]["BaseMovement"], False, kind, [],
+                name=f"Diplomatic {kind.capitalize()}")
+
+
+def random_structure(rng: random.Random = random,
+                     defensive_prob=0.5, in_settlement_prob=0.8,
+                     max_bonus=3) -> Structure:
+    # Defensive structures help in structure battles; production ones
+    # boost one kind of unit built there in open battles
+    is_defensive = rng.random() < defensive_prob
+    bonus = rng.randint(1, max_bonus)
+    if is_defensive:
+        bonus_str = f"+{bonus} {DEFENSIVE_TARGET}"
+        desc = "Defensive Structure"
+    else:
+        bonus_str = f"+{bonus} {rng.choice(UNIT_KINDS)} open"
+        desc = "Production Structure"
+    return Structure(rng.random() < in_settlement_prob, is_defensive,
+                     desc=desc, bonus_str=bonus_str)
+
+
+class GeneratedGroups():
+    # 'templates' is an (n, max_size) int array of indices into
+    # 'template_names', each row padded with EMPTY after its units
+    def __init__(self, templates: np.ndarray,
+                 template_names: List[str]) -> None:
+        self.templates = templates
+        self.template_names = template_names
+
+    def __len__(self) -> int:
+        return len(self.templates)
+
+    @property
+    def sizes(self) -> np.ndarray:
+        return (self.templates != EMPTY).sum(axis=1)
+
+    def names(self, i: int) -> List[str]:
+        return [self.template_names[t] for t in self.templates[i].tolist()
+                if t != EMPTY]
+
+    def to_unit_groups(self, indices=None) -> List[UnitGroup]:
+        # New UnitGroups (uids like "BI_BS") for all or some rows
+        if indices is None:
+            indices = range(len(self))
+        return [unit_group_from_templates(self.names(i)) for i in indices]
+
+    def unique(self):
+        # (distinct compositions, index of each row's composition); rows
+        # listing the same templates in another order count as one
+        canonical = np.sort(self.templates, axis=1)[:, ::-1]
+        # One integer per row (base len(template_names) + 1 digits) is much
+        # faster to deduplicate than the rows themselves
+        base = len(self.template_names) + 1
+        keys = (canonical.astype(np.int64) + 1) @\
+            base ** np.arange(canonical.shape[1], dtype=np.int64)
+        _, first, inverse = np.unique(keys, return_index=True,
+                                      return_inverse=True)
+        return GeneratedGroups(canonical[first], self.template_names),\
+            inverse.reshape(-1)
+
+
+def _size_probs(size_probs, max_size: int, cap: int) -> np.ndarray:
+    # Probabilities of sizes 1..max_size, renormalized over sizes allowed by
+    # the cap
+    if size_probs is None:
+        probs = np.ones(max_size)
+    elif isinstance(size_probs, dict):
+        probs = np.array([size_probs.get(s, 0.) for s in
+                          range(1, max_size + 1)], dtype=float)
+    else:
+        probs = np.array(size_probs, dtype=float)
+    if cap is not None:
+        probs[cap:] = 0.
+    if probs.sum() <= 0:
+        raise ValueError("No group size is allowed")
+    return probs / probs.sum()
+
+
+def generate_groups(n: int, seed=None, templates: Sequence[str] = None,
+                    weights=None, size_probs=None, max_size=3,
+                    military_cap=None, diplomatic_cap=None,
+                    max_attempts=100) -> GeneratedGroups:
+    # 'n' random groups of 1 to 'max_size' templates. 'weights' (one per
+    # template, or a {name: weight} dict) set how often each template is
+    # drawn for a slot and 'size_probs' (for sizes 1..max_size, or a
+    # {size: prob} dict) how many units a group has, uniform by default.
+    # 'military_cap'/'diplomatic_cap' bound the military and non-military
+    # units in a group, as on 'Nation'; groups breaking them are redrawn
+    names = sorted(UNIT_TEMPLATES if templates is None else templates)
+    if isinstance(weights, dict):
+        weights = [weights.get(name, 0.) for name in names]
+    weights = np.ones(len(names)) if weights is None else\
+        np.array(weights, dtype=float)
+    weights = weights / weights.sum()
+    is_military = np.array([UNIT_TEMPLATES[name]().has_military
+                            for name in names])
+    rng = np.random.default_rng(seed)
+
+    # With only one kind of template a cap is just a size limit
+    size_cap = military_cap if is_military.all() else\
+        diplomatic_cap if not is_military.any() else None
+    sizes_p = _size_probs(size_probs, max_size, size_cap)
+
+    def draw(count: int) -> np.ndarray:
+        sizes = rng.choice(np.arange(1, max_size + 1), size=count, p=sizes_p)
+        rows = rng.choice(len(names), size=(count, max_size), p=weights)
+        rows[np.arange(max_size) >= sizes[:, None]] = EMPTY
+        return rows.astype(np.int16)
+
+    rows = draw(n)
+    for _ in range(max_attempts):
+        filled = rows != EMPTY
+        military = (filled & is_military[rows]).sum(axis=1)
+        diplomatic = filled.sum(axis=1) - military
+        bad = np.zeros(n, dtype=bool)
+        if military_cap is not None:
+            bad |= military > military_cap
+        if diplomatic_cap is not None:
+            bad |= diplomatic > diplomatic_cap
+        if not bad.any():
+            return GeneratedGroups(rows, names)
+        rows[bad] = draw(int(bad.sum()))
+    raise ValueError("Could not draw groups within the caps")
+
+
+class GeneratedStructures():
+    # Columns of 'n' structures; 'target_kinds' indexes UNIT_KINDS, EMPTY
+    # for defensive ("all struct") structures
+    def __init__(self, in_settlement: np.ndarray, is_defensive: np.ndarray,
+                 bonuses: np.ndarray, target_kinds: np.ndarray) -> None:
+        self.in_settlement = in_settlement
+        self.is_defensive = is_defensive
+        self.bonuses = bonuses
+        self.target_kinds = target_kinds
+
+    def __len__(self) -> int:
+        return len(self.bonuses)
+
+    def bonus_str(self, i: int) -> str:
+        target = DEFENSIVE_TARGET if self.is_defensive[i] else\
+            f"{UNIT_KINDS[self.target_kinds[i]]} open"
+        return f"+{self.bonuses[i]} {target}"
+
+    def to_structures(self, indices=None) -> List[Structure]:
+        if indices is None:
+            indices = range(len(self))
+        return [Structure(bool(self.in_settlement[i]),
+                          bool(self.is_defensive[i]),
+                          desc="Defensive Structure" if self.is_defensive[i]
+                          else "Production Structure",
+                          bonus_str=self.bonus_str(i)) for i in indices]
+
+
+def generate_structures(n: int, seed=None, defensive_prob=0.5,
+                        in_settlement_prob=0.8,
+                        max_bonus=3) -> GeneratedStructures:
+    # Bulk 'random_structure'
+    rng = np.random.default_rng(seed)
+    is_defensive = rng.random(n) < defensive_prob
+    target_kinds = rng.integers(0, len(UNIT_KINDS), size=n, dtype=np.int8)
+    target_kinds[is_defensive] = EMPTY
+    return GeneratedStructures(rng.random(n) < in_settlement_prob,
+                               is_defensive,
+                               rng.integers(1, max_bonus + 1, size=n,
+                                            dtype=np.int8),
+                               target_kinds)
+
+
+class _TemplateTable():
+    # Per-template arrays for simulating template index rows: whether the
+    # unit fights, its kind bit and its modifier against every opposing
+    # kind mask, per battle type
+    def __init__(self, template_names: List[str]) -> None:
+        units = [UNIT_TEMPLATES[name]() for name in template_names]
+        num_masks = 1 << len(UNIT_KINDS)
+        # Extra last row for EMPTY, which indexes as -1
+        self.is_military = np.array([u.has_military for u in units] + [False])
+        self.kind_bits = np.array([kind_mask([u.kind]) for u in units] + [0])
+        self.modifiers = {
+            is_open: np.array([[UnitGroup([u], "").total_modifier(mask,
+                                                                   is_open)
+                                for mask in range(num_masks)]
+                               for u in units] + [[0] * num_masks])
+            for is_open in (True, False)}
+
+    def dice(self, rows: np.ndarray) -> np.ndarray:
+        return self.is_military[rows].sum(axis=1)
+
+    def kind_masks(self, rows: np.ndarray) -> np.ndarray:
+        return np.bitwise_or.reduce(self.kind_bits[rows], axis=1)
+
+    def total_modifiers(self, rows: np.ndarray, opposing_masks: np.ndarray,
+                        is_open: bool) -> np.ndarray:
+        return self.modifiers[is_open][rows, opposing_masks[:, None]].sum(
+            axis=1)
+
+
+def _cost_lookup(groups: GeneratedGroups, losses: np.ndarray) -> np.ndarray:
+    # Renown each group loses at its deficit, from one casualty table per
+    # distinct composition
+    distinct, inverse = groups.unique()
+    max_loss = int(losses.max()) if len(losses) else 0
+    tables = np.array([casualty_cost_table(ug, max_loss)
+                       for ug in distinct.to_unit_groups()])
+    return tables[inverse, losses]
 
 
-def random_unit(has_military: bool) -> Unit:
-    pass
+def paired_battles(groups_1: GeneratedGroups, groups_2: GeneratedGroups,
+                   is_open: bool, seed=None) -> Dict[str, np.ndarray]:
+    # One battle between row i of 'groups_1' and row i of 'groups_2' for
+    # every i, as 'simulate_battle' + 'determine_new_units' would fight it
+    # (all units start unbloodied). Returns the signed deficits (UG1 - UG2)
+    # and the renown each side lost. Rows where a side has no military units
+    # do not fight and get deficit 0
+    if groups_1.template_names != groups_2.template_names or\
+            len(groups_1) != len(groups_2):
+        raise ValueError("Groups must be the same length and use the same "
+                         "templates")
+    rng = np.random.default_rng(seed)
+    table = _TemplateTable(groups_1.template_names)
+    rows_1, rows_2 = groups_1.templates, groups_2.templates
+    dice_1, dice_2 = table.dice(rows_1), table.dice(rows_2)
+    modifiers_1 = table.total_modifiers(rows_1, table.kind_masks(rows_2),
+                                        is_open)
+    modifiers_2 = table.total_modifiers(rows_2, table.kind_masks(rows_1),
+                                        is_open)
 
+    # Rows with the same number of d6 are rolled together
+    totals_1 = np.zeros(len(groups_1), dtype=np.int64)
+    totals_2 = np.zeros(len(groups_2), dtype=np.int64)
+    for totals, dice in ((totals_1, dice_1), (totals_2, dice_2)):
+        for num_d6 in np.unique(dice).tolist():
+            rows = dice == num_d6
+            totals[rows] = roll_dice_sums(rng, int(rows.sum()), num_d6, 0)
+    fights = (dice_1 > 0) & (dice_2 > 0)
+    signed = np.where(fights, totals_1 + modifiers_1 - totals_2 - modifiers_2,
+                      0)
 
-def random_structure() -> Structure:
-    pass
+    return {"signed_deficits": signed,
+            "ug1_costs": _cost_lookup(groups_1, np.maximum(-signed, 0)),
+            "ug2_costs": _cost_lookup(groups_2, np.maximum(signed, 0))}
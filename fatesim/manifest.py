@@ -0,0 +1,209 @@
+from pathlib import Path
+from typing import Dict, List, Tuple
+import argparse
+import json
+import os
+
+from fatesim.cache import CACHE_VERSION, _digest, unit_fingerprint
+from fatesim.stats import SimulationStats, StatsAccumulator
+from fatesim.sweep import (BATTLE_TYPES, _run_tasks, pair_seed,
+                           sweep_tasks, template_compositions)
+from fatesim.unit import UNIT_TEMPLATES, unit_group_from_templates
+
+# Incremental template sweeps. A sweep store is a directory holding the
+# accumulator totals of every task of a template sweep (results.npz) and a
+# manifest (manifest.json) recording the sweep's parameters, the definition
+# of every template it used (kind, modifier strings, cost and a fingerprint)
+# and the templates each matchup depends on. 'update_sweep' diffs the
+# current UNIT_TEMPLATES/UNIT_COSTS against the manifest and only reruns
+# matchups that use a changed template; everything else is read back. Task
+# seeds are derived from each matchup itself ('pair_seed') rather than its
+# position in the sweep, so adding or removing templates never reseeds the
+# other matchups and an updated store matches a fresh one exactly. Usage:
+#   python -m fatesim.manifest sweeps/templates --trials 10000
+
+MANIFEST_VERSION = 2
+MANIFEST_FILE = "manifest.json"
+RESULTS_FILE = "results.npz"
+
+
+def template_definition(name: str) -> Dict:
+    # What a template contributes to a battle; 'cost' picks up UNIT_COSTS
+    unit = UNIT_TEMPLATES[name]()
+    return {"kind": unit.kind, "bonuses": list(unit.bonuses_strs),
+            "cost": unit.cost,
+            "fingerprint": _digest((CACHE_VERSION, unit_fingerprint(unit)))}
+
+
+def changed_templates(manifest: Dict, templates) -> Dict[str, str]:
+    # Template name -> why its stored results are stale
+    stored = manifest.get("templates", {})
+    changes = {}
+    for name in templates:
+        old = stored.get(name)
+        if old is None:
+            changes[name] = "new"
+            continue
+        new = template_definition(name)
+        if new["fingerprint"] == old["fingerprint"]:
+            continue
+        diffs = [f"{field} {old[field]} -> {new[field]}"
+                 for field in ("kind", "bonuses", "cost")
+                 if old[field] != new[field]]
+        changes[name] = ", ".join(diffs) or "definition"
+    return changes
+
+
+# Stacked accumulator storage: one row of totals per task, with the deficit
+# histograms concatenated and split by offsets
+_SCALARS = [name for name in vars(StatsAccumulator())
+            if name != "deficit_counts"]
+
+
+def _save_accumulators(path: Path, accumulators: List[StatsAccumulator]) -> None:
+    import numpy as np
+    scalars = np.array([[getattr(acc, name) for name in _SCALARS]
+                        for acc in accumulators],
+                       dtype=np.int64).reshape(-1, len(_SCALARS))
+    sizes = [len(acc.deficit_counts) for acc in accumulators]
+    offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+    values = [v for acc in accumulators for v in acc.deficit_counts.keys()]
+    counts = [c for acc in accumulators for c in acc.deficit_counts.values()]
+    # Write then rename so an interrupted update keeps the old results
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp.npz")
+    np.savez(tmp_path, scalars=scalars, scalar_names=np.array(_SCALARS),
+             offsets=offsets, deficit_values=np.array(values, dtype=np.int64),
+             deficit_counts=np.array(counts, dtype=np.int64))
+    os.replace(tmp_path, path)
+
+
+def _load_accumulators(path: Path) -> List[StatsAccumulator]:
+    import numpy as np
+    with np.load(path) as npz:
+        names = npz["scalar_names"].tolist()
+        scalars = npz["scalars"].tolist()
+        offsets = npz["offsets"].tolist()
+        values = npz["deficit_values"].tolist()
+        counts = npz["deficit_counts"].tolist()
+    accumulators = []
+    for i, row in enumerate(scalars):
+        acc = StatsAccumulator()
+        for name, value in zip(names, row):
+            setattr(acc, name, value)
+        start, end = offsets[i], offsets[i + 1]
+        acc.deficit_counts = dict(zip(values[start:end], counts[start:end]))
+        accumulators.append(acc)
+    return accumulators
+
+
+def load_manifest(directory) -> Dict:
+    path = Path(directory) / MANIFEST_FILE
+    if not path.exists():
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _task_key(names_1, names_2, is_open: bool) -> Tuple:
+    return (tuple(names_1), tuple(names_2), is_open)
+
+
+def update_sweep(directory, num_trials=100, seed=0, max_size=3,
+                 templates=None, battle_types=BATTLE_TYPES, num_workers=None,
+                 chunksize=1) -> Tuple[List[SimulationStats], Dict]:
+    # Bring the sweep store in 'directory' up to date with the current
+    # template definitions, simulating only stale matchups. Returns the
+    # stats of every task (in 'run_sweep' task order) and a report of what
+    # changed. Changing the sweep parameters reruns everything
+    directory = Path(directory)
+    names = sorted(UNIT_TEMPLATES if templates is None else templates)
+    compositions = template_compositions(max_size, names)
+    pairs = [(c1, c2) for c1 in compositions for c2 in compositions]
+    params = {"num_trials": num_trials, "seed": seed, "max_size": max_size,
+              "battle_types": list(battle_types)}
+
+    manifest = load_manifest(directory)
+    stored = {}
+    if manifest is not None and\
+            manifest.get("version") == MANIFEST_VERSION and\
+            manifest.get("params") == params and\
+            (directory / RESULTS_FILE).exists():
+        changes = changed_templates(manifest, names)
+        accumulators = _load_accumulators(directory / RESULTS_FILE)
+        for task, acc in zip(manifest["tasks"], accumulators):
+            if not set(task["depends"]) & set(changes):
+                stored[_task_key(task["ug1"], task["ug2"],
+                                 task["is_open"])] = acc
+    else:
+        changes = {name: "new" for name in names}
+
+    groups = {c: unit_group_from_templates(c) for c in compositions}
+    tasks = sweep_tasks([(groups[c1], groups[c2]) for c1, c2 in pairs],
+                        num_trials, seed, battle_types)
+    task_pairs = [pair for pair in pairs for _ in battle_types]
+    stats = [None] * len(tasks)
+    pending = []
+    for task, (c1, c2) in zip(tasks, task_pairs):
+        task.seed = pair_seed(seed, c1, c2, task.is_open)
+        acc = stored.get(_task_key(c1, c2, task.is_open))
+        if acc is None:
+            pending.append(task)
+            continue
+        sim_stats = SimulationStats.blank()
+        sim_stats.ug1, sim_stats.ug2 = task.ug1, task.ug2
+        sim_stats.accumulator = acc
+        stats[task.index] = sim_stats
+    for index, _, sim_stats in _run_tasks(pending, num_workers, False,
+                                          chunksize):
+        stats[index] = sim_stats
+
+    directory.mkdir(parents=True, exist_ok=True)
+    _save_accumulators(directory / RESULTS_FILE,
+                       [s.accumulator for s in stats])
+    manifest = {
+        "version": MANIFEST_VERSION, "params": params,
+        "templates": {name: template_definition(name) for name in names},
+        "tasks": [{"ug1": list(c1), "ug2": list(c2), "is_open": task.is_open,
+                   "depends": sorted(set(c1) | set(c2))}
+                  for task, (c1, c2) in zip(tasks, task_pairs)],
+    }
+    tmp_path = directory / f"{MANIFEST_FILE}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, directory / MANIFEST_FILE)
+
+    report = {"changed_templates": changes, "recomputed": len(pending),
+              "reused": len(tasks) - len(pending), "total": len(tasks)}
+    return stats, report
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Update a template sweep, rerunning only matchups whose "
+                    "templates changed")
+    parser.add_argument("directory", help="sweep store directory")
+    parser.add_argument("--trials", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--max-size", type=int, default=3)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--export",
+                        help="also write all results with 'write_results' "
+                             "(.parquet, .arrow or .npz)")
+    args = parser.parse_args()
+
+    stats, report = update_sweep(args.directory, args.trials, args.seed,
+                                 args.max_size, num_workers=args.workers)
+    for name, change in sorted(report["changed_templates"].items()):
+        print(f"{name}: {change}")
+    print(f"Recomputed {report['recomputed']} of {report['total']} tasks, "
+          f"reused {report['reused']}")
+    if args.export:
+        from fatesim.results import write_results
+        num_types = len(BATTLE_TYPES)
+        write_results(args.export, stats,
+                      is_open=(BATTLE_TYPES[i % num_types]
+                               for i in range(len(stats))))
+
+
+if __name__ == "__main__":
+    main()
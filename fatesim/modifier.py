@@ -1,7 +1,34 @@
-from copy import deepcopy
-from typing import List
+from functools import lru_cache
+from typing import List, Tuple
 from fatesim.utils import parse_bonus_str
 
+# Kept here rather than in 'fatesim.unit' so targets can be parsed without
+# a circular import
+UNIT_KINDS = ["infantry", "cavalry", "naval", "siege"]
+# Bit of each kind in a kind mask
+KIND_BITS = {kind: 1 << i for i, kind in enumerate(UNIT_KINDS)}
+ALL_KINDS_MASK = (1 << len(UNIT_KINDS)) - 1
+
+
+def kind_mask(kinds) -> int:
+    # Bitmask of a collection of unit kinds
+    mask = 0
+    for kind in kinds:
+        mask |= KIND_BITS.get(kind, 0)
+    return mask
+
+
+@lru_cache(maxsize=None)
+def parse_target(target: str) -> Tuple[bool, bool, int]:
+    # (is open, targets all, kind mask) of a modifier target, e.g.
+    # "siege open" -> (True, False, KIND_BITS["siege"]). Only the first word
+    # names the affected kind; any target not ending in "open" applies to
+    # structure battles
+    is_open = target.endswith("open")
+    if target.startswith("all"):
+        return is_open, True, ALL_KINDS_MASK
+    return is_open, False, KIND_BITS.get(target.split(" ")[0], 0)
+
 
 class Modifier():
     def __init__(self, bonus: int, target: str) -> None:
@@ -9,6 +36,21 @@ class Modifier():
         # always two words, first describes unit, second describes kind (open, structure)
         self.target = target
 
+    @property
+    def target(self) -> str:
+        return self._target
+
+    @target.setter
+    def target(self, value: str):
+        # Parsed once here so battles never need to look at the string
+        self._target = value
+        self.is_open, self.targets_all, self.kind_mask = parse_target(value)
+
+    def applies_to(self, kind_mask: int, is_open: bool) -> bool:
+        # Whether this modifier counts against units with kinds in 'kind_mask'
+        return self.is_open == is_open and\
+            (self.targets_all or bool(self.kind_mask & kind_mask))
+
     @classmethod
     def from_bonus_str(cls, bonus_str: str):
         bonus, target = parse_bonus_str(bonus_str)
@@ -27,8 +69,7 @@ def combine_modifiers(modifiers_: List[Modifier]) -> List[Modifier]:
     if not modifiers_:
         return []
     new_modifiers = []
-    modifiers = deepcopy(modifiers_)
-    for mod in modifiers:
+    for mod in modifiers_:
         found = False
         for nmod in new_modifiers:
             if mod.target == nmod.target:
@@ -36,5 +77,6 @@ def combine_modifiers(modifiers_: List[Modifier]) -> List[Modifier]:
                 found = True
                 break
         if not found:
-            new_modifiers.append(mod)
+            # Copy so summing does not change the input modifiers
+            new_modifiers.append(Modifier(mod.bonus, mod.target))
     return new_modifiers
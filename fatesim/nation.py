@@ -35,4 +35,4 @@ class Nation:
 
     @happiness.setter
     def happiness(self, value: int):
-        self._prosperity = clamp(value, -3, 3)
+        self._happiness = clamp(value, -3, 3)
@@ -0,0 +1,161 @@
+from typing import List, Tuple
+import numpy as np
+
+from fatesim.batch import casualty_cost_table, count_combat_dice
+from fatesim.distribution import signed_deficit_pmf
+from fatesim.modifier import kind_mask
+from fatesim.unit import UNIT_TEMPLATES, UnitGroup, template_abbreviation
+
+# Search for the template compositions that do best against one opponent
+# per renown spent. Compositions are scored with exact battle distributions
+# and grown one template at a time (in sorted template order, so each
+# composition is seen once, ignoring order) from their sub-compositions,
+# which carry the dice, modifier and kind totals along. Compositions that
+# fight identically (same dice, modifiers, kinds and casualty costs) share
+# one evaluation, and branches over budget are cut before being expanded
+
+
+class CompositionScore():
+    def __init__(self, templates: Tuple[str, ...], price: int,
+                 p_victory: float, p_draw: float,
+                 expected_loss_cost: float,
+                 expected_opponent_loss_cost: float) -> None:
+        self.templates = templates
+        self.uid = "_".join(template_abbreviation(t) for t in templates)
+        self.price = price  # total 'Unit.cost'
+        self.p_victory = p_victory
+        self.p_draw = p_draw
+        # Renown lost per battle, on average over all outcomes
+        self.expected_loss_cost = expected_loss_cost
+        self.expected_opponent_loss_cost = expected_opponent_loss_cost
+
+    def __str__(self) -> str:
+        return (f"{self.uid} ({self.price} Renown): win {self.p_victory:.4f},"
+                f" loss cost {self.expected_loss_cost:.2f}")
+
+    def dominates(self, other: "CompositionScore") -> bool:
+        # At least as good in win probability, loss cost and price, and
+        # better in one of them
+        at_least = self.p_victory >= other.p_victory and\
+            self.expected_loss_cost <= other.expected_loss_cost and\
+            self.price <= other.price
+        better = self.p_victory > other.p_victory or\
+            self.expected_loss_cost < other.expected_loss_cost or\
+            self.price < other.price
+        return at_least and better
+
+
+def pareto_front(scores: List[CompositionScore]) -> List[CompositionScore]:
+    # Non-dominated scores, by descending win probability. Sorting first
+    # means a score can only be dominated by one kept before it
+    ordered = sorted(scores, key=lambda s: (-s.p_victory,
+                                            s.expected_loss_cost, s.price))
+    front = []
+    for score in ordered:
+        if not any(kept.dominates(score) for kept in front):
+            front.append(score)
+    return front
+
+
+class _Partial():
+    # Running totals of a (sub-)composition against the opponent
+    __slots__ = ("templates", "units", "price", "modifier", "kind_mask")
+
+    def __init__(self, templates, units, price, modifier, mask) -> None:
+        self.templates = templates
+        self.units = units
+        self.price = price
+        self.modifier = modifier  # own total modifier against the opponent
+        self.kind_mask = mask
+
+
+class CompositionOptimizer():
+    def __init__(self, opponent: UnitGroup, is_open: bool,
+                 templates=None) -> None:
+        self.opponent = opponent
+        self.is_open = is_open
+        names = sorted(UNIT_TEMPLATES if templates is None else templates)
+        # One unit per template; units are only read, never changed
+        self.units = {name: UNIT_TEMPLATES[name]() for name in names}
+        opponent_mask = opponent.kind_mask
+        # Group modifiers add up over units, so each template's share of
+        # the total modifier against the opponent is worked out once
+        self.modifiers = {name: UnitGroup([unit], name).total_modifier(
+            opponent_mask, is_open) for name, unit in self.units.items()}
+        self.opponent_dice = count_combat_dice(opponent.units)
+        self._opponent_modifiers = {}
+        # Evaluation key -> (p_victory, p_draw, loss cost, opponent loss)
+        self._evaluations = {}
+
+    def _opponent_modifier(self, mask: int) -> int:
+        modifier = self._opponent_modifiers.get(mask)
+        if modifier is None:
+            modifier = self._opponent_modifiers[mask] =\
+                self.opponent.total_modifier(mask, self.is_open)
+        return modifier
+
+    def _evaluate(self, partial: _Partial) -> Tuple[float, float, float,
+                                                     float]:
+        dice = count_combat_dice(partial.units)
+        if not sum(dice) or not sum(self.opponent_dice):
+            return None  # no battle
+        costs = tuple(sorted(u.cost for u in partial.units))
+        opponent_modifier = self._opponent_modifier(partial.kind_mask)
+        key = (dice, partial.modifier, opponent_modifier, costs)
+        evaluation = self._evaluations.get(key)
+        if evaluation is not None:
+            return evaluation
+
+        lowest, probs = signed_deficit_pmf(dice, self.opponent_dice,
+                                           partial.modifier,
+                                           opponent_modifier)
+        deficits = np.arange(lowest, lowest + len(probs))
+        losses = np.maximum(-deficits, 0)
+        opponent_losses = np.maximum(deficits, 0)
+        own_costs = casualty_cost_table(UnitGroup(list(partial.units), ""),
+                                        int(losses.max()))[losses]
+        opponent_costs = casualty_cost_table(
+            self.opponent, int(opponent_losses.max()))[opponent_losses]
+        evaluation = self._evaluations[key] = (
+            float(probs[deficits > 0].sum()), float(probs[deficits == 0].sum()),
+            float(own_costs @ probs), float(opponent_costs @ probs))
+        return evaluation
+
+    def scores(self, budget: int, max_size=3) -> List[CompositionScore]:
+        # Every composition of 1 to 'max_size' templates costing at most
+        # 'budget' renown
+        names = list(self.units)
+        # Extensions only add cost when no template is free or refunds
+        # renown, so over-budget branches can be cut
+        can_prune = all(u.cost > 0 for u in self.units.values())
+        scores = []
+        stack = [(_Partial((), (), 0, 0, 0), 0)]
+        while stack:
+            partial, start = stack.pop()
+            if partial.templates and partial.price <= budget:
+                evaluation = self._evaluate(partial)
+                if evaluation is not None:
+                    scores.append(CompositionScore(partial.templates,
+                                                   partial.price,
+                                                   *evaluation))
+            if len(partial.templates) == max_size:
+                continue
+            for i in range(start, len(names)):
+                name = names[i]
+                unit = self.units[name]
+                price = partial.price + unit.cost
+                if can_prune and price > budget:
+                    continue
+                stack.append((_Partial(
+                    partial.templates + (name,), partial.units + (unit,),
+                    price, partial.modifier + self.modifiers[name],
+                    partial.kind_mask | kind_mask([unit.kind])), i))
+        return scores
+
+
+def optimize_composition(opponent: UnitGroup, is_open: bool, budget: int,
+                         max_size=3, templates=None) -> List[CompositionScore]:
+    # Pareto front (win probability up, expected loss cost and price down)
+    # of UNIT_TEMPLATES compositions against 'opponent' within 'budget'
+    optimizer = CompositionOptimizer(opponent, is_open, templates)
+    return pareto_front(optimizer.scores(budget, max_size))
@@ -0,0 +1,150 @@
+from contextlib import contextmanager
+from functools import wraps
+from typing import Dict
+import json
+import os
+import threading
+import time
+
+# Opt-in instrumentation for the simulation pipeline. Hot functions are
+# wrapped with '@profiled(stage)' and hot loops call 'count' behind an
+# 'if profiling.ENABLED' check, so with profiling off the only cost is one
+# flag test per call. Usage:
+#   with profiling.profile() as profiler:
+#       simulate_n_stats(ug1, ug2, True, n=1000)
+#   print(profiler.summary_table())
+#   profiler.write_chrome_trace("trace.json")
+
+ENABLED = False
+
+
+class Profiler():
+    # Per-stage timers (calls, inclusive time), named counters and, up to
+    # 'max_events', individual stage events for a Chrome trace
+    def __init__(self, max_events=100000) -> None:
+        self.max_events = max_events
+        self.reset()
+
+    def reset(self) -> None:
+        self.timers = {}
+        self.counters = {}
+        self.events = []
+        self.dropped_events = 0
+        self._start_ns = time.perf_counter_ns()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            end = time.perf_counter_ns()
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = [0, 0]
+            timer[0] += 1
+            timer[1] += end - start
+            if len(self.events) < self.max_events:
+                self.events.append((name, start, end,
+                                    threading.get_ident()))
+            else:
+                self.dropped_events += 1
+
+    def count(self, name: str, value=1) -> None:
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary_table(self) -> str:
+        # Stages sorted by total (inclusive) time, then counters
+        lines = [f"{'stage':32s} {'calls':>10s} {'total ms':>12s} "
+                 f"{'mean us':>10s}"]
+        for name, (calls, total_ns) in sorted(self.timers.items(),
+                                              key=lambda t: -t[1][1]):
+            lines.append(f"{name:32s} {calls:10d} {total_ns / 1e6:12.3f} "
+                         f"{total_ns / calls / 1e3:10.3f}")
+        if self.counters:
+            lines.append("")
+            lines.append(f"{'counter':32s} {'value':>10s}")
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"{name:32s} {value:10d}")
+        if self.dropped_events:
+            lines.append(f"\n({self.dropped_events} events not traced)")
+        return "\n".join(lines)
+
+    def chrome_trace(self) -> Dict:
+        # Trace Event Format, viewable in chrome://tracing or Perfetto
+        pid = os.getpid()
+        events = [{"name": name, "ph": "X", "pid": pid, "tid": tid,
+                   "ts": (start - self._start_ns) / 1e3,
+                   "dur": (end - start) / 1e3}
+                  for name, start, end, tid in self.events]
+        end_ts = (time.perf_counter_ns() - self._start_ns) / 1e3
+        events.extend({"name": name, "ph": "C", "pid": pid, "tid": 0,
+                       "ts": end_ts, "args": {name: value}}
+                      for name, value in self.counters.items())
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write_chrome_trace(self, path) -> None:
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
+
+PROFILER = Profiler()
+
+
+def enable(reset=True) -> Profiler:
+    global ENABLED
+    if reset:
+        PROFILER.reset()
+    ENABLED = True
+    return PROFILER
+
+
+def disable() -> None:
+    global ENABLED
+    ENABLED = False
+
+
+@contextmanager
+def profile(reset=True):
+    # Profile everything run inside the block
+    profiler = enable(reset)
+    try:
+        yield profiler
+    finally:
+        disable()
+
+
+def stage(name: str):
+    # Time a block as 'name' when profiling is enabled
+    if ENABLED:
+        return PROFILER.stage(name)
+    return _NULL_STAGE
+
+
+def count(name: str, value=1) -> None:
+    if ENABLED:
+        PROFILER.count(name, value)
+
+
+def profiled(name: str):
+    # Decorator timing every call of a function as stage 'name'
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return func(*args, **kwargs)
+            with PROFILER.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class _NullStage():
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
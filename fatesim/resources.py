@@ -0,0 +1,146 @@
+from hashlib import sha1
+from pathlib import Path
+from typing import Dict, List
+import os
+import pickle
+
+from fatesim.utils import parse_bonus_str
+
+# Loaders for the reference sheets in 'res/', and a registry of all of them
+# that is parsed once and kept as a pickle snapshot next to the matchup
+# cache. The snapshot records each sheet's size, mtime and hash: unchanged
+# stats mean no file is read at all, and a touched but identical sheet only
+# costs a hash before the snapshot is trusted again
+RES_DIR = Path(__file__).resolve().parent.parent / "res"
+RESOURCE_FILES = {"nations": "nations.csv",
+                  "settlements": "settlement_ref.csv",
+                  "units": "units.csv"}
+# Bump when the parsed layout changes
+REGISTRY_VERSION = 1
+DEFAULT_SNAPSHOT_PATH = Path(os.environ.get(
+    "FATESIM_CACHE_DIR", Path.home() / ".cache" / "fatesim")) / "resources.pickle"
+
+
+def _read_rows(path) -> List[Dict[str, str]]:
+    import csv
+    with open(path, newline="") as f:
+        return [row for row in csv.DictReader(f, skipinitialspace=True)]
+
+
+def parse_bonuses(bonus_strs: str) -> tuple:
+    # "+2 infantry open, -2 all struct" -> ((2, "infantry open"),
+    # (-2, "all struct"))
+    return tuple(parse_bonus_str(s.strip()) for s in bonus_strs.split(",")
+                 if s.strip())
+
+
+def load_nation_names(path=RES_DIR / "nations.csv") -> List[str]:
+    return [row["Nation"] for row in _read_rows(path)]
+
+
+def load_settlement_ref(path=RES_DIR / "settlement_ref.csv") -> Dict[str, Dict[str, int]]:
+    # e.g. {"Village": {"RenownGain": 2, "FateGain": 0, "ProsperityTax": -1,
+    # "HappinessTax": -1}, ...}
+    return {row["SettlementType"]: {k: int(v) for k, v in row.items()
+                                    if k != "SettlementType"}
+            for row in _read_rows(path)}
+
+
+def load_unit_ref(path=RES_DIR / "units.csv") -> Dict[str, Dict]:
+    # Keyed by lower case kind (as in UNIT_COSTS), e.g. {"infantry":
+    # {"RenownCost": 5, "BaseMovement": 4, "BaseBonus": "+2 cavalry siege",
+    # "Bonuses": ((2, "cavalry siege"),)}}
+    return {row["Unit"].lower(): {"RenownCost": int(row["RenownCost"]),
+                                  "BaseMovement": int(row["BaseMovement"]),
+                                  "BaseBonus": row["BaseBonus"],
+                                  "Bonuses": parse_bonuses(row["BaseBonus"])}
+            for row in _read_rows(path)}
+
+
+_LOADERS = {"nations": load_nation_names,
+            "settlements": load_settlement_ref,
+            "units": load_unit_ref}
+
+
+class ResourceRegistry():
+    # Parsed contents of every sheet in RESOURCE_FILES
+    def __init__(self, nations: List[str], settlements: Dict[str, Dict],
+                 units: Dict[str, Dict]) -> None:
+        self.nations = nations
+        self.settlements = settlements
+        self.units = units
+
+
+def _stamp(path: Path):
+    stat = path.stat()
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _file_hash(path: Path) -> str:
+    return sha1(path.read_bytes()).hexdigest()
+
+
+def _write_snapshot(snapshot_path: Path, snapshot: Dict) -> None:
+    try:
+        snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+        # Write then rename so other processes never read a partial file
+        tmp_path = snapshot_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, snapshot_path)
+    except OSError:
+        pass  # read-only cache directory; parse again next time
+
+
+def build_registry(res_dir=RES_DIR,
+                   snapshot_path=DEFAULT_SNAPSHOT_PATH) -> ResourceRegistry:
+    # Registry from the snapshot at 'snapshot_path' when it is current,
+    # otherwise parsed from the sheets in 'res_dir' and snapshotted
+    # ('snapshot_path=None' always parses)
+    res_dir = Path(res_dir)
+    paths = {name: res_dir / filename
+             for name, filename in RESOURCE_FILES.items()}
+    stamps = {name: _stamp(path) for name, path in paths.items()}
+
+    snapshot = None
+    if snapshot_path is not None:
+        snapshot_path = Path(snapshot_path)
+        try:
+            with open(snapshot_path, "rb") as f:
+                snapshot = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            snapshot = None
+        if snapshot is not None and (
+                snapshot.get("version") != REGISTRY_VERSION or
+                snapshot.get("res_dir") != str(res_dir)):
+            snapshot = None
+
+    if snapshot is not None:
+        if snapshot["stamps"] == stamps:
+            return ResourceRegistry(**snapshot["data"])
+        # Touched files may still have the same contents
+        hashes = {name: _file_hash(path) for name, path in paths.items()}
+        if snapshot["hashes"] == hashes:
+            snapshot["stamps"] = stamps
+            _write_snapshot(snapshot_path, snapshot)
+            return ResourceRegistry(**snapshot["data"])
+    else:
+        hashes = {name: _file_hash(path) for name, path in paths.items()}
+
+    data = {name: _LOADERS[name](path) for name, path in paths.items()}
+    if snapshot_path is not None:
+        _write_snapshot(snapshot_path, {
+            "version": REGISTRY_VERSION, "res_dir": str(res_dir),
+            "stamps": stamps, "hashes": hashes, "data": data})
+    return ResourceRegistry(**data)
+
+
+_REGISTRY = None
+
+
+def registry(refresh=False) -> ResourceRegistry:
+    # The process-wide registry of the sheets in RES_DIR, built on first use
+    global _REGISTRY
+    if _REGISTRY is None or refresh:
+        _REGISTRY = build_registry()
+    return _REGISTRY
@@ -0,0 +1,151 @@
+from pathlib import Path
+from typing import Dict, Iterable, List
+import numpy as np
+
+from fatesim import profiling
+from fatesim.stats import (MAX_GROUP_SIZE, SUMMARY_COLUMNS, UNIT_ATTRIBUTES,
+                           SimulationStats, unit_columns)
+
+# Typed columnar storage for sweep results: the same columns as
+# 'SimulationStats.generate_csv_header', kept as native arrays instead of CSV
+# text. Parquet (.parquet) and Arrow IPC (.arrow/.feather) need pyarrow;
+# anything else is written as a NumPy .npz archive.
+# String columns are stored as dictionary codes (-1 for missing units) since
+# they only take a handful of values; missing unit costs are NaN
+
+SUMMARY_DTYPES = [None, np.int64, np.int64, np.int64, np.float64, np.float64,
+                  np.float64, np.float64, np.float64]
+STRING_ATTRIBUTES = ("name", "kind", "modifiers")
+ARROW_SUFFIXES = (".arrow", ".feather", ".ipc")
+
+
+def _unit_value(unit, attr: str):
+    # Unquoted values, unlike 'Unit.data_dict'
+    if attr == "modifiers":
+        return ",".join(str(m) for m in unit.modifiers)
+    return getattr(unit, attr)
+
+
+def _encode_strings(values: List[str]):
+    # (codes, categories) with None as code -1
+    categories = {}
+    codes = np.empty(len(values), dtype=np.int32)
+    for i, v in enumerate(values):
+        codes[i] = -1 if v is None else categories.setdefault(v,
+                                                              len(categories))
+    return codes, np.array(list(categories), dtype=str)
+
+
+def sweep_columns(sim_stats: Iterable[SimulationStats],
+                  is_open: Iterable[bool] = None) -> Dict[str, np.ndarray]:
+    # Column arrays for many SimulationStats, with an optional 'is_open'
+    # column. String columns are returned as '<column>' codes plus
+    # '<column>__categories'
+    rows = [[] for _ in SUMMARY_COLUMNS]
+    # Sweeps reuse the same few unit groups, so unit attributes are worked
+    # out once per distinct group and then spread over rows by index
+    groups, group_index = [], {}
+    ug_rows = {"ug1": [], "ug2": []}
+    for stats in sim_stats:
+        for column, value in zip(rows, stats.summary_values()):
+            column.append(value)
+        for ug_name, ug in (("ug1", stats.ug1), ("ug2", stats.ug2)):
+            index = group_index.get(id(ug))
+            if index is None:
+                index = group_index[id(ug)] = len(groups)
+                groups.append(ug)
+            ug_rows[ug_name].append(index)
+
+    columns = {}
+    codes, categories = _encode_strings(rows[0])
+    columns["sim_uid"], columns["sim_uid__categories"] = codes, categories
+    for name, values, dtype in zip(SUMMARY_COLUMNS[1:], rows[1:],
+                                   SUMMARY_DTYPES[1:]):
+        columns[name] = np.array(values, dtype=dtype)
+
+    for i in range(MAX_GROUP_SIZE):
+        units = [ug.units[i] if i < len(ug.units) else None for ug in groups]
+        for attr in UNIT_ATTRIBUTES:
+            values = [None if u is None else _unit_value(u, attr)
+                      for u in units]
+            if attr in STRING_ATTRIBUTES:
+                group_codes, categories = _encode_strings(values)
+            else:
+                group_codes = np.array([np.nan if v is None else v
+                                        for v in values], dtype=np.float64)
+            for ug_name, index in ug_rows.items():
+                name = f"{ug_name}_{i+1}_{attr}"
+                columns[name] = group_codes[np.array(index, dtype=np.int64)]
+                if attr in STRING_ATTRIBUTES:
+                    columns[f"{name}__categories"] = categories
+    if is_open is not None:
+        columns["is_open"] = np.fromiter(is_open, dtype=bool)
+
+    # Same column order as the CSV
+    order = SUMMARY_COLUMNS + unit_columns()
+    if is_open is not None:
+        order.append("is_open")
+    return {key: columns[key] for name in order
+            for key in (name, f"{name}__categories") if key in columns}
+
+
+def _column_names(columns: Dict[str, np.ndarray]) -> List[str]:
+    return [name for name in columns if not name.endswith("__categories")]
+
+
+def _arrow_table(columns: Dict[str, np.ndarray]):
+    import pyarrow as pa
+    arrays = []
+    for name in _column_names(columns):
+        categories = columns.get(f"{name}__categories")
+        if categories is None:
+            arrays.append(pa.array(columns[name]))
+        else:
+            codes = columns[name]
+            arrays.append(pa.DictionaryArray.from_arrays(
+                pa.array(codes, mask=codes < 0), pa.array(categories)))
+    return pa.table(arrays, names=_column_names(columns))
+
+
+@profiling.profiled("stats_writing")
+def write_results(path, sim_stats: Iterable[SimulationStats],
+                  is_open: Iterable[bool] = None) -> Path:
+    # Write a whole sweep in one go; the format follows the file suffix
+    path = Path(path)
+    columns = sweep_columns(sim_stats, is_open)
+    if path.suffix == ".parquet":
+        import pyarrow.parquet as pq
+        pq.write_table(_arrow_table(columns), path)
+    elif path.suffix in ARROW_SUFFIXES:
+        import pyarrow.feather as feather
+        feather.write_feather(_arrow_table(columns), path)
+    else:
+        path = path.with_suffix(".npz")
+        np.savez(path, **columns)
+    return path
+
+
+def load_results(path):
+    # Load a sweep written by 'write_results' as a pandas DataFrame. Numeric
+    # columns wrap the loaded arrays without copying them and string columns
+    # become categoricals over the stored codes
+    import pandas as pd
+    path = Path(path)
+    if path.suffix == ".parquet":
+        import pyarrow.parquet as pq
+        return pq.read_table(path).to_pandas(types_mapper=pd.ArrowDtype)
+    if path.suffix in ARROW_SUFFIXES:
+        import pyarrow.feather as feather
+        return feather.read_table(path, memory_map=True).to_pandas(
+            types_mapper=pd.ArrowDtype)
+
+    with np.load(path) as npz:
+        columns = {name: npz[name] for name in npz.files}
+    data = {}
+    for name in _column_names(columns):
+        categories = columns.get(f"{name}__categories")
+        if categories is None:
+            data[name] = columns[name]
+        else:
+            data[name] = pd.Categorical.from_codes(columns[name], categories)
+    return pd.DataFrame(data, copy=False)
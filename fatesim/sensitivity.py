@@ -0,0 +1,314 @@
+from copy import copy
+from itertools import product
+from typing import Dict, List, Sequence, Tuple
+import numpy as np
+
+from fatesim.batch import (DEFAULT_BATCH_SIZE, casualty_cost_table,
+                           count_combat_dice, roll_dice_sums)
+from fatesim.distribution import signed_deficit_pmf
+from fatesim.modifier import ALL_KINDS_MASK, UNIT_KINDS, Modifier, kind_mask
+from fatesim.sweep import BATTLE_TYPES, sweep_tasks, template_compositions
+from fatesim.unit import (UNIT_COSTS, UNIT_TEMPLATES, UnitGroup,
+                          unit_group_from_templates)
+
+# Sensitivity of a template sweep to the balance numbers: UNIT_COSTS and the
+# bonus values in UNIT_TEMPLATES' bonus strings. Parameters are named
+#   "cost:<kind>"                 e.g. "cost:siege" (UNIT_COSTS["siege"])
+#   "bonus:<template>:<index>"    e.g. "bonus:extra_cavalry:0", the 3 in
+#                                 extra_cavalry's "+3 siege open"
+# and a design is a list of variants, each a dict of parameter values (any
+# parameter left out keeps its current value).
+# Only modifiers and unit costs change between variants, never the dice, so
+# every variant is scored on the same dice samples (common random numbers):
+# each matchup's dice are rolled once, with the seeds 'run_sweep' would use,
+# and kept as a histogram of UG1 roll - UG2 roll. A variant then just shifts
+# that histogram by its modifier difference and looks up its casualty
+# costs, for every matchup at once. Differences between variants are
+# therefore not blurred by sampling noise, and the base variant reproduces
+# 'run_sweep' exactly. With 'num_trials=None' the exact dice distribution is
+# used instead of samples
+
+METRICS = ("win_rate", "ug1_cost", "ug2_cost")
+
+
+def cost_parameter(kind: str) -> str:
+    return f"cost:{kind}"
+
+
+def bonus_parameter(template: str, index: int) -> str:
+    return f"bonus:{template}:{index}"
+
+
+def sensitivity_parameters(templates=None) -> Dict[str, int]:
+    # Every parameter of 'templates' (default all) and its current value
+    names = sorted(UNIT_TEMPLATES if templates is None else templates)
+    units = [UNIT_TEMPLATES[name]() for name in names]
+    parameters = {cost_parameter(kind): UNIT_COSTS[kind]
+                  for kind in UNIT_KINDS if any(u.kind == kind for u in units)}
+    for name, unit in zip(names, units):
+        for i, bonus_str in enumerate(unit.bonuses_strs):
+            parameters[bonus_parameter(name, i)] =\
+                Modifier.from_bonus_str(bonus_str).bonus
+    return parameters
+
+
+def grid_design(values: Dict[str, Sequence[int]]) -> List[Dict[str, int]]:
+    # Every combination of the given parameter values
+    names = list(values)
+    return [dict(zip(names, combo))
+            for combo in product(*(values[name] for name in names))]
+
+
+def one_at_a_time_design(values: Dict[str, Sequence[int]]) -> List[Dict[str, int]]:
+    # Each parameter varied on its own, the rest at their current values
+    return [{name: v} for name, name_values in values.items()
+            for v in name_values]
+
+
+def random_design(ranges: Dict[str, Tuple[int, int]], n: int,
+                  seed=None) -> List[Dict[str, int]]:
+    # 'n' variants with every parameter drawn uniformly from its inclusive
+    # (low, high) range
+    rng = np.random.default_rng(seed)
+    draws = {name: rng.integers(low, high + 1, size=n)
+             for name, (low, high) in ranges.items()}
+    return [{name: int(draws[name][i]) for name in ranges} for i in range(n)]
+
+
+class ParameterEffect():
+    def __init__(self, parameter: str, low: int, high: int,
+                 effects: Dict[str, float],
+                 max_effects: Dict[str, float]) -> None:
+        self.parameter = parameter
+        # Range of the parameter over the design
+        self.low = low
+        self.high = high
+        # Change of each metric as the parameter goes from 'low' to 'high'
+        # (linear fit over the design), as an absolute value averaged over
+        # matchups and as the largest over matchups
+        self.effects = effects
+        self.max_effects = max_effects
+
+
+class SensitivityResult():
+    def __init__(self, parameters: List[str], base_values: np.ndarray,
+                 values: np.ndarray, tasks: List[Tuple[str, str, bool]],
+                 base: Dict[str, np.ndarray],
+                 metrics: Dict[str, np.ndarray]) -> None:
+        self.parameters = parameters
+        self.base_values = base_values
+        # (variants, parameters) values of every parameter in each variant
+        self.values = values
+        # (UG1 uid, UG2 uid, is_open) of each matchup, in 'run_sweep' order
+        self.tasks = tasks
+        # Metric -> (matchups,) for the current values and (variants,
+        # matchups) for the design. Costs are renown lost per battle over
+        # all outcomes, as 'average_ug1_cost'
+        self.base = base
+        self.metrics = metrics
+
+    @property
+    def num_variants(self) -> int:
+        return self.values.shape[0]
+
+    def varied_parameters(self) -> List[str]:
+        return [p for i, p in enumerate(self.parameters)
+                if np.any(self.values[:, i] != self.base_values[i])]
+
+    def variant_changes(self, metric="win_rate") -> np.ndarray:
+        # Mean absolute change of 'metric' from the base, per variant
+        return np.abs(self.metrics[metric] - self.base[metric]).mean(axis=1)
+
+    def effects(self) -> List[ParameterEffect]:
+        # Effect of every varied parameter, largest win rate effect first.
+        # All metrics of all matchups are fitted in one least squares solve,
+        # with the base as one more point of the design
+        varied_names = self.varied_parameters()
+        varied = [i for i, p in enumerate(self.parameters)
+                  if p in varied_names]
+        if not varied:
+            return []
+        x = np.vstack([self.base_values, self.values])[:, varied].astype(
+            np.float64)
+        design = np.hstack([np.ones((len(x), 1)), x - x.mean(axis=0)])
+        num_tasks = len(self.tasks)
+        y = np.hstack([np.vstack([self.base[m], self.metrics[m]])
+                       for m in METRICS])
+        coefs = np.linalg.lstsq(design, y, rcond=None)[0][1:]
+        spans = x.max(axis=0) - x.min(axis=0)
+        effects = []
+        for k, i in enumerate(varied):
+            change = np.abs(coefs[k] * spans[k]).reshape(len(METRICS),
+                                                         num_tasks)
+            effects.append(ParameterEffect(
+                self.parameters[i], int(x[:, k].min()), int(x[:, k].max()),
+                dict(zip(METRICS, change.mean(axis=1).tolist())),
+                dict(zip(METRICS, change.max(axis=1).tolist()))))
+        effects.sort(key=lambda e: e.effects["win_rate"], reverse=True)
+        return effects
+
+    def generate_summary(self) -> str:
+        summary = f"Sensitivity: {self.num_variants} variants, "
+        summary += f"{len(self.tasks)} matchups\n"
+        summary += "Parameter (range): mean|max change in win rate, "
+        summary += "UG1 cost, UG2 cost\n"
+        for e in self.effects():
+            summary += f"{e.parameter} ({e.low} to {e.high}): "
+            summary += ", ".join(f"{e.effects[m]:.4f}|{e.max_effects[m]:.4f}"
+                                 for m in METRICS)
+            summary += "\n"
+        return summary
+
+
+def _dice_histograms(tasks, dice: Dict[Tuple[str, ...], Tuple[int, int]],
+                     task_pairs, num_trials, batch_size,
+                     lowest: int, width: int) -> np.ndarray:
+    # (tasks, width) counts (or probabilities) of UG1 roll - UG2 roll,
+    # offset by 'lowest'. Rolls are drawn in the same order as
+    # 'BatchedMatchup.run', so they are the dice 'run_sweep' would use
+    histograms = np.zeros((len(tasks), width))
+    for t, (task, (c1, c2)) in enumerate(zip(tasks, task_pairs)):
+        dice_1, dice_2 = dice[c1], dice[c2]
+        if num_trials is None:
+            low, probs = signed_deficit_pmf(dice_1, dice_2, 0, 0)
+            histograms[t, low - lowest:low - lowest + len(probs)] = probs
+            continue
+        rng = np.random.default_rng(task.seed)
+        for start in range(0, num_trials, batch_size):
+            size = min(batch_size, num_trials - start)
+            rolls = roll_dice_sums(rng, size, *dice_1) -\
+                roll_dice_sums(rng, size, *dice_2)
+            histograms[t] += np.bincount(rolls - lowest, minlength=width)
+    return histograms
+
+
+def run_sensitivity(design: List[Dict[str, int]], max_size=3, templates=None,
+                    num_trials=1000, seed=0, battle_types=BATTLE_TYPES,
+                    batch_size=DEFAULT_BATCH_SIZE) -> SensitivityResult:
+    # Score every variant of 'design' on every ordered pair of template
+    # compositions (mirror matchups included, unlike
+    # 'all_template_matchups') and battle type
+    names = sorted(UNIT_TEMPLATES if templates is None else templates)
+    base_parameters = sensitivity_parameters(names)
+    parameters = list(base_parameters)
+    for variant in design:
+        for name in variant:
+            if name not in base_parameters:
+                raise ValueError(f"Unknown parameter {name}")
+    base_values = np.array(list(base_parameters.values()), dtype=np.int64)
+    values = np.array([[variant.get(p, base_parameters[p])
+                        for p in parameters] for variant in design],
+                      dtype=np.int64).reshape(-1, len(parameters))
+    all_values = np.vstack([base_values, values])
+
+    # Per-template constants and how each parameter enters them
+    units = [UNIT_TEMPLATES[name]() for name in names]
+    bonus_owner, applies, cost_weights = [], [], np.zeros((len(parameters),
+                                                           len(names)))
+    base_costs = np.array([u.cost for u in units], dtype=np.int64)
+    for p, parameter in enumerate(parameters):
+        fields = parameter.split(":")
+        if fields[0] == "cost":
+            # Unit cost is UNIT_COSTS[kind] plus twice its bonuses
+            for t, unit in enumerate(units):
+                cost_weights[p, t] = unit.kind == fields[1]
+            continue
+        t = names.index(fields[1])
+        cost_weights[p, t] = 2
+        modifier = Modifier.from_bonus_str(
+            units[t].bonuses_strs[int(fields[2])])
+        bonus_owner.append((p, t))
+        applies.append([[modifier.applies_to(mask, is_open)
+                         for is_open in (False, True)]
+                        for mask in range(ALL_KINDS_MASK + 1)])
+    bonus_params = [p for p, _ in bonus_owner]
+    applies = np.array(applies, dtype=np.float64).reshape(
+        len(bonus_owner), ALL_KINDS_MASK + 1, 2)
+
+    compositions = template_compositions(max_size, names)
+    comp_index = {c: i for i, c in enumerate(compositions)}
+    # (compositions, templates) template counts
+    counts = np.zeros((len(compositions), len(names)))
+    for i, c in enumerate(compositions):
+        for name in c:
+            counts[i, names.index(name)] += 1
+    # (compositions, bonus parameters) number of units carrying each bonus
+    bonus_counts = np.array([[counts[i, t] for _, t in bonus_owner]
+                             for i in range(len(compositions))]).reshape(
+        len(compositions), len(bonus_owner))
+    groups = {c: unit_group_from_templates(c) for c in compositions}
+    masks = np.array([kind_mask(u.kind for u in groups[c].units)
+                      for c in compositions], dtype=np.int64)
+    dice = {c: count_combat_dice(groups[c].units) for c in compositions}
+
+    pairs = [(c1, c2) for c1 in compositions for c2 in compositions]
+    tasks = sweep_tasks([(groups[c1], groups[c2]) for c1, c2 in pairs],
+                        num_trials or 1, seed, battle_types)
+    task_pairs = [pair for pair in pairs for _ in battle_types]
+    comp_1 = np.array([comp_index[c1] for c1, _ in task_pairs])
+    comp_2 = np.array([comp_index[c2] for _, c2 in task_pairs])
+    opens = np.array([task.is_open for task in tasks], dtype=np.int64)
+
+    # Rolls range over [-6*max_size, 6*max_size]
+    lowest = -6 * max_size
+    width = 12 * max_size + 1
+    histograms = _dice_histograms(tasks, dice, task_pairs, num_trials,
+                                  batch_size, lowest, width)
+    totals = histograms.sum(axis=1)
+    # Trials in which UG1's roll difference is at least each value
+    at_least = np.cumsum(histograms[:, ::-1], axis=1)[:, ::-1]
+    at_least = np.hstack([at_least, np.zeros((len(tasks), 1))])
+    rolls = np.arange(lowest, lowest + width)
+
+    # (variants, compositions, masks, is_open) total modifiers, for every
+    # variant at once
+    modifiers = np.einsum("vb,cb,bmo->vcmo",
+                          all_values[:, bonus_params].astype(np.float64),
+                          bonus_counts, applies).round().astype(np.int64)
+    modifier_1 = modifiers[:, comp_1, masks[comp_2], opens]
+    modifier_2 = modifiers[:, comp_2, masks[comp_1], opens]
+    differences = modifier_1 - modifier_2
+    max_deficit = 6 * max_size + int(np.abs(differences).max())
+    # (variants, templates) unit costs
+    costs = base_costs + ((all_values - base_values) @ cost_weights
+                          ).round().astype(np.int64)
+
+    results = {m: np.empty((len(all_values), len(tasks))) for m in METRICS}
+    task_range = np.arange(len(tasks))
+    for v, difference in enumerate(differences):
+        # UG1 wins when its roll difference exceeds -difference
+        index = np.clip(1 - difference - lowest, 0, width)
+        results["win_rate"][v] = at_least[task_range, index] / totals
+        tables = _cost_tables(compositions, groups, names, costs[v],
+                              max_deficit)
+        deficits = rolls[None, :] + difference[:, None]
+        losses_1 = np.maximum(-deficits, 0)
+        losses_2 = np.maximum(deficits, 0)
+        results["ug1_cost"][v] = (tables[comp_1[:, None], losses_1]
+                                  * histograms).sum(axis=1) / totals
+        results["ug2_cost"][v] = (tables[comp_2[:, None], losses_2]
+                                  * histograms).sum(axis=1) / totals
+
+    task_labels = [(groups[c1].uid, groups[c2].uid, bool(task.is_open))
+                   for task, (c1, c2) in zip(tasks, task_pairs)]
+    return SensitivityResult(parameters, base_values, values, task_labels,
+                             {m: r[0] for m, r in results.items()},
+                             {m: r[1:] for m, r in results.items()})
+
+
+def _cost_tables(compositions, groups, names, costs: np.ndarray,
+                 max_deficit: int) -> np.ndarray:
+    # (compositions, max_deficit + 1) casualty cost tables with the
+    # variant's unit costs; shared with other variants through the
+    # 'casualty_cost_table' cache when costs coincide
+    cost_of = dict(zip(names, costs.tolist()))
+    tables = np.empty((len(compositions), max_deficit + 1), dtype=np.int64)
+    for i, c in enumerate(compositions):
+        units = []
+        for name, unit in zip(c, groups[c].units):
+            unit = copy(unit)
+            unit.cost = cost_of[name]
+            units.append(unit)
+        tables[i] = casualty_cost_table(UnitGroup(units, groups[c].uid),
+                                        max_deficit)
+    return tables
@@ -0,0 +1,382 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+from typing import Dict, List, Tuple
+import argparse
+import asyncio
+import json
+import os
+import socket
+import stat
+import time
+
+from fatesim.cache import MatchupCache, matchup_key
+from fatesim.stats import SUMMARY_COLUMNS, SimulationStats, simulate_n_stats
+from fatesim.unit import UNIT_TEMPLATES, unit_group_from_templates
+
+# Local matchup odds service: JSON-RPC 2.0, one JSON object per line, over a
+# Unix socket (or TCP on localhost only). Methods:
+#   simulate {"ug1": [template, ...], "ug2": [...], "is_open": bool, "n": int}
+#       -> SUMMARY_COLUMNS of the matchup, plus where the answer came from
+#   metrics {} -> queue depth, counters and latency percentiles
+# Identical queries share one run: a query waits on the run already queued or
+# in flight for its matchup. Distinct queries are collected for up to
+# 'batch_delay' seconds and handed to the worker pool together, and finished
+# runs go into a MatchupCache (read and written on a background thread, so
+# its disk I/O never stalls the event loop). Every matchup is seeded from its cache key, so
+# an answer does not depend on whether it was cached, coalesced or simulated.
+# Usage:
+#   python -m fatesim.server --socket /tmp/fatesim.sock
+#   query("/tmp/fatesim.sock", "simulate", {"ug1": ["basic_infantry"],
+#                                           "ug2": ["basic_cavalry"]})
+
+DEFAULT_SOCKET = Path(os.environ.get("FATESIM_SOCKET",
+                                     "/tmp/fatesim.sock"))
+LOCAL_HOSTS = ("127.0.0.1", "::1", "localhost")
+MAX_TRIALS = 10_000_000
+
+# JSON-RPC error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+INTERNAL_ERROR = -32603
+
+
+class RPCError(Exception):
+    def __init__(self, code: int, message: str) -> None:
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+def _run_batch(queries: List[Tuple]) -> List[SimulationStats]:
+    # Worker side: (ug1 templates, ug2 templates, is_open, n, seed) each
+    return [simulate_n_stats(unit_group_from_templates(names_1),
+                             unit_group_from_templates(names_2), is_open,
+                             n=n, vectorized=True, seed=seed)
+            for names_1, names_2, is_open, n, seed in queries]
+
+
+def _summary(sim_stats: SimulationStats) -> Dict:
+    return dict(zip(SUMMARY_COLUMNS, sim_stats.summary_values()))
+
+
+class Metrics():
+    def __init__(self, window=1000) -> None:
+        self.started = time.monotonic()
+        self.requests = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.coalesced = 0
+        self.simulated = 0
+        self.batches = 0
+        # Seconds per 'simulate' request, over the last 'window' requests
+        self.latencies = deque(maxlen=window)
+
+    def snapshot(self, queue_depth: int, in_flight: int) -> Dict:
+        latencies = sorted(self.latencies)
+
+        def percentile(q):
+            if not latencies:
+                return None
+            return latencies[min(int(q * len(latencies)), len(latencies) - 1)]
+
+        return {"uptime": time.monotonic() - self.started,
+                "queue_depth": queue_depth, "in_flight": in_flight,
+                "requests": self.requests, "errors": self.errors,
+                "cache_hits": self.cache_hits, "coalesced": self.coalesced,
+                "simulated": self.simulated, "batches": self.batches,
+                "latency_mean": (sum(latencies) / len(latencies)
+                                 if latencies else None),
+                "latency_p50": percentile(0.5),
+                "latency_p95": percentile(0.95),
+                "latency_max": latencies[-1] if latencies else None}
+
+
+class SimulationServer():
+    def __init__(self, cache: MatchupCache = None, num_workers=None,
+                 batch_size=64, batch_delay=0.002) -> None:
+        self.cache = MatchupCache() if cache is None else cache
+        self.num_workers = num_workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.metrics = Metrics()
+        # Cache key -> future of the run for that matchup, queued or running
+        self._pending = {}
+        self._queue = None
+        self._in_flight = 0
+        self._executor = None
+        # One thread, so cache accesses never run concurrently
+        self._cache_executor = None
+        self._dispatcher = None
+        # Running '_run' tasks; the loop only keeps weak references to them
+        self._runs = set()
+
+    async def start(self) -> None:
+        self._queue = asyncio.Queue()
+        self._executor = ProcessPoolExecutor(self.num_workers)
+        self._cache_executor = ThreadPoolExecutor(1)
+        self._dispatcher = asyncio.ensure_future(self._dispatch())
+
+    async def close(self) -> None:
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+        for run in list(self._runs):
+            run.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        if self._cache_executor is not None:
+            self._cache_executor.shutdown(wait=False)
+
+    def metrics_snapshot(self) -> Dict:
+        return self.metrics.snapshot(self._queue.qsize(), self._in_flight)
+
+    async def _dispatch(self) -> None:
+        # Collect queued runs into batches for the worker pool
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_delay
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(),
+                                                        timeout))
+                except asyncio.TimeoutError:
+                    break
+            run = asyncio.ensure_future(self._run(batch))
+            self._runs.add(run)
+            run.add_done_callback(self._runs.discard)
+
+    async def _run(self, batch: List[Tuple]) -> None:
+        # batch entries are (key, ug1, ug2, query)
+        loop = asyncio.get_running_loop()
+        self._in_flight += len(batch)
+        self.metrics.batches += 1
+        try:
+            results = await loop.run_in_executor(
+                self._executor, _run_batch, [entry[3] for entry in batch])
+        except Exception as e:
+            for key, _, _, _ in batch:
+                self._pending.pop(key).set_exception(e)
+            return
+        finally:
+            self._in_flight -= len(batch)
+        for (key, ug1, ug2, query), sim_stats in zip(batch, results):
+            sim_stats.ug1, sim_stats.ug2 = ug1, ug2
+            self.metrics.simulated += 1
+            self._pending[key].set_result(sim_stats)
+        # Answered already; queries arriving before the results are cached
+        # still find the finished runs in '_pending'
+        try:
+            await loop.run_in_executor(self._cache_executor, self._put_batch,
+                                       batch, results)
+        finally:
+            for key, _, _, _ in batch:
+                self._pending.pop(key)
+
+    def _put_batch(self, batch: List[Tuple],
+                   results: List[SimulationStats]) -> None:
+        for (_, ug1, ug2, query), sim_stats in zip(batch, results):
+            self.cache.put(ug1, ug2, query[2], query[3], sim_stats,
+                           seed=query[4])
+
+    async def simulate(self, params: Dict) -> Dict:
+        names_1, names_2 = params.get("ug1"), params.get("ug2")
+        for names in (names_1, names_2):
+            if not isinstance(names, list) or not names or\
+                    any(name not in UNIT_TEMPLATES for name in names):
+                raise RPCError(INVALID_PARAMS,
+                               "ug1 and ug2 must be non-empty lists of "
+                               f"templates from {sorted(UNIT_TEMPLATES)}")
+        is_open = params.get("is_open", True)
+        n = params.get("n", 1000)
+        if not isinstance(is_open, bool) or not isinstance(n, int) or\
+                not 0 < n <= MAX_TRIALS:
+            raise RPCError(INVALID_PARAMS, "is_open must be a boolean and n "
+                           f"an integer in [1, {MAX_TRIALS}]")
+
+        ug1 = unit_group_from_templates(names_1)
+        ug2 = unit_group_from_templates(names_2)
+        key = matchup_key(ug1, ug2, is_open, n)
+        seed = int(key[:16], 16)
+        sim_stats = await asyncio.get_running_loop().run_in_executor(
+            self._cache_executor, partial(self.cache.get, seed=seed),
+            ug1, ug2, is_open, n)
+        if sim_stats is not None:
+            self.metrics.cache_hits += 1
+            return dict(_summary(sim_stats), source="cache")
+
+        future = self._pending.get(key)
+        source = "coalesced"
+        if future is None:
+            future = self._pending[key] =\
+                asyncio.get_running_loop().create_future()
+            self._queue.put_nowait((key, ug1, ug2,
+                                    (names_1, names_2, is_open, n, seed)))
+            source = "simulated"
+        else:
+            self.metrics.coalesced += 1
+        sim_stats = await asyncio.shield(future)
+        # Relabel for this query's own groups
+        result = SimulationStats.blank()
+        result.accumulator = sim_stats.accumulator
+        result.ug1, result.ug2 = ug1, ug2
+        return dict(_summary(result), source=source)
+
+    async def handle(self, request) -> Dict:
+        # One JSON-RPC request object -> response object (None for
+        # notifications)
+        if not isinstance(request, dict) or request.get("jsonrpc") != "2.0"\
+                or not isinstance(request.get("method"), str):
+            return _error(None, INVALID_REQUEST, "Invalid request")
+        request_id = request.get("id")
+        params = request.get("params") or {}
+        start = time.perf_counter()
+        self.metrics.requests += 1
+        try:
+            if not isinstance(params, dict):
+                raise RPCError(INVALID_PARAMS, "params must be an object")
+            if request["method"] == "simulate":
+                result = await self.simulate(params)
+                self.metrics.latencies.append(time.perf_counter() - start)
+            elif request["method"] == "metrics":
+                result = self.metrics_snapshot()
+            else:
+                raise RPCError(METHOD_NOT_FOUND,
+                               f"Unknown method '{request['method']}'")
+        except RPCError as e:
+            self.metrics.errors += 1
+            return _error(request_id, e.code, e.message)
+        except Exception as e:
+            self.metrics.errors += 1
+            return _error(request_id, INTERNAL_ERROR, repr(e))
+        if "id" not in request:
+            return None
+        return {"jsonrpc": "2.0", "id": request_id, "result": result}
+
+    async def _answer(self, line: bytes, writer: asyncio.StreamWriter,
+                      lock: asyncio.Lock) -> None:
+        try:
+            request = json.loads(line)
+        except ValueError:
+            response = _error(None, PARSE_ERROR, "Parse error")
+        else:
+            response = await self.handle(request)
+        if response is not None:
+            async with lock:
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+
+    async def _client(self, reader: asyncio.StreamReader,
+                      writer: asyncio.StreamWriter) -> None:
+        # Requests on one connection are answered as they finish, so a slow
+        # run does not hold up cached answers; match them up by 'id'
+        lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    task = asyncio.ensure_future(
+                        self._answer(line, writer, lock))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            writer.close()
+
+    async def serve(self, path=DEFAULT_SOCKET, host=None, port=None) -> None:
+        # Serve forever on the Unix socket 'path', or on TCP 'host':'port'
+        # when a port is given (localhost only)
+        await self.start()
+        try:
+            if port is not None:
+                host = host or "127.0.0.1"
+                if host not in LOCAL_HOSTS:
+                    raise ValueError(f"Refusing to listen on non-local "
+                                     f"host '{host}'")
+                server = await asyncio.start_server(self._client, host, port)
+            else:
+                path = Path(path)
+                try:
+                    mode = path.lstat().st_mode
+                except FileNotFoundError:
+                    mode = None
+                # Replace a stale socket from an earlier run, but never
+                # delete anything else
+                if mode is not None:
+                    if not stat.S_ISSOCK(mode):
+                        raise ValueError(f"Refusing to replace '{path}', "
+                                         "which is not a socket")
+                    path.unlink()
+                server = await asyncio.start_unix_server(self._client,
+                                                         str(path))
+                os.chmod(path, 0o600)
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.close()
+
+
+def _error(request_id, code: int, message: str) -> Dict:
+    return {"jsonrpc": "2.0", "id": request_id,
+            "error": {"code": code, "message": message}}
+
+
+def query(path=DEFAULT_SOCKET, method="simulate", params=None, port=None,
+          host="127.0.0.1", timeout=None) -> Dict:
+    # Blocking client for one request; raises RPCError on an error response
+    if port is not None:
+        sock = socket.create_connection((host, port), timeout=timeout)
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(str(path))
+    with sock, sock.makefile("rwb") as f:
+        request = {"jsonrpc": "2.0", "id": 1, "method": method,
+                   "params": params or {}}
+        f.write(json.dumps(request).encode() + b"\n")
+        f.flush()
+        response = json.loads(f.readline())
+    if "error" in response:
+        raise RPCError(response["error"]["code"],
+                       response["error"]["message"])
+    return response["result"]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve fatesim matchup queries on this machine")
+    parser.add_argument("--socket", default=str(DEFAULT_SOCKET),
+                        help="Unix socket path to listen on")
+    parser.add_argument("--port", type=int,
+                        help="listen on this localhost TCP port instead")
+    parser.add_argument("--workers", type=int, help="worker processes")
+    parser.add_argument("--cache-dir",
+                        help="on-disk result cache (default: the shared "
+                             "fatesim cache, 'none' to keep it in memory)")
+    args = parser.parse_args()
+
+    if args.cache_dir is None:
+        cache = MatchupCache()
+    elif args.cache_dir == "none":
+        cache = MatchupCache(directory=None)
+    else:
+        cache = MatchupCache(args.cache_dir)
+    server = SimulationServer(cache, num_workers=args.workers)
+    try:
+        asyncio.run(server.serve(args.socket, port=args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,73 @@
-from fatesim.modifier import combine_modifiers
+from typing import List
+
+from fatesim.modifier import ALL_KINDS_MASK, combine_modifiers
+from fatesim.unit import Unit, UnitGroup
 
 SETTLEMENT_KINDS = ["Village", "Town", "City", "Capital"]
 GARRISON_CAP = 3
 
 
 class Settlement():
-    def __init__(self, name: str, kind: str, structures=[],
-                 garrisoned_units=[]) -> None:
+    def __init__(self, name: str, kind: str, structures=None,
+                 garrisoned_units=None) -> None:
         self.name = name
         self.kind = kind
+        self.structures = structures or []
+        self.garrisoned_units = garrisoned_units or []
+
+    @property
+    def structures(self):
+        return self._structures
+
+    @structures.setter
+    def structures(self, structures):
         # Check to make sure structure is allowed to be in a settlement
-        self.structures = [s for s in structures if s.in_settlement]
-        self.defensive_structures = [s for s in self.structures
+        self._structures = [s for s in structures if s.in_settlement]
+        self.defensive_structures = [s for s in self._structures
                                      if s.is_defensive]
-        self.production_structures = [s for s in structures
+        self.production_structures = [s for s in self._structures
                                       if not s in self.defensive_structures]
         # Defensive modifiers from structures that provide them
         self.defense_modifier = combine_modifiers(s.modifier
                                                   for s in self.defensive_structures)
-        self.garrisoned_units = garrisoned_units
+        # Total defense modifier against each attacking kind mask, filled
+        # in by 'defense_modifier_against'
+        self._defense_table = None
+
+    def add_structure(self, structure) -> None:
+        # Use these (or assign 'structures') rather than changing the lists,
+        # so the defense table is rebuilt
+        self.structures = self._structures + [structure]
+
+    def remove_structure(self, structure) -> None:
+        self.structures = [s for s in self._structures if s is not structure]
+
+    def defense_modifier_against(self, attacking_kind_mask: int) -> int:
+        # Modifier the settlement's defenses add to its garrison in a siege
+        # by units with kinds in 'attacking_kind_mask'. Sieges are structure
+        # battles, so only non-open modifiers count
+        if self._defense_table is None:
+            self._defense_table = [
+                sum(m.bonus for m in self.defense_modifier
+                    if m.applies_to(mask, False))
+                for mask in range(ALL_KINDS_MASK + 1)]
+        return self._defense_table[attacking_kind_mask]
+
+    @property
+    def garrisoned_units(self) -> List[Unit]:
+        return self._garrisoned_units
+
+    @garrisoned_units.setter
+    def garrisoned_units(self, units: List[Unit]):
+        if len(units) > GARRISON_CAP:
+            raise ValueError(f"At most {GARRISON_CAP} units can garrison "
+                             f"{self.name}")
+        self._garrisoned_units = list(units)
+        self._garrison = None
+
+    @property
+    def garrison(self) -> UnitGroup:
+        # The garrison as the defending unit group of a siege
+        if self._garrison is None:
+            self._garrison = UnitGroup(self._garrisoned_units, self.name)
+        return self._garrison
@@ -0,0 +1,56 @@
+from typing import Dict, List
+import numpy as np
+
+from fatesim.distribution import BattleDistribution, exact_battle_distribution
+from fatesim.settlement import Settlement
+from fatesim.stats import SimulationStats, simulate_n_stats
+from fatesim.unit import UnitGroup
+
+# Sieges: structure battles against a settlement's garrison, which fights
+# with the settlement's defensive modifiers on top of its own (see
+# 'Settlement.defense_modifier_against' and 'simulate_siege'). In every
+# result the attackers are UG1 and the garrison UG2
+
+
+def _defense(attackers: UnitGroup, settlement: Settlement) -> tuple:
+    return (0, settlement.defense_modifier_against(attackers.kind_mask))
+
+
+def simulate_siege_n_stats(attackers: UnitGroup, settlement: Settlement,
+                           n=100, vectorized=False, seed=None,
+                           dice=None) -> SimulationStats:
+    return simulate_n_stats(attackers, settlement.garrison, False, n=n,
+                            vectorized=vectorized, seed=seed, dice=dice,
+                            extra_modifiers=_defense(attackers, settlement))
+
+
+def siege_distribution(attackers: UnitGroup,
+                       settlement: Settlement) -> BattleDistribution:
+    # Exact outcome distribution of 'simulate_siege'
+    return exact_battle_distribution(attackers, settlement.garrison, False,
+                                     _defense(attackers, settlement))
+
+
+def siege_sweep(attackers: List[UnitGroup],
+                settlements: List[Settlement]) -> Dict[str, np.ndarray]:
+    # Exact siege odds of every attacking group against every settlement,
+    # as (len(attackers), len(settlements)) arrays. NaN where a side has
+    # no military units
+    shape = (len(attackers), len(settlements))
+    results = {name: np.full(shape, np.nan)
+               for name in ("p_attacker_victory", "p_garrison_victory",
+                            "p_draw", "average_attacker_cost",
+                            "average_garrison_cost")}
+    for j, settlement in enumerate(settlements):
+        if not any(u.has_military for u in settlement.garrisoned_units):
+            continue
+        for i, ug in enumerate(attackers):
+            if not any(u.has_military for u in ug.units):
+                continue
+            dist = siege_distribution(ug, settlement)
+            results["p_attacker_victory"][i, j] = dist.p_ug1_victory
+            results["p_garrison_victory"][i, j] = dist.p_ug2_victory
+            results["p_draw"][i, j] = dist.p_draw
+            results["average_attacker_cost"][i, j] = dist.average_ug1_cost
+            results["average_garrison_cost"][i, j] = dist.average_ug2_cost
+    return results
@@ -1,9 +1,10 @@
 from typing import List
 from copy import deepcopy
 
+from fatesim import profiling
+from fatesim.dice import GLOBAL_DICE, DiceSource
 from fatesim.modifier import Modifier
 from fatesim.unit import Unit, UnitGroup
-from fatesim.utils import roll_d3, roll_d6
 
 
 class BattleResult():
@@ -41,6 +42,14 @@ class BattleResult():
 
         return summ
 
+    @property
+    def victor_side(self) -> int:
+        # 1 (UG1), 2 (UG2) or 0 for a draw; by position, so it stays right
+        # when both groups share a uid
+        if self.units_1_total == self.units_2_total:
+            return 0
+        return 1 if self.units_1_total > self.units_2_total else 2
+
     def determine_victor(self):
         deficit = self.units_1_total - self.units_2_total
         if deficit == 0:
@@ -62,127 +71,132 @@ def check_open(is_open: bool, target: str):
 def is_applicable_modifier(modifier: Modifier, is_open: bool,
                            target: str):
     # Check if the modifier is applicable to the target
-    if is_open and not modifier.target.endswith("open"):
+    if is_open and not modifier.is_open:
         return False
-    if modifier.target.startswith("all"):
+    if modifier.targets_all:
         return True
     return target == modifier.target
 
 
+@profiling.profiled("modifier_resolution")
 def determine_total_modifier(attacking_ug: UnitGroup,
                              defending_ug: UnitGroup,
                              is_open: bool) -> int:
     # Determine the total modifier attacking units should have, avoiding
     # multiple counting (e.g. cav does not get multiple boosts for multiple
     # opposing siege)
-    total_modifier = 0
-    defending_unit_kinds = set([u.kind for u in defending_ug.units])
-    for mod in attacking_ug.modifiers:
-        if check_open(is_open, mod.target):
-            if mod.target.startswith("all") or mod.target.split(" ")[0] in defending_unit_kinds:
-                total_modifier += mod.bonus
-    return total_modifier
+    return attacking_ug.total_modifier(defending_ug.kind_mask, is_open)
 
 
-def determine_combat_dice(units: List[Unit]) -> List[callable]:
-    return [roll_d3 if unit.is_bloodied else roll_d6 for unit in units]
+def determine_combat_dice(units: List[Unit]) -> List[int]:
+    # Faces of each unit's die: bloodied units roll a d3 instead of a d6
+    return [3 if unit.is_bloodied else 6 for unit in units]
 
 
-def roll_combat_dice(dice: List[callable]) -> List[int]:
-    return [d() for d in dice]
+@profiling.profiled("dice_rolling")
+def roll_combat_dice(faces: List[int], dice: DiceSource = None) -> List[int]:
+    if profiling.ENABLED:
+        profiling.count("dice_rolled", len(faces))
+    return (dice or GLOBAL_DICE).roll(faces)
 
 
+@profiling.profiled("determine_new_units")
 def determine_new_units(ug: UnitGroup,
                         result: BattleResult) -> List[Unit]:
-    units, units_id = deepcopy(ug.units), ug.uid
-    if units_id == result.victor:
-        return units
+    if ug.uid == result.victor:
+        if profiling.ENABLED:
+            profiling.count("units_copied", len(ug.units))
+        with profiling.stage("unit_copying"):
+            return deepcopy(ug.units)
+
+    return allocate_casualties(ug.units, result.deficit)
 
+
+@profiling.profiled("casualty_allocation")
+def allocate_casualties(units: List[Unit], deficit: int) -> List[Unit]:
     # Find how many multiples of 6 there are in the deficit, then
     # multiples of 3, then remaining deficit and decide which units to
     # remove and bloody based on cost (lower cost ones go first)
-    deficit = result.deficit
-    new_units = deepcopy(units)
+    # Returns new units, 'units' is left untouched
+    # Every 6 kills the cheapest remaining unit; what is left (under 6)
+    # makes at most two hits, one for 3 and one for any remainder. Units
+    # are sorted once (stably), deaths are a slice and hits advance a
+    # pointer, so large groups cost O(n log n); only survivors are copied
     # Sort in ascending order so cheapest units are at the front
-    new_units.sort(key=lambda unit: unit.cost)
+    ordered = sorted(units, key=lambda unit: unit.cost)
     # Unit deaths
-    num_deaths = deficit // 6
-    for _ in range(num_deaths):
-        try:
-            new_units.remove(new_units[0])
-            deficit -= 6
-        except IndexError:
-            # no more units
-            return new_units
-    # Check if any units left
-    if not new_units:
-        return new_units
-
-    # Bloodied units; prefer bloodied unit to dead one
-    num_bloodied = deficit // 3
-    while num_bloodied > 0:
-        # Check if any units left
+    num_deaths = max(deficit // 6, 0)
+    if num_deaths >= len(ordered):
+        return []  # all units killed
+    deficit -= 6 * num_deaths
+    if profiling.ENABLED:
+        profiling.count("units_copied", len(ordered) - num_deaths)
+    with profiling.stage("unit_copying"):
+        new_units = deepcopy(ordered[num_deaths:])
+
+    # Bloodied units; prefer bloodied unit to dead one. Then bloody /
+    # remove another unit if deficit remains
+    num_hits = deficit // 3 + (deficit % 3 > 0) if deficit > 0 else 0
+    first_unbloodied = 0
+    for _ in range(num_hits):
         if not new_units:
-            return new_units  # all units killed
-        # Only bloodied, units, remove low value ones
-        if all(unit.is_bloodied for unit in new_units):
-            new_units.pop()
-            deficit -= 3
-            num_bloodied -= 1
-        # Iterate in ascending order
-        for unit in new_units:
-            if not unit.is_bloodied:
-                unit.is_bloodied = True
-                deficit -= 3
-                num_bloodied -= 1
-                if num_bloodied <= 0:
-                    break
-
-    # Bloody / remove another unit if deficit remains
-    if deficit > 0:
-        # print("Final deficit")
-        if all(unit.is_bloodied for unit in new_units):
+            break  # already bloodied groups can be emptied
+        while first_unbloodied < len(new_units) and\
+                new_units[first_unbloodied].is_bloodied:
+            first_unbloodied += 1
+        if first_unbloodied >= len(new_units):
+            # Only bloodied units, remove the most expensive one
             new_units.pop()
-            return new_units
         else:
-            for unit in new_units:
-                if not unit.is_bloodied:
-                    unit.is_bloodied = True
-                    return new_units
-    return new_units  # deficit is <= 0
+            new_units[first_unbloodied].is_bloodied = True
+    return new_units
 
 
-def simulate_battle(ug1: UnitGroup, ug2: UnitGroup, is_open: bool):
+@profiling.profiled("simulate_battle")
+def simulate_battle(ug1: UnitGroup, ug2: UnitGroup, is_open: bool,
+                    dice: DiceSource = None, extra_modifiers=(0, 0)):
     # Simulate a battle between two sets of units
     # 'is_open' is used to determine modifier applicability for open
     # battles vs sieges
+    # 'dice' is where rolls come from (see 'fatesim.dice'), by default the
+    # global 'random' module
+    # 'extra_modifiers' are added to each side's total modifier, e.g. a
+    # settlement's defenses (see 'simulate_siege')
     # In Fatecraft, only sets of up to 3 units can fight each other
     # at a time, but there is no restriction made here
-    # Create copies to avoid overwriting original unit groups
-    units_1 = deepcopy(ug1.units)
-    units_2 = deepcopy(ug2.units)
-    # Remove all non-military units locally
-    for u in units_1:
-        if not u.has_military:
-            units_1.remove(u)
-    for u in units_2:
-        if not u.has_military:
-            units_2.remove(u)
+    # Remove all non-military units locally; units are only read here, so
+    # new lists (no copies of the units) leave the original groups intact
+    units_1 = [u for u in ug1.units if u.has_military]
+    units_2 = [u for u in ug2.units if u.has_military]
 
     if not units_1 or not units_2:
         print("Both units_1 and units_2 must be non-empty")
         return None
 
+    if profiling.ENABLED:
+        profiling.count("battles")
+
     # Determine total modifiers each side should apply
-    units_1_modifier = determine_total_modifier(ug1, ug2, is_open)
-    units_2_modifier = determine_total_modifier(ug2, ug1, is_open)
+    units_1_modifier = determine_total_modifier(ug1, ug2, is_open) +\
+        extra_modifiers[0]
+    units_2_modifier = determine_total_modifier(ug2, ug1, is_open) +\
+        extra_modifiers[1]
 
     # Determine dice rolls
-    units_1_dice = roll_combat_dice(determine_combat_dice(units_1))
-    units_2_dice = roll_combat_dice(determine_combat_dice(units_2))
+    units_1_dice = roll_combat_dice(determine_combat_dice(units_1), dice)
+    units_2_dice = roll_combat_dice(determine_combat_dice(units_2), dice)
 
     # Compute result, but do not update units
     result = BattleResult(ug1, units_1_modifier, units_1_dice,
                           ug2, units_2_modifier, units_2_dice)
 
     return result
+
+
+def simulate_siege(attackers: UnitGroup, settlement, dice: DiceSource = None):
+    # Structure battle against a 'fatesim.settlement.Settlement': its
+    # garrison defends (as UG2 of the result) with the settlement's
+    # defensive modifiers added to its own
+    defense = settlement.defense_modifier_against(attackers.kind_mask)
+    return simulate_battle(attackers, settlement.garrison, False, dice,
+                           extra_modifiers=(0, defense))
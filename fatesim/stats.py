@@ -1,15 +1,169 @@
-from typing import List
+from typing import Dict, List, Tuple
 from io import TextIOWrapper
+from math import sqrt
+from statistics import NormalDist
 
 
+from fatesim import profiling
 from fatesim.simulation import determine_new_units, simulate_battle
 from fatesim.unit import Unit, UnitGroup, renown_difference
 
 
+# Columns of 'generate_csv_header', followed by UNIT_ATTRIBUTES for each of
+# the first MAX_GROUP_SIZE units of UG1 and then UG2
+SUMMARY_COLUMNS = ["sim_uid", "num_trials", "num_ug1_victories",
+                   "num_ug2_victories", "avg_roll_deficit", "avg_ug1_cost",
+                   "avg_ug2_cost", "avg_ug1_loss_cost", "avg_ug2_loss_cost"]
+UNIT_ATTRIBUTES = ["name", "kind", "modifiers", "cost"]
+MAX_GROUP_SIZE = 3
+
+
+def unit_columns() -> List[str]:
+    return [f"{ug}_{i+1}_{attr}" for ug in ("ug1", "ug2")
+            for i in range(MAX_GROUP_SIZE) for attr in UNIT_ATTRIBUTES]
+
+
+class StatsAccumulator():
+    # Constant-memory running totals over battle trials. Everything is kept
+    # as exact integer counts and sums (with sums of squares for variances
+    # and a signed deficit histogram for quantiles), so accumulators from
+    # parallel shards merge exactly with 'merge'
+    # Sides are 1 for UG1, 2 for UG2 and 0 for a draw
+    def __init__(self) -> None:
+        self.num_trials = 0
+        self.num_ug1_victories = 0
+        self.num_ug2_victories = 0
+        self.deficit_sum = 0
+        self.deficit_sum_sq = 0
+        # Signed deficit (UG1 total - UG2 total) -> count
+        self.deficit_counts = {}
+        self.ug1_cost_sum = 0
+        self.ug1_cost_sum_sq = 0
+        self.ug2_cost_sum = 0
+        self.ug2_cost_sum_sq = 0
+        # Costs summed over the trials each side lost
+        self.ug1_loss_cost_sum = 0
+        self.ug2_loss_cost_sum = 0
+
+    def add(self, deficit: int, victor_side: int,
+            ug1_cost: int, ug2_cost: int) -> None:
+        # One trial; 'deficit' is unsigned as in 'BattleResult'
+        self.num_trials += 1
+        signed_deficit = deficit
+        if victor_side == 1:
+            self.num_ug1_victories += 1
+            self.ug2_loss_cost_sum += ug2_cost
+        elif victor_side == 2:
+            self.num_ug2_victories += 1
+            self.ug1_loss_cost_sum += ug1_cost
+            signed_deficit = -deficit
+        self.deficit_sum += deficit
+        self.deficit_sum_sq += deficit*deficit
+        self.deficit_counts[signed_deficit] = \
+            self.deficit_counts.get(signed_deficit, 0) + 1
+        self.ug1_cost_sum += ug1_cost
+        self.ug1_cost_sum_sq += ug1_cost*ug1_cost
+        self.ug2_cost_sum += ug2_cost
+        self.ug2_cost_sum_sq += ug2_cost*ug2_cost
+
+    def add_batch(self, signed_deficits, ug1_costs, ug2_costs) -> None:
+        # Many trials at once from NumPy integer arrays
+        import numpy as np
+        ug1_lost = signed_deficits < 0
+        ug2_lost = signed_deficits > 0
+        deficits = np.abs(signed_deficits)
+        self.num_trials += len(signed_deficits)
+        self.num_ug1_victories += int(ug2_lost.sum())
+        self.num_ug2_victories += int(ug1_lost.sum())
+        self.deficit_sum += int(deficits.sum())
+        self.deficit_sum_sq += int((deficits*deficits).sum())
+        values, counts = np.unique(signed_deficits, return_counts=True)
+        for v, c in zip(values.tolist(), counts.tolist()):
+            self.deficit_counts[v] = self.deficit_counts.get(v, 0) + c
+        self.ug1_cost_sum += int(ug1_costs.sum())
+        self.ug1_cost_sum_sq += int((ug1_costs*ug1_costs).sum())
+        self.ug2_cost_sum += int(ug2_costs.sum())
+        self.ug2_cost_sum_sq += int((ug2_costs*ug2_costs).sum())
+        self.ug1_loss_cost_sum += int(ug1_costs[ug1_lost].sum())
+        self.ug2_loss_cost_sum += int(ug2_costs[ug2_lost].sum())
+
+    def merge(self, other: "StatsAccumulator") -> None:
+        # Adds another accumulator's trials into this one
+        for name, value in vars(other).items():
+            if name == "deficit_counts":
+                for d, c in value.items():
+                    self.deficit_counts[d] = self.deficit_counts.get(d, 0) + c
+            else:
+                setattr(self, name, getattr(self, name) + value)
+
+    @staticmethod
+    def _variance(total: int, total_sq: int, n: int) -> float:
+        # Sample variance from exact sums
+        if n < 2:
+            return 0.
+        return (total_sq - total*total / n) / (n - 1)
+
+    def deficit_variance(self) -> float:
+        return self._variance(self.deficit_sum, self.deficit_sum_sq,
+                              self.num_trials)
+
+    def ug1_cost_variance(self) -> float:
+        return self._variance(self.ug1_cost_sum, self.ug1_cost_sum_sq,
+                              self.num_trials)
+
+    def ug2_cost_variance(self) -> float:
+        return self._variance(self.ug2_cost_sum, self.ug2_cost_sum_sq,
+                              self.num_trials)
+
+    def win_interval(self, side: int, confidence=0.95) -> Tuple[float, float]:
+        # Wilson score interval for the probability that 'side' wins, which
+        # stays sensible for lopsided matchups with (almost) no wins
+        n = self.num_trials
+        if n == 0:
+            return 0., 1.
+        wins = self.num_ug1_victories if side == 1 else self.num_ug2_victories
+        z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        p = wins / n
+        centre = (p + z*z / (2*n)) / (1 + z*z / n)
+        half_width = z * sqrt(p*(1 - p) / n + z*z / (4*n*n)) / (1 + z*z / n)
+        return max(centre - half_width, 0.), min(centre + half_width, 1.)
+
+    def cost_interval(self, side: int, confidence=0.95) -> Tuple[float, float]:
+        # Normal interval for the average renown cost of 'side'
+        n = self.num_trials
+        if n < 2:
+            return float("-inf"), float("inf")
+        if side == 1:
+            mean, variance = self.ug1_cost_sum / n, self.ug1_cost_variance()
+        else:
+            mean, variance = self.ug2_cost_sum / n, self.ug2_cost_variance()
+        z = NormalDist().inv_cdf(0.5 + confidence / 2)
+        half_width = z * sqrt(max(variance, 0.) / n)
+        return mean - half_width, mean + half_width
+
+    def deficit_quantile(self, q: float, signed=False) -> int:
+        # Smallest (unsigned unless 'signed') roll deficit with at least a
+        # fraction 'q' of trials at or below it
+        counts = {}
+        for d, c in self.deficit_counts.items():
+            key = d if signed else abs(d)
+            counts[key] = counts.get(key, 0) + c
+        target = q * self.num_trials
+        cumulative = 0
+        for d in sorted(counts):
+            cumulative += counts[d]
+            if cumulative >= target:
+                return d
+        return None
+
+
 class SimulationStats():
     # Assumes two unit groups (UG1 & UG2) fighting each other multiple
     # times without any changes in the battle
     # Usually created from the 'simulate_n_stats' function
+    # Summaries come from a 'StatsAccumulator'; the per-trial lists are only
+    # kept when given here or when created with 'blank(keep_trials=True)',
+    # and otherwise are None
     def __init__(self, ug1: UnitGroup, ug2: UnitGroup,
                  deficits: List[int], victors: List[str],
                  losers: List[str], ug1_costs: List[int],
@@ -21,44 +175,115 @@ class SimulationStats():
         self.losers = losers
         self.ug1_costs = ug1_costs
         self.ug2_costs = ug2_costs
+        self.accumulator = StatsAccumulator()
+        # Only set for 'fatesim.batch.simulate_to_precision' runs
+        self.confidence = None
+        self.target_precision = None
+        self.achieved_precision = None
+        self.intervals = None
+        if deficits:
+            for i, deficit in enumerate(deficits):
+                self.accumulator.add(deficit, self._side(victors[i]),
+                                     ug1_costs[i], ug2_costs[i])
 
     @classmethod
-    def blank(cls):
+    def blank(cls, keep_trials=False):
         # For when starting a new simulation
-        return cls(None, None, [], [], [], [], [])
+        if keep_trials:
+            return cls(None, None, [], [], [], [], [])
+        return cls(None, None, None, None, None, None, None)
+
+    @property
+    def keep_trials(self) -> bool:
+        return self.deficits is not None
+
+    def _side(self, uid: str) -> int:
+        # Only for trial lists, which record the victor by uid; ambiguous
+        # when both groups share one, so 'add_trial' takes the side too
+        if uid is None:
+            return 0
+        return 1 if uid == self.ug1.uid else 2
+
+    @profiling.profiled("stats_aggregation")
+    def add_trial(self, deficit: int, victor: str, loser: str,
+                  ug1_cost: int, ug2_cost: int, victor_side=None) -> None:
+        # 'victor_side' is 'BattleResult.victor_side', worked out from the
+        # victor's uid when not given
+        if victor_side is None:
+            victor_side = self._side(victor)
+        self.accumulator.add(deficit, victor_side, ug1_cost, ug2_cost)
+        if self.keep_trials:
+            self.deficits.append(deficit)
+            self.victors.append(victor)
+            self.losers.append(loser)
+            self.ug1_costs.append(ug1_cost)
+            self.ug2_costs.append(ug2_cost)
+
+    @profiling.profiled("stats_aggregation")
+    def add_batch(self, signed_deficits, ug1_costs, ug2_costs) -> None:
+        # NumPy arrays of trials, signed deficits are UG1 total - UG2 total
+        self.accumulator.add_batch(signed_deficits, ug1_costs, ug2_costs)
+        if self.keep_trials:
+            import numpy as np
+            # Indexed by sign(deficit) + 1
+            victors = np.array([self.ug2.uid, None, self.ug1.uid],
+                               dtype=object)
+            losers = np.array([self.ug1.uid, None, self.ug2.uid],
+                              dtype=object)
+            signs = np.sign(signed_deficits) + 1
+            self.deficits.extend(np.abs(signed_deficits).tolist())
+            self.victors.extend(victors[signs].tolist())
+            self.losers.extend(losers[signs].tolist())
+            self.ug1_costs.extend(ug1_costs.tolist())
+            self.ug2_costs.extend(ug2_costs.tolist())
+
+    def merge(self, other: "SimulationStats") -> None:
+        # Combine trials of the same matchup run in another shard
+        self.accumulator.merge(other.accumulator)
+        if self.keep_trials and other.keep_trials:
+            self.deficits.extend(other.deficits)
+            self.victors.extend(other.victors)
+            self.losers.extend(other.losers)
+            self.ug1_costs.extend(other.ug1_costs)
+            self.ug2_costs.extend(other.ug2_costs)
+        else:
+            self.deficits = self.victors = self.losers = None
+            self.ug1_costs = self.ug2_costs = None
+
+    def confidence_intervals(self, target="win_probability",
+                             confidence=0.95) -> Dict[str, Tuple[float, float]]:
+        # Intervals for both sides' win probabilities or average costs
+        acc = self.accumulator
+        if target == "win_probability":
+            return {"ug1_win": acc.win_interval(1, confidence),
+                    "ug2_win": acc.win_interval(2, confidence)}
+        if target == "cost":
+            return {"ug1_cost": acc.cost_interval(1, confidence),
+                    "ug2_cost": acc.cost_interval(2, confidence)}
+        raise ValueError(f"Unknown precision target '{target}'")
 
     def compute_summary_stats(self):
-        self.num_trials = len(self.deficits)
+        acc = self.accumulator
+        self.num_trials = acc.num_trials
         # Calculate victories (there might be draws)
-        self.num_ug1_victories = sum([v == self.ug1.uid for v in self.victors])
-        self.num_ug2_victories = sum([v == self.ug2.uid for v in self.victors])
+        self.num_ug1_victories = acc.num_ug1_victories
+        self.num_ug2_victories = acc.num_ug2_victories
         # Average roll deficit
-        self.average_roll_deficit = sum(self.deficits) / self.num_trials
+        self.average_roll_deficit = acc.deficit_sum / self.num_trials
         # Average renown costs overall and for losses
-        self.average_ug1_cost = sum(self.ug1_costs) / self.num_trials
-        self.average_ug2_cost = sum(self.ug2_costs) / self.num_trials
-        # UG1 Loss Cost
-        average_ug1_loss_cost = 0
-        count = 0
-        for i, c in enumerate(self.ug1_costs):
-            if self.losers[i] == self.ug1.uid:
-                average_ug1_loss_cost += c
-                count += 1
-        if count == 0:
+        self.average_ug1_cost = acc.ug1_cost_sum / self.num_trials
+        self.average_ug2_cost = acc.ug2_cost_sum / self.num_trials
+        # UG1 loses whenever UG2 wins and vice versa
+        if self.num_ug2_victories == 0:
             self.average_ug1_loss_cost = 0
         else:
-            self.average_ug1_loss_cost = average_ug1_loss_cost / count
-        # UG2 Loss Cost
-        average_ug2_loss_cost = 0
-        count = 0
-        for i, c in enumerate(self.ug2_costs):
-            if self.losers[i] == self.ug2.uid:
-                average_ug2_loss_cost += c
-                count += 1
-        if count == 0:
+            self.average_ug1_loss_cost = acc.ug1_loss_cost_sum /\
+                self.num_ug2_victories
+        if self.num_ug1_victories == 0:
             self.average_ug2_loss_cost = 0
         else:
-            self.average_ug2_loss_cost = average_ug2_loss_cost / count
+            self.average_ug2_loss_cost = acc.ug2_loss_cost_sum /\
+                self.num_ug1_victories
 
     def generate_summary(self) -> str:
         self.compute_summary_stats()  # make sure things are updated
@@ -70,75 +295,85 @@ class SimulationStats():
 
         return summary
 
+    @profiling.profiled("stats_writing")
     def write_summary(self, f: TextIOWrapper) -> None:
         # Generates summary and dumps it to f
         summary = self.generate_summary()
         f.write(summary)
 
+    def summary_values(self) -> list:
+        # Values of SUMMARY_COLUMNS, in order
+        self.compute_summary_stats()
+        sim_uid = f"{self.num_trials}-{self.ug1.uid}-{self.ug2.uid}"
+        return [sim_uid, self.num_trials, self.num_ug1_victories,
+                self.num_ug2_victories, self.average_roll_deficit,
+                self.average_ug1_cost, self.average_ug2_cost,
+                self.average_ug1_loss_cost, self.average_ug2_loss_cost]
+
     def generate_csv_header(self) -> str:
         # Convenience function for getting the column names of the rows
-        columns = ["sim_uid", "num_trials", "num_ug1_victories",
-                   "num_ug2_victories", "avg_roll_deficit", "avg_ug1_cost",
-                   "avg_ug2_cost", "avg_ug1_loss_cost", "avg_ug2_loss_cost"]
-        unit_attributes = ["name", "kind", "modifiers", "cost"]
-        for i in range(3):
-            for attr in unit_attributes:
-                columns.append(f"ug1_{i+1}_{attr}")
-        for i in range(3):
-            for attr in unit_attributes:
-                columns.append(f"ug2_{i+1}_{attr}")
-
-        return ",".join(columns)
+        return ",".join(SUMMARY_COLUMNS + unit_columns())
 
+    @profiling.profiled("stats_writing")
     def generate_csv_row(self) -> str:
         # Generate a row to be saved in a CSV and loaded later for plotting
         # This does not save everything, just the UIDs, unit attributes and
         # battle simulation statistics
         # columns: [sim_uid, [sim_stats], [ug1 attributes], [ug2 attributes]]
-        sim_uid = f"{self.num_trials}-{self.ug1.uid}-{self.ug2.uid}"
-        csv_row = f"{sim_uid},{self.num_trials},{self.num_ug1_victories}," +\
-            f"{self.num_ug2_victories},{self.average_roll_deficit}," +\
-            f"{self.average_ug1_cost},{self.average_ug2_cost}," +\
-            f"{self.average_ug1_loss_cost},{self.average_ug2_loss_cost},"
-        unit_attributes = ["name", "kind", "modifiers", "cost"]
-        for i in range(3):
-            try:
-                unit = self.ug1.units[i]
-                for attr in unit_attributes:
-                    csv_row += f"{unit[attr]},"
-            except IndexError:
-                csv_row += ","*len(unit_attributes)
-                continue
-        for i in range(3):
-            try:
-                unit = self.ug2.units[i]
-                for attr in unit_attributes:
-                    csv_row += f"{unit[attr]},"
-            except IndexError:
-                csv_row += ","*len(unit_attributes)
-                continue
-        csv_row.rstrip(",")
-
-        return csv_row
+        # For many rows, 'fatesim.results.write_results' stores the same
+        # columns in a typed binary format
+        fields = [str(v) for v in self.summary_values()]
+        for ug in (self.ug1, self.ug2):
+            for i in range(MAX_GROUP_SIZE):
+                if i < len(ug.units):
+                    fields.extend(str(ug.units[i][attr])
+                                  for attr in UNIT_ATTRIBUTES)
+                else:
+                    fields.extend([""]*len(UNIT_ATTRIBUTES))
+        # Rows have always ended with a trailing comma
+        return ",".join(fields) + ","
 
 
 # Simulate the same battle N times, get summary statistics
+@profiling.profiled("simulate_n_stats")
 def simulate_n_stats(ug1: UnitGroup, ug2: UnitGroup,
-                     is_open: bool, n=100):
-    sim_stats = SimulationStats.blank()
+                     is_open: bool, n=100, vectorized=False, seed=None,
+                     keep_trials=False, dice=None, extra_modifiers=(0, 0),
+                     precision=None, target="win_probability"):
+    # 'vectorized' rolls all trials at once with NumPy (see
+    # 'fatesim.batch'), 'seed' only applies to the vectorized engine; the
+    # per-trial loop below is the reference implementation, rolling from
+    # 'dice' (a 'fatesim.dice.DiceSource', the global 'random' by default)
+    # 'keep_trials' also stores every trial's results in lists
+    # 'extra_modifiers' are added to each side's modifier ('simulate_battle')
+    # With a 'precision', trials are sampled with the vectorized engine
+    # until the 'target' intervals are that tight, using at most 'n' (see
+    # 'fatesim.batch.simulate_to_precision')
+    if precision is not None:
+        from fatesim.batch import simulate_to_precision
+        return simulate_to_precision(ug1, ug2, is_open, precision, target,
+                                     max_trials=n, seed=seed,
+                                     keep_trials=keep_trials,
+                                     extra_modifiers=extra_modifiers)
+    if vectorized:
+        from fatesim.batch import simulate_n_stats_vectorized
+        return simulate_n_stats_vectorized(ug1, ug2, is_open, n=n, seed=seed,
+                                           keep_trials=keep_trials,
+                                           extra_modifiers=extra_modifiers)
+
+    sim_stats = SimulationStats.blank(keep_trials)
     sim_stats.ug1 = ug1
     sim_stats.ug2 = ug2
     for i in range(n):
-        result = simulate_battle(ug1, ug2, is_open)
+        result = simulate_battle(ug1, ug2, is_open, dice, extra_modifiers)
         new_ug1 = UnitGroup(determine_new_units(ug1, result),
                             f"{ug1.uid}_n")
         new_ug2 = UnitGroup(determine_new_units(ug2, result),
                             f"{ug2.uid}_n")
 
-        sim_stats.deficits.append(result.deficit)
-        sim_stats.victors.append(result.victor)
-        sim_stats.losers.append(result.loser)
-        sim_stats.ug1_costs.append(renown_difference(ug1, new_ug1))
-        sim_stats.ug2_costs.append(renown_difference(ug2, new_ug2))
+        sim_stats.add_trial(result.deficit, result.victor, result.loser,
+                            renown_difference(ug1, new_ug1),
+                            renown_difference(ug2, new_ug2),
+                            result.victor_side)
 
     return sim_stats
@@ -0,0 +1,144 @@
+from itertools import combinations_with_replacement, permutations
+from typing import Iterable, Iterator, List, Tuple
+import os
+
+from fatesim.stats import SimulationStats, simulate_n_stats
+from fatesim.unit import UNIT_TEMPLATES, UnitGroup, unit_group_from_templates
+
+# Battle types swept by default: open, then structure
+BATTLE_TYPES = (True, False)
+
+
+class SweepTask():
+    # One matchup and battle type, with its own seed so results do not
+    # depend on which worker runs it or in which order
+    def __init__(self, index: int, ug1: UnitGroup, ug2: UnitGroup,
+                 is_open: bool, num_trials: int,
+                 seed: "np.random.SeedSequence", precision=None,
+                 target="win_probability") -> None:
+        self.index = index
+        self.ug1 = ug1
+        self.ug2 = ug2
+        self.is_open = is_open
+        self.num_trials = num_trials
+        self.seed = seed
+        # With a 'precision', 'num_trials' caps sequential sampling
+        self.precision = precision
+        self.target = target
+
+
+def template_compositions(max_size=3, templates=None) -> List[Tuple[str]]:
+    # Every unit group of 1 to 'max_size' templates, ignoring order
+    names = sorted(UNIT_TEMPLATES if templates is None else templates)
+    compositions = []
+    for size in range(1, max_size + 1):
+        compositions.extend(combinations_with_replacement(names, size))
+    return compositions
+
+
+def all_template_matchups(max_size=3, templates=None) -> List[Tuple[UnitGroup, UnitGroup]]:
+    # Every ordered pair of distinct template compositions. Mirror matchups
+    # are left out: both sides would share a uid, which the reference
+    # engine uses to tell the victor's units from the loser's
+    groups = [unit_group_from_templates(c)
+              for c in template_compositions(max_size, templates)]
+    return list(permutations(groups, 2))
+
+
+def sweep_tasks(matchups: Iterable[Tuple[UnitGroup, UnitGroup]],
+                num_trials=100, seed=0, battle_types=BATTLE_TYPES,
+                precision=None,
+                target="win_probability") -> List[SweepTask]:
+    # Child seeds are spawned from one master seed in task order, so task i
+    # always gets the same stream
+    import numpy as np
+    pairs = [(ug1, ug2, is_open) for ug1, ug2 in matchups
+             for is_open in battle_types]
+    seeds = np.random.SeedSequence(seed).spawn(len(pairs))
+    return [SweepTask(i, ug1, ug2, is_open, num_trials, task_seed,
+                      precision, target)
+            for i, ((ug1, ug2, is_open), task_seed) in enumerate(zip(pairs,
+                                                                    seeds))]
+
+
+def pair_seed(seed: int, c1: Tuple[str, ...], c2: Tuple[str, ...],
+              is_open: bool) -> "np.random.SeedSequence":
+    # A seed derived from the pair of template compositions itself, so its
+    # stream never depends on what else is being simulated
+    from hashlib import sha1
+    import numpy as np
+    digest = sha1(repr((c1, c2, is_open)).encode()).digest()
+    words = np.frombuffer(digest[:16], dtype="<u4").tolist()
+    return np.random.SeedSequence(seed, spawn_key=tuple(words))
+
+
+def run_task(task: SweepTask) -> Tuple[int, bool, SimulationStats]:
+    if task.precision is not None:
+        from fatesim.batch import simulate_to_precision
+        sim_stats = simulate_to_precision(task.ug1, task.ug2, task.is_open,
+                                          task.precision, task.target,
+                                          max_trials=task.num_trials,
+                                          seed=task.seed)
+        return task.index, task.is_open, sim_stats
+
+    sim_stats = simulate_n_stats(task.ug1, task.ug2, task.is_open,
+                                 n=task.num_trials, vectorized=True,
+                                 seed=task.seed)
+    return task.index, task.is_open, sim_stats
+
+
+def _run_tasks(tasks: List[SweepTask], num_workers: int, ordered: bool,
+               chunksize: int) -> Iterator[Tuple[int, bool, SimulationStats]]:
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+
+    if num_workers == 1:
+        for task in tasks:
+            yield run_task(task)
+        return
+
+    from multiprocessing import Pool
+    with Pool(num_workers) as pool:
+        imap = pool.imap if ordered else pool.imap_unordered
+        for result in imap(run_task, tasks, chunksize=chunksize):
+            yield result
+
+
+def run_sweep(matchups: Iterable[Tuple[UnitGroup, UnitGroup]],
+              num_trials=100, seed=0, battle_types=BATTLE_TYPES,
+              num_workers=None, ordered=False, chunksize=1,
+              cache=None, precision=None, target="win_probability"
+              ) -> Iterator[Tuple[int, bool, SimulationStats]]:
+    # Simulate every matchup for every battle type on a process pool,
+    # yielding (task index, is_open, SimulationStats) as results arrive.
+    # Results are identical for any 'num_workers' given the same 'seed';
+    # 'num_workers' defaults to every core and 1 runs in this process.
+    # With a 'MatchupCache', cached matchups are yielded first without being
+    # simulated and new results are added to it. Entries are keyed on each
+    # task's seed, so a cached result is the one this 'seed' would give.
+    # With a 'precision', each task samples until its 'target' intervals are
+    # that tight (see 'simulate_to_precision') using at most 'num_trials';
+    # such results are not cached since they are not fixed-size runs
+    tasks = sweep_tasks(matchups, num_trials, seed, battle_types, precision,
+                        target)
+    if precision is not None:
+        cache = None
+    if cache is not None:
+        pending = []
+        for task in tasks:
+            sim_stats = cache.get(task.ug1, task.ug2, task.is_open,
+                                  task.num_trials, seed=task.seed)
+            if sim_stats is None:
+                pending.append(task)
+            else:
+                yield task.index, task.is_open, sim_stats
+        tasks = pending
+
+    tasks_by_index = {task.index: task for task in tasks}
+    for index, is_open, sim_stats in _run_tasks(tasks, num_workers, ordered,
+                                                chunksize):
+        if cache is not None and sim_stats is not None:
+            task = tasks_by_index[index]
+            cache.put(task.ug1, task.ug2, is_open, task.num_trials,
+                      sim_stats, seed=task.seed)
+        yield index, is_open, sim_stats
@@ -0,0 +1,241 @@
+from pathlib import Path
+from typing import Dict, List, Tuple
+import json
+import os
+import numpy as np
+
+from fatesim.dice import BufferedDice
+from fatesim.manifest import changed_templates, template_definition
+from fatesim.simulation import simulate_battle
+from fatesim.sweep import BATTLE_TYPES, pair_seed, template_compositions
+from fatesim.unit import UNIT_TEMPLATES, unit_group_from_templates
+
+# Round robin of every template composition against every other, for each
+# battle type, rated with a Bradley-Terry model. Each pair of compositions
+# plays 'num_trials' battles through 'simulate_battle' (or the batched
+# engine with 'vectorized') on a process pool; draws count as half a win
+# for each side. Pair seeds are derived from the pair itself rather than
+# its position in the schedule, so results never depend on which templates
+# were present when a pair was played. That makes updates incremental:
+# 'update' only plays pairs it has no result for - those involving new or
+# changed templates - and refits the ratings starting from the previous
+# ones. Ratings are on the Elo scale (400 * log10 of the strength), where
+# a 200 point gap means the stronger side wins about 76% of the time.
+# Usage:
+#   tournament = Tournament(num_trials=200)
+#   tournament.update()
+#   for uid, elo, win_rate in tournament.standings(is_open=True)[:10]: ...
+
+TOURNAMENT_VERSION = 1
+ELO_SCALE = 400 / np.log(10)
+
+
+def _play(task) -> Tuple[Tuple, float, float, int]:
+    # (pair key, c1 wins, c2 wins, battles), draws split evenly
+    c1, c2, is_open, n, seed, vectorized = task
+    ug1 = unit_group_from_templates(c1)
+    ug2 = unit_group_from_templates(c2)
+    if vectorized:
+        from fatesim.batch import BatchedMatchup
+        matchup = BatchedMatchup.prepare(ug1, ug2, is_open)
+        if matchup is None:
+            return (c1, c2, is_open), 0., 0., 0
+        sim_stats = matchup.blank_stats()
+        matchup.run(sim_stats, np.random.default_rng(seed), n)
+        wins_1 = sim_stats.accumulator.num_ug1_victories
+        wins_2 = sim_stats.accumulator.num_ug2_victories
+    else:
+        dice = BufferedDice(seed)
+        wins_1 = wins_2 = 0
+        for _ in range(n):
+            result = simulate_battle(ug1, ug2, is_open, dice)
+            if result is None:
+                return (c1, c2, is_open), 0., 0., 0
+            if result.units_1_total > result.units_2_total:
+                wins_1 += 1
+            elif result.units_1_total < result.units_2_total:
+                wins_2 += 1
+    draws = n - wins_1 - wins_2
+    return (c1, c2, is_open), wins_1 + draws / 2, wins_2 + draws / 2, n
+
+
+def _log_likelihood(theta, wins, games, prior) -> float:
+    # Bradley-Terry log likelihood of log strengths 'theta', including the
+    # prior games against the virtual player
+    differences = theta[:, None] - theta[None, :]
+    return float((wins * -np.logaddexp(0, -differences)).sum()
+                 + prior * (-np.logaddexp(0, -theta)
+                            - np.logaddexp(0, theta)).sum())
+
+
+def fit_bradley_terry(wins: np.ndarray, log_strengths: np.ndarray = None,
+                      prior=1., tol=1e-9, max_iter=100) -> np.ndarray:
+    # Log strengths from 'wins[i, j]', i's (possibly fractional) wins over
+    # j, by Newton's method on the (concave) log likelihood. Each player
+    # also gets 'prior' wins and losses against a virtual player of strength
+    # 1, which keeps unbeaten or winless players finite and fixes the
+    # scale's origin. 'log_strengths' warm starts the fit
+    games = wins + wins.T
+    theta = np.zeros(len(wins)) if log_strengths is None else\
+        np.array(log_strengths, dtype=np.float64)
+    likelihood = _log_likelihood(theta, wins, games, prior)
+    for _ in range(max_iter):
+        p = 1 / (1 + np.exp(theta[None, :] - theta[:, None]))
+        p_virtual = 1 / (1 + np.exp(-theta))
+        gradient = wins.sum(axis=1) + prior - (games * p).sum(axis=1)\
+            - 2 * prior * p_virtual
+        weights = games * p * (1 - p)
+        hessian = weights - np.diag(weights.sum(axis=1)
+                                    + 2 * prior * p_virtual * (1 - p_virtual))
+        step = np.linalg.solve(hessian, -gradient)
+        # Halve the step until the likelihood improves
+        scale = 1.
+        while True:
+            new_theta = theta + scale * step
+            new_likelihood = _log_likelihood(new_theta, wins, games, prior)
+            if new_likelihood >= likelihood or scale < 1e-6:
+                break
+            scale /= 2
+        theta, likelihood = new_theta, new_likelihood
+        if np.abs(scale * step).max() < tol:
+            break
+    return theta
+
+
+class Tournament():
+    def __init__(self, max_size=3, num_trials=100, seed=0,
+                 battle_types=BATTLE_TYPES, vectorized=False) -> None:
+        self.max_size = max_size
+        self.num_trials = num_trials
+        self.seed = seed
+        self.battle_types = tuple(battle_types)
+        self.vectorized = vectorized
+        # Template name -> 'template_definition' when its pairs were played
+        self.templates = {}
+        # (c1, c2, is_open) -> (c1 wins, c2 wins, battles), with c1 < c2
+        self.results = {}
+        # is_open -> {composition: log strength}
+        self.ratings = {is_open: {} for is_open in self.battle_types}
+
+    def compositions(self) -> List[Tuple[str, ...]]:
+        return template_compositions(self.max_size, sorted(self.templates))
+
+    def pending(self, templates=None) -> List[Tuple]:
+        # Pairs 'update(templates)' would play
+        names = sorted(UNIT_TEMPLATES if templates is None else templates)
+        compositions = template_compositions(self.max_size, names)
+        stale = set(changed_templates({"templates": self.templates}, names))
+        pairs = []
+        for i, c1 in enumerate(compositions):
+            for c2 in compositions[i + 1:]:
+                # Keys are ordered so adding templates never flips a pair
+                first, second = min(c1, c2), max(c1, c2)
+                for is_open in self.battle_types:
+                    key = (first, second, is_open)
+                    if key not in self.results or\
+                            stale & (set(c1) | set(c2)):
+                        pairs.append(key)
+        return pairs
+
+    def update(self, templates=None, num_workers=None, chunksize=16) -> int:
+        # Bring the tournament up to date with 'templates' (default all of
+        # UNIT_TEMPLATES), playing only missing or stale pairs, then refit
+        # the ratings. Returns the number of pairs played
+        names = sorted(UNIT_TEMPLATES if templates is None else templates)
+        pairs = self.pending(names)
+        stale = set(changed_templates({"templates": self.templates}, names))
+        self.results = {key: result for key, result in self.results.items()
+                        if set(key[0]).issubset(names)
+                        and set(key[1]).issubset(names)
+                        and not stale & (set(key[0]) | set(key[1]))}
+        self.templates = {name: template_definition(name) for name in names}
+
+        tasks = [(c1, c2, is_open, self.num_trials,
+                  pair_seed(self.seed, c1, c2, is_open), self.vectorized)
+                 for c1, c2, is_open in pairs]
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        if num_workers == 1 or len(tasks) <= 1:
+            self._record(map(_play, tasks))
+        else:
+            from multiprocessing import Pool
+            with Pool(num_workers) as pool:
+                self._record(pool.imap_unordered(_play, tasks,
+                                                 chunksize=chunksize))
+        self.fit()
+        return len(tasks)
+
+    def _record(self, played) -> None:
+        for key, wins_1, wins_2, n in played:
+            self.results[key] = (wins_1, wins_2, n)
+
+    def win_matrix(self, is_open: bool) -> np.ndarray:
+        # (compositions, compositions) wins, in 'compositions' order
+        index = {c: i for i, c in enumerate(self.compositions())}
+        wins = np.zeros((len(index), len(index)))
+        for (c1, c2, key_open), (wins_1, wins_2, _) in self.results.items():
+            if key_open == is_open:
+                wins[index[c1], index[c2]] = wins_1
+                wins[index[c2], index[c1]] = wins_2
+        return wins
+
+    def fit(self) -> None:
+        # Refit every battle type's ratings, starting from the last fit
+        # (new compositions start at the scale's origin)
+        compositions = self.compositions()
+        for is_open in self.battle_types:
+            previous = self.ratings[is_open]
+            start = np.array([previous.get(c, 0.) for c in compositions])
+            log_strengths = fit_bradley_terry(self.win_matrix(is_open), start)
+            self.ratings[is_open] = dict(zip(compositions,
+                                             log_strengths.tolist()))
+
+    def elo(self, is_open: bool) -> Dict[Tuple[str, ...], float]:
+        return {c: float(ELO_SCALE * s)
+                for c, s in self.ratings[is_open].items()}
+
+    def standings(self, is_open: bool) -> List[Tuple[str, float, float]]:
+        # (uid, Elo rating, round robin win rate), strongest first
+        compositions = self.compositions()
+        wins = self.win_matrix(is_open)
+        games = wins + wins.T
+        with np.errstate(invalid="ignore"):
+            win_rates = wins.sum(axis=1) / games.sum(axis=1)
+        elo = self.elo(is_open)
+        rows = [(unit_group_from_templates(c).uid, elo[c], float(rate))
+                for c, rate in zip(compositions, win_rates)]
+        return sorted(rows, key=lambda row: -row[1])
+
+    def save(self, path) -> None:
+        data = {"version": TOURNAMENT_VERSION, "max_size": self.max_size,
+                "num_trials": self.num_trials, "seed": self.seed,
+                "battle_types": list(self.battle_types),
+                "vectorized": self.vectorized, "templates": self.templates,
+                "results": [[list(c1), list(c2), is_open, *result]
+                            for (c1, c2, is_open), result
+                            in self.results.items()],
+                "ratings": {str(is_open): [[list(c), s]
+                                           for c, s in ratings.items()]
+                            for is_open, ratings in self.ratings.items()}}
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        if data.get("version") != TOURNAMENT_VERSION:
+            raise ValueError(f"{path} has an unsupported tournament version")
+        tournament = cls(data["max_size"], data["num_trials"], data["seed"],
+                         data["battle_types"], data["vectorized"])
+        tournament.templates = data["templates"]
+        tournament.results = {(tuple(c1), tuple(c2), is_open): (w1, w2, n)
+                              for c1, c2, is_open, w1, w2, n
+                              in data["results"]}
+        tournament.ratings = {is_open: {tuple(c): s for c, s
+                                        in data["ratings"][str(is_open)]}
+                              for is_open in tournament.battle_types}
+        return tournament
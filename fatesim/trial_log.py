@@ -0,0 +1,260 @@
+from pathlib import Path
+from typing import Iterable, Tuple
+import os
+import numpy as np
+
+from fatesim.batch import count_combat_dice
+from fatesim.simulation import (allocate_casualties, determine_new_units,
+                                determine_total_modifier, simulate_battle)
+from fatesim.stats import MAX_GROUP_SIZE
+from fatesim.unit import UnitGroup
+
+try:
+    import fcntl
+except ImportError:  # no file locks, e.g. on Windows
+    fcntl = None
+
+# Append-only log of individual trials as fixed-width binary records, for
+# when summaries are not enough (deficit tails, replaying battles). Workers
+# append whole chunks of records under an exclusive file lock, so any
+# number of processes can write to one log; readers map it with
+# 'open_trial_log' and filter or aggregate without loading it:
+#   log = open_trial_log("trials.bin")
+#   tail = log[(log["matchup"] == 7) & (log["deficit"] <= -10)]
+# Dice are listed in unit order (military units only, 0 for no die) for the
+# first MAX_GROUP_SIZE units; 'roll' is the sum of all of a side's dice.
+# The casualty outcome is what 'determine_new_units' leaves of each side:
+# renown lost, units killed and how many of the survivors are bloodied
+
+MAGIC = b"FSTRIALS"
+LOG_VERSION = 1
+HEADER_SIZE = 64
+RECORD_DTYPE = np.dtype([
+    ("matchup", "<u4"), ("is_open", "u1"), ("victor", "i1"),
+    ("dice_1", "u1", (MAX_GROUP_SIZE,)), ("dice_2", "u1", (MAX_GROUP_SIZE,)),
+    ("roll_1", "<i2"), ("roll_2", "<i2"),
+    ("modifier_1", "<i2"), ("modifier_2", "<i2"),
+    # UG1 total - UG2 total; victor is 1 (UG1), 2 (UG2) or 0 (draw)
+    ("deficit", "<i2"),
+    ("cost_1", "<i2"), ("cost_2", "<i2"),
+    ("killed_1", "u1"), ("killed_2", "u1"),
+    ("bloodied_1", "u1"), ("bloodied_2", "u1"),
+])
+DEFAULT_BUFFER_RECORDS = 1 << 16
+
+
+def _header() -> bytes:
+    header = MAGIC + np.array([LOG_VERSION, RECORD_DTYPE.itemsize],
+                              dtype="<u4").tobytes()
+    return header.ljust(HEADER_SIZE, b"\0")
+
+
+class TrialLogWriter():
+    # Buffers records and appends them to 'path' in chunks; each chunk is
+    # written under the lock, so it stays contiguous in the log
+    def __init__(self, path, buffer_records=DEFAULT_BUFFER_RECORDS) -> None:
+        self.path = Path(path)
+        self.buffer_records = buffer_records
+        self._chunks = []
+        self._buffered = 0
+        self.records_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+        return False
+
+    def append(self, records: np.ndarray) -> None:
+        self._chunks.append(np.asarray(records, dtype=RECORD_DTYPE))
+        self._buffered += len(records)
+        if self._buffered >= self.buffer_records:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._chunks:
+            return
+        data = np.concatenate(self._chunks).tobytes()
+        with open(self.path, "ab") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                # The position is from when the file was opened; another
+                # writer may have appended (and written the header) since
+                f.seek(0, os.SEEK_END)
+                if f.tell() == 0:
+                    f.write(_header())
+                f.write(data)
+                f.flush()
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+        self.records_written += self._buffered
+        self._chunks = []
+        self._buffered = 0
+
+
+def open_trial_log(path, mode="r") -> np.memmap:
+    # The log's records as a structured memmap (no data is read up front)
+    path = Path(path)
+    with open(path, "rb") as f:
+        header = f.read(HEADER_SIZE)
+    if header[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a trial log")
+    version, record_size = np.frombuffer(header[len(MAGIC):len(MAGIC) + 8],
+                                         dtype="<u4").tolist()
+    if version != LOG_VERSION or record_size != RECORD_DTYPE.itemsize:
+        raise ValueError(f"{path} has an unsupported trial log version")
+    # Ignore a record a writer is still in the middle of
+    count = (path.stat().st_size - HEADER_SIZE) // record_size
+    if count == 0:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode=mode,
+                     offset=HEADER_SIZE, shape=(count,))
+
+
+def casualty_outcome_table(ug: UnitGroup, max_deficit: int) -> np.ndarray:
+    # (renown lost, units killed, bloodied survivors) when 'ug' loses by
+    # each deficit in [0, max_deficit], from the reference casualty rules
+    value = ug.renown_value()
+    table = np.zeros((max_deficit + 1, 3), dtype=np.int64)
+    table[0] = (0, 0, sum(u.is_bloodied for u in ug.units))
+    for deficit in range(1, max_deficit + 1):
+        new_units = allocate_casualties(ug.units, deficit)
+        table[deficit] = (value - sum(u.renown_value() for u in new_units),
+                          len(ug.units) - len(new_units),
+                          sum(u.is_bloodied for u in new_units))
+        if deficit // 6 >= len(ug.units):
+            # Killed outright, as by every larger deficit
+            table[deficit:] = table[deficit]
+            break
+    return table
+
+
+def _casualty_outcome(ug: UnitGroup, new_units) -> Tuple[int, int, int]:
+    return (ug.renown_value() - sum(u.renown_value() for u in new_units),
+            len(ug.units) - len(new_units),
+            sum(u.is_bloodied for u in new_units))
+
+
+def log_trials(writer: TrialLogWriter, matchup: int, ug1: UnitGroup,
+               ug2: UnitGroup, is_open: bool, n=100, dice=None) -> None:
+    # Reference engine: 'n' trials of 'simulate_battle' and
+    # 'determine_new_units', one record each
+    records = np.zeros(n, dtype=RECORD_DTYPE)
+    records["matchup"] = matchup
+    records["is_open"] = is_open
+    for i in range(n):
+        result = simulate_battle(ug1, ug2, is_open, dice)
+        if result is None:
+            return
+        record = records[i]
+        record["dice_1"][:len(result.units_1_dice[:MAX_GROUP_SIZE])] =\
+            result.units_1_dice[:MAX_GROUP_SIZE]
+        record["dice_2"][:len(result.units_2_dice[:MAX_GROUP_SIZE])] =\
+            result.units_2_dice[:MAX_GROUP_SIZE]
+        record["roll_1"] = sum(result.units_1_dice)
+        record["roll_2"] = sum(result.units_2_dice)
+        record["modifier_1"] = result.units_1_modifier
+        record["modifier_2"] = result.units_2_modifier
+        deficit = result.units_1_total - result.units_2_total
+        record["deficit"] = deficit
+        record["victor"] = 1 if deficit > 0 else 2 if deficit < 0 else 0
+        (record["cost_1"], record["killed_1"], record["bloodied_1"]) =\
+            _casualty_outcome(ug1, determine_new_units(ug1, result))
+        (record["cost_2"], record["killed_2"], record["bloodied_2"]) =\
+            _casualty_outcome(ug2, determine_new_units(ug2, result))
+    writer.append(records)
+
+
+def _roll_unit_dice(rng: np.random.Generator, ug: UnitGroup,
+                    n: int) -> np.ndarray:
+    # (n, military units) dice in unit order
+    faces = np.array([3 if u.is_bloodied else 6 for u in ug.units
+                      if u.has_military])
+    return rng.integers(1, faces + 1, size=(n, len(faces)))
+
+
+def log_trials_vectorized(writer: TrialLogWriter, matchup: int,
+                          ug1: UnitGroup, ug2: UnitGroup, is_open: bool,
+                          n=100, seed=None,
+                          batch_size=DEFAULT_BUFFER_RECORDS) -> None:
+    # Batched equivalent of 'log_trials'
+    if not sum(count_combat_dice(ug1.units)) or\
+            not sum(count_combat_dice(ug2.units)):
+        print("Both units_1 and units_2 must be non-empty")
+        return
+    rng = np.random.default_rng(seed)
+    modifier_1 = determine_total_modifier(ug1, ug2, is_open)
+    modifier_2 = determine_total_modifier(ug2, ug1, is_open)
+    max_deficit = 6 * (len(ug1.units) + len(ug2.units)) +\
+        abs(modifier_1 - modifier_2)
+    outcomes_1 = casualty_outcome_table(ug1, max_deficit)
+    outcomes_2 = casualty_outcome_table(ug2, max_deficit)
+    for start in range(0, n, batch_size):
+        size = min(batch_size, n - start)
+        dice_1 = _roll_unit_dice(rng, ug1, size)
+        dice_2 = _roll_unit_dice(rng, ug2, size)
+        records = np.zeros(size, dtype=RECORD_DTYPE)
+        records["matchup"] = matchup
+        records["is_open"] = is_open
+        records["dice_1"][:, :dice_1.shape[1]] = dice_1[:, :MAX_GROUP_SIZE]
+        records["dice_2"][:, :dice_2.shape[1]] = dice_2[:, :MAX_GROUP_SIZE]
+        roll_1, roll_2 = dice_1.sum(axis=1), dice_2.sum(axis=1)
+        records["roll_1"], records["roll_2"] = roll_1, roll_2
+        records["modifier_1"], records["modifier_2"] = modifier_1, modifier_2
+        deficits = roll_1 + modifier_1 - roll_2 - modifier_2
+        records["deficit"] = deficits
+        records["victor"] = np.where(deficits > 0, 1,
+                                     np.where(deficits < 0, 2, 0))
+        for side, outcomes, losses in ((1, outcomes_1, -deficits),
+                                       (2, outcomes_2, deficits)):
+            outcome = outcomes[np.maximum(losses, 0)]
+            records[f"cost_{side}"] = outcome[:, 0]
+            records[f"killed_{side}"] = outcome[:, 1]
+            records[f"bloodied_{side}"] = outcome[:, 2]
+        writer.append(records)
+
+
+def _log_task(task) -> int:
+    path, matchup, ug1, ug2, is_open, n, seed = task
+    with TrialLogWriter(path) as writer:
+        log_trials_vectorized(writer, matchup, ug1, ug2, is_open, n, seed)
+    return writer.records_written
+
+
+def log_sweep(path, matchups: Iterable[Tuple[UnitGroup, UnitGroup]],
+              num_trials=100, seed=0, battle_types=(True, False),
+              num_workers=None) -> int:
+    # Log every trial of a sweep, with the same task order and seeds as
+    # 'run_sweep' (the record 'matchup' is the task index). Workers append
+    # to the log in parallel. Returns the number of records written
+    from multiprocessing import Pool
+    from fatesim.sweep import sweep_tasks
+    tasks = [(str(path), t.index, t.ug1, t.ug2, t.is_open, t.num_trials,
+              t.seed)
+             for t in sweep_tasks(matchups, num_trials, seed, battle_types)]
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    if num_workers == 1:
+        return sum(map(_log_task, tasks))
+    with Pool(num_workers) as pool:
+        return sum(pool.imap_unordered(_log_task, tasks))
+
+
+def deficit_histogram(log: np.ndarray, matchup=None,
+                      chunk_size=1 << 24) -> Tuple[np.ndarray, np.ndarray]:
+    # (signed deficits, counts) over the whole log or one matchup, read in
+    # chunks so memory stays bounded however large the log is
+    counts = {}
+    for start in range(0, len(log), chunk_size):
+        chunk = log[start:start + chunk_size]
+        deficits = chunk["deficit"] if matchup is None else\
+            chunk["deficit"][chunk["matchup"] == matchup]
+        values, chunk_counts = np.unique(deficits, return_counts=True)
+        for v, c in zip(values.tolist(), chunk_counts.tolist()):
+            counts[v] = counts.get(v, 0) + c
+    values = np.array(sorted(counts), dtype=np.int64)
+    return values, np.array([counts[v] for v in values.tolist()],
+                            dtype=np.int64)
@@ -1,8 +1,7 @@
 from typing import List
-from fatesim.modifier import Modifier, combine_modifiers
+from fatesim.modifier import UNIT_KINDS, Modifier, combine_modifiers, kind_mask
 
 
-UNIT_KINDS = ["infantry", "cavalry", "naval", "siege"]
 UNIT_COSTS = {
     # for now just renown cost, but for the AI to figure out what to kill
     "infantry": 5,
@@ -63,6 +62,24 @@ class Unit:
     def __getitem__(self, key: str):
         return self.data_dict[key]
 
+    def __deepcopy__(self, memo):
+        # Same copy as the generic deepcopy (casualty allocation copies
+        # every surviving unit), without walking each attribute: the rest
+        # are numbers and strings
+        new = type(self).__new__(type(self))
+        memo[id(self)] = new
+        new.__dict__.update(self.__dict__)
+        new.bonuses_strs = self.bonuses_strs[:]
+        modifiers = []
+        for m in self.modifiers:
+            copied = memo.get(id(m))
+            if copied is None:
+                copied = memo[id(m)] = Modifier(m.bonus, m.target)
+            modifiers.append(copied)
+        new.modifiers = modifiers
+        new.data_dict = dict(self.data_dict)
+        return new
+
     def renown_value(self):
         # Renown value is cost, halved if unit is bloodied
         value = self.cost
@@ -85,6 +102,9 @@ class UnitGroup():
         self.uid = uid
         self.modifiers = combine_modifiers([m for u in units
                                            for m in u.modifiers])
+        # Total modifier against (opposing kind mask, is_open), filled in by
+        # 'total_modifier'
+        self._modifier_table = {}
 
     def __str__(self) -> str:
         desc = "\n\n".join([str(unit) for unit in self.units])
@@ -94,6 +114,21 @@ class UnitGroup():
             desc += "\n\t".join(str(ug_mod) for ug_mod in self.modifiers)
         return desc
 
+    @property
+    def kind_mask(self) -> int:
+        return kind_mask(u.kind for u in self.units)
+
+    def total_modifier(self, opposing_kind_mask: int, is_open: bool) -> int:
+        # Sum of group modifiers that apply against the opposing kinds,
+        # memoized since 'modifiers' is fixed at construction
+        key = (opposing_kind_mask, is_open)
+        total = self._modifier_table.get(key)
+        if total is None:
+            total = sum(m.bonus for m in self.modifiers
+                        if m.applies_to(opposing_kind_mask, is_open))
+            self._modifier_table[key] = total
+        return total
+
     def renown_value(self):
         if not self.units:
             return 0  # no units left
@@ -130,3 +165,17 @@ UNIT_TEMPLATES = {
                                                    "+3 all struct"],
                                 name="Basic Siege"),
 }
+
+
+def template_abbreviation(template_name: str) -> str:
+    # e.g. "basic_infantry" -> "BI"
+    return "".join(word[0].capitalize() for word in template_name.split("_"))
+
+
+def unit_group_from_templates(template_names, uid=None) -> UnitGroup:
+    # Build a unit group from UNIT_TEMPLATES keys, named after the templates
+    # (e.g. "BI_BS_BI") unless 'uid' is given
+    units = [UNIT_TEMPLATES[name]() for name in template_names]
+    if uid is None:
+        uid = "_".join(template_abbreviation(name) for name in template_names)
+    return UnitGroup(units, uid)
@@ -5,7 +5,7 @@ import random
 
 # Generic utilities
 def clamp(value, minv, maxv):
-    max(min(value, maxv), minv)
+    return max(min(value, maxv), minv)
 
 
 # Utilities for bonuses and modifiers
@@ -1,3 +1,323 @@
-# TODO:
-# - port the combat viz tool from PF2 into here so we can look at a
-# campaign's progression over time
+from pathlib import Path
+from typing import Dict, List, Sequence
+import argparse
+import numpy as np
+
+# Plots of sweep results and campaign progression. Everything is aggregated
+# and downsampled with NumPy first, so the plotting libraries only ever see
+# a few hundred cells or points per trace however large the sweep:
+#   - 'matchup_grid' turns a sweep (results file, column dict or
+#     SimulationStats) into a 'MatchupGrid' of per-composition totals
+#   - 'MatchupGrid.downsample' merges neighbouring compositions into blocks;
+#     totals are summed, so block win rates and loss costs stay exact
+#   - 'plot_matchup_heatmaps' and 'plot_campaign' draw with matplotlib or
+#     write a standalone plotly HTML file
+# matplotlib and plotly are optional (the 'viz' extra) and only imported
+# when drawing. Usage:
+#   python -m fatesim.viz results.parquet --out heatmaps.html
+
+MATCHUP_METRICS = ("win_rate", "ug1_loss_cost", "ug2_loss_cost")
+METRIC_TITLES = {"win_rate": "UG1 win rate",
+                 "ug1_loss_cost": "UG1 average loss cost",
+                 "ug2_loss_cost": "UG2 average loss cost"}
+CAMPAIGN_METRICS = ("renown", "fate", "prosperity", "happiness",
+                    "settlements", "units")
+_GRID_COLUMNS = ("sim_uid", "num_trials", "num_ug1_victories",
+                 "num_ug2_victories", "avg_ug1_loss_cost",
+                 "avg_ug2_loss_cost")
+
+
+class MatchupGrid():
+    # Sweep totals over (UG1 composition, UG2 composition). Averages are
+    # kept as sums so merging cells is just addition
+    def __init__(self, labels: List[str], trials: np.ndarray,
+                 ug1_wins: np.ndarray, ug2_wins: np.ndarray,
+                 ug1_loss_cost_sum: np.ndarray,
+                 ug2_loss_cost_sum: np.ndarray) -> None:
+        self.labels = list(labels)
+        self.trials = trials
+        self.ug1_wins = ug1_wins
+        self.ug2_wins = ug2_wins
+        self.ug1_loss_cost_sum = ug1_loss_cost_sum
+        self.ug2_loss_cost_sum = ug2_loss_cost_sum
+
+    @property
+    def size(self) -> int:
+        return len(self.labels)
+
+    def metric(self, name: str) -> np.ndarray:
+        # (size, size) values, NaN where there is nothing to average
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if name == "win_rate":
+                return self.ug1_wins / self.trials
+            if name == "ug1_loss_cost":
+                return self.ug1_loss_cost_sum / self.ug2_wins
+            if name == "ug2_loss_cost":
+                return self.ug2_loss_cost_sum / self.ug1_wins
+        raise ValueError(f"Unknown metric {name}, expected one of "
+                         f"{MATCHUP_METRICS}")
+
+    def strength(self) -> np.ndarray:
+        # Each composition's win rate over every matchup it fought, as UG1
+        # and as UG2
+        wins = self.ug1_wins.sum(axis=1) + self.ug2_wins.sum(axis=0)
+        trials = self.trials.sum(axis=1) + self.trials.sum(axis=0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return wins / trials
+
+    def reordered(self, order: Sequence[int]) -> "MatchupGrid":
+        order = np.asarray(order)
+        return MatchupGrid([self.labels[i] for i in order],
+                           *(a[np.ix_(order, order)] for a in self._totals()))
+
+    def sorted_by_strength(self) -> "MatchupGrid":
+        # Weakest first, so blocks of 'downsample' group similar strengths
+        strength = np.nan_to_num(self.strength(), nan=-1.)
+        return self.reordered(np.argsort(strength, kind="stable"))
+
+    def downsample(self, max_size=200) -> "MatchupGrid":
+        # Merge runs of consecutive compositions into at most 'max_size'
+        # blocks a side
+        if self.size <= max_size:
+            return self
+        starts = np.linspace(0, self.size, max_size + 1).astype(np.int64)[:-1]
+        starts = np.unique(starts)
+        ends = np.append(starts[1:], self.size)
+        labels = [self.labels[s] if e - s == 1
+                  else f"{self.labels[s]}..{self.labels[e - 1]}"
+                  for s, e in zip(starts, ends)]
+
+        def merge(a):
+            a = np.add.reduceat(a, starts, axis=0)
+            return np.add.reduceat(a, starts, axis=1)
+        return MatchupGrid(labels, *(merge(a) for a in self._totals()))
+
+    def _totals(self) -> List[np.ndarray]:
+        return [self.trials, self.ug1_wins, self.ug2_wins,
+                self.ug1_loss_cost_sum, self.ug2_loss_cost_sum]
+
+
+def _label_order(label: str):
+    # Smaller groups first, then by name
+    return (label.count("_"), label)
+
+
+def _read_columns(path: Path, is_open) -> Dict[str, np.ndarray]:
+    # Only the columns the grid needs, from a 'write_results' file
+    names = list(_GRID_COLUMNS) + ([] if is_open is None else ["is_open"])
+    if path.suffix == ".npz":
+        with np.load(path) as npz:
+            return {name: npz[name]
+                    for name in names + ["sim_uid__categories"]}
+
+    if path.suffix == ".parquet":
+        import pyarrow.parquet as pq
+        table = pq.read_table(path, columns=names)
+    else:
+        import pyarrow.feather as feather
+        table = feather.read_table(path, columns=names, memory_map=True)
+    columns = {}
+    for name in names:
+        array = table.column(name).combine_chunks()
+        if name == "sim_uid":
+            if hasattr(array, "indices"):
+                columns[name] = array.indices.to_numpy(zero_copy_only=False)
+                columns["sim_uid__categories"] = np.array(
+                    array.dictionary.to_pylist())
+            else:
+                columns["sim_uid__categories"], columns[name] = np.unique(
+                    np.array(array.to_pylist()), return_inverse=True)
+        else:
+            columns[name] = array.to_numpy(zero_copy_only=False)
+    return columns
+
+
+def matchup_grid(source, is_open=None) -> MatchupGrid:
+    # 'source' is a path written by 'write_results', a column dict from
+    # 'sweep_columns' or SimulationStats. With 'is_open', only that battle
+    # type is counted (the source then needs an 'is_open' column, or pass
+    # SimulationStats of one battle type); otherwise all rows are summed
+    if isinstance(source, (str, Path)):
+        columns = _read_columns(Path(source), is_open)
+    elif isinstance(source, dict):
+        columns = source
+    else:
+        from fatesim.results import sweep_columns
+        columns = sweep_columns(source)
+        is_open = None
+
+    rows = np.ones(len(columns["num_trials"]), dtype=bool)
+    if is_open is not None:
+        rows = np.asarray(columns["is_open"]) == is_open
+    # sim_uid is '<trials>-<UG1 uid>-<UG2 uid>' and uids have no '-'
+    uid_pairs = [uid.split("-")[1:3]
+                 for uid in np.asarray(columns["sim_uid__categories"]).tolist()]
+    labels = sorted({uid for pair in uid_pairs for uid in pair},
+                    key=_label_order)
+    label_index = {label: i for i, label in enumerate(labels)}
+    pair_index = np.array([[label_index[uid] for uid in pair]
+                           for pair in uid_pairs],
+                          dtype=np.int64).reshape(-1, 2)
+    codes = np.asarray(columns["sim_uid"])[rows]
+    i, j = pair_index[codes, 0], pair_index[codes, 1]
+
+    def total(values):
+        grid = np.zeros((len(labels), len(labels)))
+        np.add.at(grid, (i, j), np.asarray(values, dtype=np.float64)[rows])
+        return grid
+    ug1_wins = np.asarray(columns["num_ug1_victories"], dtype=np.float64)
+    ug2_wins = np.asarray(columns["num_ug2_victories"], dtype=np.float64)
+    return MatchupGrid(labels, total(columns["num_trials"]), total(ug1_wins),
+                       total(ug2_wins),
+                       total(np.asarray(columns["avg_ug1_loss_cost"])
+                             * ug2_wins),
+                       total(np.asarray(columns["avg_ug2_loss_cost"])
+                             * ug1_wins))
+
+
+def downsample_series(values: np.ndarray, max_points=500):
+    # Average (turns, ...) values over equal bins of turns, returning
+    # (bin centre turns, binned values); turns are numbered from 1
+    turns = len(values)
+    if turns <= max_points:
+        return np.arange(1, turns + 1, dtype=np.float64), values
+    starts = np.linspace(0, turns, max_points + 1).astype(np.int64)
+    counts = np.diff(starts)
+    sums = np.add.reduceat(values, starts[:-1], axis=0)
+    shape = (-1,) + (1,) * (values.ndim - 1)
+    centres = (starts[:-1] + starts[1:] + 1) / 2
+    return centres, sums / counts.reshape(shape)
+
+
+def _tick_labels(labels: List[str], max_ticks: int):
+    # Positions and labels of at most 'max_ticks' evenly spread ticks
+    step = max(1, -(-len(labels) // max_ticks))
+    positions = list(range(0, len(labels), step))
+    return positions, [labels[p] for p in positions]
+
+
+def plot_matchup_heatmaps(grid: MatchupGrid, metrics=MATCHUP_METRICS,
+                          max_size=200, backend="matplotlib", path=None,
+                          sort_by_strength=True, max_ticks=20):
+    # Heatmaps of 'metrics' with UG1 compositions as rows and UG2
+    # compositions as columns, downsampled to 'max_size' a side. Returns the
+    # matplotlib or plotly figure; with 'path' it is also saved (plotly
+    # always writes HTML)
+    if sort_by_strength:
+        grid = grid.sorted_by_strength()
+    grid = grid.downsample(max_size)
+    values = [grid.metric(m).astype(np.float32) for m in metrics]
+    titles = [METRIC_TITLES[m] for m in metrics]
+    if backend == "plotly":
+        from plotly.subplots import make_subplots
+        import plotly.graph_objects as go
+        fig = make_subplots(rows=1, cols=len(metrics), subplot_titles=titles)
+        for col, (metric, z) in enumerate(zip(metrics, values), start=1):
+            fig.add_trace(go.Heatmap(
+                z=np.round(z, 3), x=grid.labels, y=grid.labels,
+                colorscale="RdBu" if metric == "win_rate" else "Viridis",
+                zmin=0 if metric == "win_rate" else None,
+                zmax=1 if metric == "win_rate" else None,
+                colorbar={"x": col / len(metrics) - 0.02, "len": 0.9},
+                hovertemplate="%{y} vs %{x}: %{z}<extra></extra>"),
+                row=1, col=col)
+            fig.update_yaxes(autorange="reversed", row=1, col=col)
+        fig.update_layout(height=600, width=550 * len(metrics))
+        if path is not None:
+            fig.write_html(path, include_plotlyjs="cdn")
+        return fig
+    if backend != "matplotlib":
+        raise ValueError(f"Unknown backend {backend}")
+
+    import matplotlib.pyplot as plt
+    fig, axes = plt.subplots(1, len(metrics),
+                             figsize=(6 * len(metrics), 5), squeeze=False)
+    positions, labels = _tick_labels(grid.labels, max_ticks)
+    for ax, metric, z, title in zip(axes[0], metrics, values, titles):
+        image = ax.imshow(z, cmap="RdBu" if metric == "win_rate"
+                          else "viridis",
+                          vmin=0 if metric == "win_rate" else None,
+                          vmax=1 if metric == "win_rate" else None,
+                          interpolation="nearest", aspect="auto")
+        ax.set_title(title)
+        ax.set_xlabel("UG2")
+        ax.set_ylabel("UG1")
+        ax.set_xticks(positions)
+        ax.set_xticklabels(labels, rotation=90, fontsize=6)
+        ax.set_yticks(positions)
+        ax.set_yticklabels(labels, fontsize=6)
+        fig.colorbar(image, ax=ax)
+    fig.tight_layout()
+    if path is not None:
+        fig.savefig(path, dpi=150)
+    return fig
+
+
+def plot_campaign(history: Dict[str, np.ndarray], names: List[str],
+                  metrics=CAMPAIGN_METRICS, max_points=500,
+                  backend="matplotlib", path=None):
+    # One panel per metric of a 'run_campaign' history, a line per nation,
+    # each binned down to at most 'max_points' turns
+    metrics = [m for m in metrics if m in history]
+    series = {m: downsample_series(np.asarray(history[m]), max_points)
+              for m in metrics}
+    if backend == "plotly":
+        from plotly.subplots import make_subplots
+        import plotly.graph_objects as go
+        fig = make_subplots(rows=len(metrics), cols=1, shared_xaxes=True,
+                            subplot_titles=[m.capitalize() for m in metrics])
+        for row, metric in enumerate(metrics, start=1):
+            turns, values = series[metric]
+            for n, name in enumerate(names):
+                fig.add_trace(go.Scattergl(
+                    x=turns, y=np.round(values[:, n], 3), name=name,
+                    legendgroup=name, showlegend=row == 1, mode="lines"),
+                    row=row, col=1)
+        fig.update_xaxes(title_text="Turn", row=len(metrics), col=1)
+        fig.update_layout(height=250 * len(metrics), width=900)
+        if path is not None:
+            fig.write_html(path, include_plotlyjs="cdn")
+        return fig
+    if backend != "matplotlib":
+        raise ValueError(f"Unknown backend {backend}")
+
+    import matplotlib.pyplot as plt
+    fig, axes = plt.subplots(len(metrics), 1, sharex=True, squeeze=False,
+                             figsize=(9, 2.5 * len(metrics)))
+    for ax, metric in zip(axes[:, 0], metrics):
+        turns, values = series[metric]
+        for n, name in enumerate(names):
+            ax.plot(turns, values[:, n], label=name)
+        ax.set_ylabel(metric.capitalize())
+    axes[-1, 0].set_xlabel("Turn")
+    axes[0, 0].legend(fontsize=6, ncol=4)
+    fig.tight_layout()
+    if path is not None:
+        fig.savefig(path, dpi=150)
+    return fig
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Draw matchup heatmaps from a saved sweep")
+    parser.add_argument("results", help="file written by 'write_results'")
+    parser.add_argument("--out", required=True,
+                        help="output file (.html uses plotly, anything else "
+                             "matplotlib)")
+    parser.add_argument("--battle-type", choices=("open", "structure"),
+                        help="only one battle type (needs an is_open "
+                             "column)")
+    parser.add_argument("--max-size", type=int, default=200)
+    args = parser.parse_args()
+
+    is_open = None if args.battle_type is None else\
+        args.battle_type == "open"
+    grid = matchup_grid(args.results, is_open)
+    backend = "plotly" if args.out.endswith(".html") else "matplotlib"
+    plot_matchup_heatmaps(grid, max_size=args.max_size, backend=backend,
+                          path=args.out)
+    print(f"Wrote {args.out} ({grid.size} compositions)")
+
+
+if __name__ == "__main__":
+    main()
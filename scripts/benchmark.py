@@ -0,0 +1,197 @@
+from typing import Callable, Dict, List
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+from fatesim.dice import GLOBAL_DICE, BufferedDice
+from fatesim.modifier import Modifier, combine_modifiers
+from fatesim.simulation import (allocate_casualties, determine_new_units,
+                                determine_total_modifier, roll_combat_dice,
+                                simulate_battle)
+from fatesim.stats import simulate_n_stats
+from fatesim.unit import UNIT_TEMPLATES, unit_group_from_templates
+
+# Benchmarks for the combat and stats hot paths. Each case reports
+# throughput (work items per second) and peak traced memory; results are
+# saved as a JSON baseline and can be compared against an older one:
+#   python benchmark.py --save baseline.json
+#   python benchmark.py --compare baseline.json --threshold 0.1
+
+# Unit groups of 1, 2 and 3 units
+GROUPS = {
+    1: (["basic_infantry"], ["basic_cavalry"]),
+    2: (["basic_infantry", "basic_siege"], ["extra_cavalry", "basic_cavalry"]),
+    3: (["basic_infantry", "basic_siege", "basic_infantry"],
+        ["extra_cavalry", "basic_cavalry", "extra_cavalry"]),
+}
+STATS_TRIALS = [100, 1000, 10000]
+# Field armies, far beyond the 3 unit groups of the base game
+ARMY_SIZES = [30, 300]
+
+
+class BenchmarkCase():
+    # 'func' does 'items' units of work (e.g. trials) per call
+    def __init__(self, name: str, func: Callable, items=1,
+                 unit="calls") -> None:
+        self.name = name
+        self.func = func
+        self.items = items
+        self.unit = unit
+
+    def run(self, min_time: float, repeat=3) -> Dict:
+        # Best of 'repeat' rounds of at least 'min_time' seconds each, to keep
+        # noise from other processes out of the comparison
+        self.func()  # warm up caches
+        throughput = 0.
+        for _ in range(repeat):
+            calls = 0
+            start = time.perf_counter()
+            elapsed = 0.
+            while elapsed < min_time:
+                self.func()
+                calls += 1
+                elapsed = time.perf_counter() - start
+            throughput = max(throughput, calls * self.items / elapsed)
+
+        tracemalloc.start()
+        self.func()
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return {"throughput": throughput,
+                "unit": f"{self.unit}/s", "peak_memory": peak_memory}
+
+
+def benchmark_cases() -> List[BenchmarkCase]:
+    cases = []
+    cases.append(BenchmarkCase(
+        "unit_construction",
+        lambda: [template() for template in UNIT_TEMPLATES.values()],
+        items=len(UNIT_TEMPLATES), unit="units"))
+
+    modifiers = [Modifier.from_bonus_str(bonus_str) for bonus_str in
+                 ["+2 siege open", "+1 infantry open", "-2 all struct",
+                  "+3 siege open", "+3 infantry open", "-2 all struct",
+                  "+1 all open", "+3 all struct"]]
+    cases.append(BenchmarkCase("combine_modifiers",
+                               lambda: combine_modifiers(modifiers)))
+
+    faces = [6, 6, 3]
+    for name, dice in (("global", GLOBAL_DICE), ("buffered", BufferedDice(0))):
+        cases.append(BenchmarkCase(f"roll_combat_dice[{name}]",
+                                   lambda dice=dice:
+                                   roll_combat_dice(faces, dice),
+                                   items=len(faces), unit="dice"))
+
+    for size, (names_1, names_2) in GROUPS.items():
+        ug1 = unit_group_from_templates(names_1)
+        ug2 = unit_group_from_templates(names_2)
+        # Seeded so 'determine_new_units' times the same casualties on
+        # every run
+        result = simulate_battle(ug1, ug2, True, BufferedDice(0))
+        cases.extend([
+            BenchmarkCase(f"determine_total_modifier[{size}]",
+                          lambda ug1=ug1, ug2=ug2:
+                          determine_total_modifier(ug1, ug2, True)),
+            BenchmarkCase(f"simulate_battle[{size}]",
+                          lambda ug1=ug1, ug2=ug2:
+                          simulate_battle(ug1, ug2, True),
+                          unit="battles"),
+            BenchmarkCase(f"determine_new_units[{size}]",
+                          lambda ug1=ug1, result=result:
+                          determine_new_units(ug1, result)),
+        ])
+        for n in STATS_TRIALS:
+            for vectorized in (False, True):
+                engine = "vectorized" if vectorized else "reference"
+                cases.append(BenchmarkCase(
+                    f"simulate_n_stats[{engine},{size},{n}]",
+                    lambda ug1=ug1, ug2=ug2, n=n, vectorized=vectorized:
+                    simulate_n_stats(ug1, ug2, True, n=n,
+                                     vectorized=vectorized, seed=0),
+                    items=n, unit="trials"))
+
+    names = sorted(UNIT_TEMPLATES)
+    for size in ARMY_SIZES:
+        army = unit_group_from_templates(names[i % len(names)]
+                                         for i in range(size)).units
+        for unit in army[::4]:
+            unit.is_bloodied = True
+        # Kill a third of the army and make both bloodying hits
+        deficit = 6 * (size // 3) + 5
+        cases.append(BenchmarkCase(
+            f"allocate_casualties[{size}]",
+            lambda army=army, deficit=deficit:
+            allocate_casualties(army, deficit),
+            items=size, unit="units"))
+    return cases
+
+
+def run_benchmarks(min_time=0.2, pattern="") -> Dict:
+    results = {}
+    for case in benchmark_cases():
+        if pattern in case.name:
+            results[case.name] = case.run(min_time)
+            print(f"{case.name:45s} {results[case.name]['throughput']:14.1f} "
+                  f"{results[case.name]['unit']:10s} "
+                  f"{results[case.name]['peak_memory'] / 1024:10.1f} KiB")
+    return {
+        "meta": {"python": sys.version.split()[0],
+                 "platform": platform.platform(),
+                 "time": time.strftime("%Y-%m-%d %H:%M:%S")},
+        "results": results,
+    }
+
+
+def compare(baseline: Dict, current: Dict, threshold: float) -> List[str]:
+    # Cases whose throughput fell, or peak memory grew, by more than
+    # 'threshold' (a fraction) relative to the baseline
+    regressions = []
+    for name, new in current["results"].items():
+        old = baseline["results"].get(name)
+        if old is None:
+            continue
+        change = new["throughput"] / old["throughput"] - 1
+        if change < -threshold:
+            regressions.append(f"{name}: throughput {change:+.1%}")
+        if old["peak_memory"] and\
+                new["peak_memory"] / old["peak_memory"] - 1 > threshold:
+            change = new["peak_memory"] / old["peak_memory"] - 1
+            regressions.append(f"{name}: peak memory {change:+.1%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the fatesim combat and stats hot paths")
+    parser.add_argument("--save", help="write results to this JSON file")
+    parser.add_argument("--compare", help="baseline JSON file to compare to")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="allowed relative slowdown (default 0.1)")
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="seconds to run each case for")
+    parser.add_argument("-k", dest="pattern", default="",
+                        help="only run cases whose name contains this")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.min_time, args.pattern)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args.threshold)
+        if regressions:
+            print(f"\nRegressions beyond {args.threshold:.0%}:")
+            print("\n".join(regressions))
+            sys.exit(1)
+        print(f"\nNo regressions beyond {args.threshold:.0%}")
+
+
+if __name__ == "__main__":
+    main()
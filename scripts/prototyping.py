@@ -4,37 +4,34 @@ import random
 
 from fatesim.simulation import determine_new_units, simulate_battle
 from fatesim.stats import simulate_n_stats, SimulationStats
-from fatesim.unit import UnitGroup, UNIT_TEMPLATES
+from fatesim.sweep import BATTLE_TYPES, run_sweep
+from fatesim.unit import UnitGroup, UNIT_TEMPLATES, unit_group_from_templates
 
 
-def random_unit_group():
+def random_unit_group(rng=random):
+    # 'rng' is a 'random.Random' (the global 'random' by default)
     unit_kinds = list(UNIT_TEMPLATES.keys())
-    num_units = random.randint(1, 3)
-    units = []
-    uid = ""
-    for i in range(num_units):
-        unit_kind = random.choice(unit_kinds)
-        units.append(UNIT_TEMPLATES[unit_kind]())
-        # capital letter of template type
-        unit_level, unit_type = unit_kind.split("_")
-        uid += f"{unit_level[0].capitalize()}{unit_type[0].capitalize()}_"
-
-    uid = uid.rstrip("_")
-
-    return UnitGroup(units, uid)
-
-
-def random_unit_group_sims(num_sims=5, num_trials=100) -> Tuple[SimulationStats]:
-    open_sim_stats = []
-    struct_sim_stats = []
-    for i in range(num_sims):
-        # Generate random groups
-        ug1, ug2 = random_unit_group(), random_unit_group()
-        # Open battle
-        open_sim_stats.append(simulate_n_stats(ug1, ug2, True, n=num_trials))
-        # Structure battle
-        struct_sim_stats.append(simulate_n_stats(
-            ug1, ug2, False, n=num_trials))
+    num_units = rng.randint(1, 3)
+    return unit_group_from_templates([rng.choice(unit_kinds)
+                                      for _ in range(num_units)])
+
+
+def random_unit_group_sims(num_sims=5, num_trials=100,
+                           seed=0) -> Tuple[SimulationStats]:
+    # Generate random groups, from 'seed' too so a run is reproducible
+    rng = random.Random(seed)
+    matchups = [(random_unit_group(rng), random_unit_group(rng))
+                for _ in range(num_sims)]
+    # Open and structure battles on all cores, seeded per matchup
+    open_sim_stats = [None] * num_sims
+    struct_sim_stats = [None] * num_sims
+    for index, is_open, sim_stats in run_sweep(matchups, num_trials=num_trials,
+                                               seed=seed):
+        i = index // len(BATTLE_TYPES)
+        if is_open:
+            open_sim_stats[i] = sim_stats
+        else:
+            struct_sim_stats[i] = sim_stats
 
     return open_sim_stats, struct_sim_stats
 